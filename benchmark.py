@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Nobby.
+#
+# Nobby is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Nobby is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nobby. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the LaTeX parser and the HTML conversion of Nobby.
+
+Help:          run `benchmark.py -h`
+Unit tests:    run `py.test` in this directory.
+
+The benchmarks time every parsing and conversion stage for synthetic
+documents (see :func:`generateDocument`). Every benchmark varies one
+parameter of a base document, which shows how each stage scales with the
+size of the document, the density of math, the nesting depth of
+environments, and the frequency of macros. The results can be saved and
+compared with those of a previous run to catch regressions.
+"""
+
+import io
+import re
+import sys
+import json
+import time
+import nobby
+import random
+import plugins
+import argparse
+import platform
+import contextlib
+import collections
+
+
+# The parameters of the base document, and the values every benchmark sweeps
+# (one parameter at a time).
+base_params = {'paragraphs': 100, 'math_density': 0.1, 'depth': 2,
+               'macro_freq': 0.1}
+sweeps = collections.OrderedDict([
+    ('paragraphs', (25, 50, 100, 200, 400)),
+    ('math_density', (0, 0.1, 0.3, 0.6)),
+    ('depth', (0, 1, 2, 4, 8)),
+    ('macro_freq', (0, 0.1, 0.3, 0.6)),
+])
+
+# The stages in the order Nobby runs them (see nobby.convertDocument).
+stage_names = ('splitLaTeXDocument', 'findDelimiters', 'pruneDelimiters',
+               'buildTree', 'convertTreeToHTML', 'prettifyHTML')
+
+# Format identifier of the result files.
+result_format = 'nobby-benchmark-1'
+
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor',
+         'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+# Macros with a plugin, and one without (see plugins.plugins).
+macros = ('emph', 'textbf', 'texttt', 'footnote', 'unknownmacro')
+
+
+def generateDocument(paragraphs=100, math_density=0.1, depth=2,
+                     macro_freq=0.1, seed=0):
+    """
+    Return a synthetic LaTeX document.
+
+    The document consists of ``paragraphs`` paragraphs of random words, with
+    a section heading every ten paragraphs and an occasional comment. The
+    ``math_density`` is the fraction of words that are inline equations,
+    and also the probability that a paragraph is followed by a displayed
+    equation. Every fifth paragraph is followed by lists nested ``depth``
+    levels deep (none if ``depth`` is zero). The ``macro_freq`` is the
+    fraction of words that are wrapped in a macro like '\\\\emph'.
+
+    The same arguments always produce the same document.
+
+    Example:
+
+    .. inline-python::
+
+        import benchmark
+        print(benchmark.generateDocument(paragraphs=1, depth=1, seed=1))
+
+    :param *int* paragraphs: number of paragraphs.
+    :param *float* math_density: fraction of inline equations (0 to 1).
+    :param *int* depth: nesting depth of the list environments.
+    :param *float* macro_freq: fraction of words in macros (0 to 1).
+    :param *int* seed: seed of the random number generator.
+    :return: LaTeX document.
+    :rtype: **str**
+    """
+    rng = random.Random(seed)
+
+    def formula():
+        a, b = rng.sample('abcxyz', 2)
+        return rng.choice((
+            '{}^{{{}}}'.format(a, rng.randint(2, 9)),
+            '\\frac{{{}}}{{{}}}'.format(a, b),
+            '{}_{{i}} + {}_{{j}}'.format(a, b),
+            '\\sqrt{{{} + {}}}'.format(a, b),
+        ))
+
+    def sentence():
+        out = []
+        for ii in range(rng.randint(8, 16)):
+            val = rng.random()
+            if val < math_density:
+                out.append('${}$'.format(formula()))
+            elif val < math_density + macro_freq:
+                out.append('\\{}{{{}}}'.format(rng.choice(macros),
+                                               rng.choice(words)))
+            else:
+                out.append(rng.choice(words))
+        return ' '.join(out) + '.'
+
+    def nestedList(level):
+        env = ('itemize', 'enumerate')[level % 2]
+        out = ['\\begin{{{}}}'.format(env)]
+        for ii in range(2):
+            out.append('\\item ' + sentence())
+        if level + 1 < depth:
+            out.append(nestedList(level + 1))
+        out.append('\\end{{{}}}'.format(env))
+        return '\n'.join(out)
+
+    body = []
+    for num in range(paragraphs):
+        if num % 10 == 0:
+            body.append('\\section{{{}}}'.format(rng.choice(words)))
+        if rng.random() < 0.1:
+            body.append('% ' + sentence())
+        body.append(' '.join(sentence() for ii in range(rng.randint(2, 5))))
+        if rng.random() < math_density:
+            body.append('\\begin{{equation}}\n{}\n\\end{{equation}}'.format(
+                formula()))
+        if depth > 0 and num % 5 == 4:
+            body.append(nestedList(0))
+        body.append('')
+
+    return ('\\documentclass{article}\n\\usepackage{amsmath}\n'
+            '\\begin{document}\n' + '\n'.join(body) + '\\end{document}\n')
+
+
+def dumpCounters(body):
+    """
+    Return the counter values that LaTeX would dump for ``body``.
+
+    This mimics :func:`nobby.compileWithCounters` without LaTeX: every
+    environment in ``config.counter_dump_envs`` and macro in
+    ``config.counter_dump_macros`` gets a counter dump, and increments the
+    counter of the same name (if there is one). The dump holds the values
+    *before* the increment, just like the one LaTeX writes.
+
+    :param *str* body: document body.
+    :return: list of :class:`nobby.NTCounter` tuples.
+    :rtype: **list**
+    """
+    config = nobby.config
+    envs = '|'.join(config.counter_dump_envs)
+    macros = '|'.join(config.counter_dump_macros)
+    pat = r'\\begin{{({})}}|\\({})(?![a-zA-Z*])'.format(envs, macros)
+
+    values = {_: 0 for _ in config.counter_names}
+    counters = []
+    for m in re.finditer(pat, body):
+        counters.append(nobby.NTCounter(
+            m.start(), m.end(), {k: str(v) for k, v in values.items()}))
+        name = m.group(1) or m.group(2)
+        if name in values:
+            values[name] += 1
+    return counters
+
+
+def timeStages(document, repeat=3):
+    """
+    Return the time of every parsing and conversion stage for ``document``.
+
+    Every stage runs ``repeat`` times, and the fastest run counts, because
+    it is the one least affected by other processes on the machine. The
+    stages run exactly like they do in Nobby, except that the counter values
+    come from :func:`dumpCounters` instead of LaTeX.
+
+    :param *str* document: LaTeX document.
+    :param *int* repeat: number of runs per stage.
+    :return: ({stage name: seconds}, number of fragments).
+    :rtype: (**dict**, **int**)
+    """
+    best = collections.OrderedDict((_, float('inf')) for _ in stage_names)
+
+    def timed(name, func, *args):
+        t0 = time.perf_counter()
+        ret = func(*args)
+        best[name] = min(best[name], time.perf_counter() - t0)
+        return ret
+
+    # The tree nodes and fragments pick their counter values from the config.
+    preamble, body = nobby.splitLaTeXDocument(document)
+    counter_values = nobby.config.counter_values
+    nobby.config.counter_values = dumpCounters(body)
+
+    # The conversion prints warnings (eg. for unknown macros).
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for ii in range(repeat):
+                preamble, body = timed('splitLaTeXDocument',
+                                       nobby.splitLaTeXDocument, document)
+                delims = timed('findDelimiters', nobby.findDelimiters, body)
+                delims = timed('pruneDelimiters', nobby.pruneDelimiters,
+                               delims, plugins.plugins)
+                tree = timed('buildTree', nobby.buildTree, body, delims)
+                fragments = []
+                html = timed('convertTreeToHTML', nobby.convertTreeToHTML,
+                             tree, fragments, plugins.plugins)
+                timed('prettifyHTML', nobby.prettifyHTML, html)
+    finally:
+        nobby.config.counter_values = counter_values
+    return best, len(fragments)
+
+
+def runBenchmarks(scale=1, repeat=3):
+    """
+    Run all benchmarks and return their results.
+
+    :param *float* scale: factor for the number of paragraphs of all
+        documents (eg. 0.25 for a quick run).
+    :param *int* repeat: number of runs per stage (see :func:`timeStages`).
+    :return: results in the format that :func:`compareResults` expects.
+    :rtype: **dict**
+    """
+    results = []
+    for name, values in sweeps.items():
+        for value in values:
+            params = dict(base_params)
+            params[name] = value
+            params['paragraphs'] = max(1, int(params['paragraphs'] * scale))
+            document = generateDocument(**params)
+            seconds, num_frags = timeStages(document, repeat)
+            results.append({'sweep': name, 'params': params,
+                            'chars': len(document), 'fragments': num_frags,
+                            'seconds': seconds})
+            print('{:13s} {:>5} {:8d} chars: {:8.1f}ms'.format(
+                name, value, len(document), 1000 * sum(seconds.values())),
+                flush=True)
+    return {'format': result_format, 'created': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(), 'scale': scale, 'repeat': repeat,
+            'results': results}
+
+
+def compareResults(old, new, threshold=0.25, min_seconds=1E-3):
+    """
+    Return all stages that are slower in ``new`` than in ``old``.
+
+    A stage counts as slower if it takes more than ``1 + threshold`` times
+    as long as before, and at least ``min_seconds`` longer. The latter
+    ignores the noise of stages that hardly take any time. Benchmarks with
+    different document parameters are not comparable and thus ignored.
+
+    :param *dict* old: results of a previous run (see :func:`runBenchmarks`).
+    :param *dict* new: current results.
+    :param *float* threshold: tolerated slow down (eg. 0.25 for 25%).
+    :param *float* min_seconds: tolerated absolute slow down.
+    :return: list of (params, stage, old seconds, new seconds).
+    :rtype: **list**
+    """
+    def key(params):
+        return tuple(sorted(params.items()))
+
+    previous = {key(_['params']): _['seconds'] for _ in old['results']}
+    regressions = []
+    for result in new['results']:
+        old_seconds = previous.get(key(result['params']))
+        if old_seconds is None:
+            continue
+        for stage, seconds in result['seconds'].items():
+            if stage not in old_seconds:
+                continue
+            before = old_seconds[stage]
+            if seconds > before * (1 + threshold) and \
+               seconds - before > min_seconds:
+                regressions.append((result['params'], stage, before, seconds))
+    return regressions
+
+
+def parseCmdline():
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the parser and HTML conversion of Nobby')
+    padd = parser.add_argument
+    padd('-o', type=str, default=None, metavar='file',
+         help='Save the results to this JSON file')
+    padd('--compare', type=str, default=None, metavar='file',
+         help='Compare the results with those in this JSON file')
+    padd('--threshold', type=float, default=0.25, metavar='T',
+         help='Report stages that are more than T slower (default 0.25)')
+    padd('--repeat', type=int, default=3, metavar='N',
+         help='Runs per stage; the fastest one counts (default 3)')
+    padd('--quick', action='store_true', default=False,
+         help='Use documents a quarter of the usual size')
+    return parser.parse_args()
+
+
+def main():
+    args = parseCmdline()
+
+    scale = 0.25 if args.quick else 1
+
+    # Load the previous results first, to fail before the benchmarks run.
+    old = None
+    if args.compare is not None:
+        old = json.loads(open(args.compare, 'r').read())
+        if old.get('format') != result_format:
+            print('Unknown result format in <{}>'.format(args.compare))
+            sys.exit(1)
+        if old['scale'] != scale:
+            print('Cannot compare the results: <{}> used a different '
+                  'document size (see --quick)'.format(args.compare))
+            sys.exit(1)
+
+    new = runBenchmarks(scale, args.repeat)
+    if args.o is not None:
+        open(args.o, 'w').write(json.dumps(new, indent=1))
+        print('Results: <{}>'.format(args.o))
+
+    if old is None:
+        return
+    regressions = compareResults(old, new, args.threshold)
+    for params, stage, before, seconds in regressions:
+        print('Slower: {} {:.1f}ms -> {:.1f}ms ({:+.0f}%) for {}'.format(
+            stage, 1000 * before, 1000 * seconds,
+            100 * (seconds / before - 1), params))
+    if len(regressions) > 0:
+        sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
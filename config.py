@@ -15,14 +15,55 @@
 # You should have received a copy of the GNU General Public License
 # along with Nobby. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import getpass
+import tempfile
 import multiprocessing
 
 # Removes build directory when nobby is done.
 keep_builddir = False
 
-# If True, then existing fragment images will not be compiled again.
+# HTML output directory (relative to the LaTeX file). If None, then Nobby
+# uses 'html-<name of LaTeX file>'.
+html_dir = None
+
+# If True, then fragment images from the fragment cache will not be compiled
+# again.
 skip_existing_fragments = True
 
+# Directory of the fragment cache. Nobby stores every fragment image it
+# compiles there, named after a hash of everything that determines its
+# appearance (preamble, LaTeX code, counter values, scale, ...). Subsequent
+# runs only compile fragments whose hash is not yet in the cache, irrespective
+# of where in the document they are. The counter values of every document
+# also go there, which lets Nobby skip the compilation with counter dumps if
+# the document has not changed (or only in its plain text). Set to None to
+# disable the cache.
+cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'nobby')
+
+# Remove all images from the fragment cache that were not used for this many
+# days. Afterwards, remove the least recently used images until the cache is
+# smaller than 'cache_max_size' (in Bytes).
+cache_max_age = 30
+cache_max_size = 200 * 2 ** 20
+
+# Nobby checks the size and age of the cache entries at most once in this many
+# seconds, because it has to visit every file in the cache to do so.
+cache_prune_interval = 3600
+
+# The cache key of every fragment also covers the state (ie. modification time
+# and size) of every file that the fragment or the preamble reads with one of
+# these macros (eg. '\includegraphics{plot}'). Nobby looks for these files in
+# the directory of the LaTeX file, with every extension in 'input_extensions'
+# that LaTeX would try. If you define macros that read files, add them to the
+# list.
+input_macros = ['input', 'include', 'includegraphics', 'includepdf',
+                'includestandalone', 'lstinputlisting', 'verbatiminput',
+                'usepackage', 'documentclass']
+input_extensions = ['', '.tex', '.sty', '.cls', '.pdf', '.png', '.jpg',
+                    '.jpeg', '.eps', '.mps']
+
 # Maximum size of SVG image (in Bytes) before it will be converted to PNG.
 max_svg_size = 100000
 
@@ -31,6 +72,10 @@ max_svg_size = 100000
 # page background is purely white, than JPG might give you smaller files.
 alt_image_format = 'png'
 
+# Resolution (in dots per inch) of the bitmap that determines the crop box of
+# every fragment. This is also the resolution of the alternative images.
+raster_dpi = 120
+
 # Display all environments that Nobby could not convert.
 show_unconverted_envs = True
 
@@ -57,8 +102,29 @@ textwidth_addon = 0
 # HTML tags will replace these strings.
 ph_format = '{0}-{1:06d}'
 
-# Format of HTML image inclusion tags.
-tag_format = '<img src="{}" style="vertical-align: middle;">'
+# Format of HTML image inclusion tags. The second field is the CSS style of
+# the image, ie. its exact size and vertical alignment for measured fragments
+# (see 'measure_inline'), and 'vertical-align: middle;' for all others.
+tag_format = '<img src="{0}" style="{1}">'
+
+# Measure the size and baseline of every inline equation (ie. '$' fragment)
+# with TeX. This produces exact 'vertical-align', 'width' and 'height' styles
+# for the <img> tags. Otherwise, and for all other inline fragments (eg.
+# macros), Nobby centres the images vertically, based on a reference block
+# that it finds in a rendered bitmap of the fragment.
+measure_inline = True
+
+# Extra space (in points) around the measured box of inline fragments. This
+# avoids clipping characters that protrude from their box (eg. italic ones).
+fragment_padding = 1
+
+# Backend for fragment images. The 'pdf' backend compiles fragments to PDF and
+# converts them with pdf2svg. The 'dvi' backend compiles them to DVI, which
+# is faster, and converts all pages of a DVI file with a single dvisvgm call.
+# The 'dvi' backend always measures inline equations (see 'measure_inline'),
+# never replaces large SVG images with 'alt_image_format', and only supports
+# graphics formats that work with DVI (eg. EPS).
+backend = 'pdf'
 
 # If True, then the full LaTeX code including preamble will be listed, instead
 # of only the source code fragment.
@@ -84,9 +150,83 @@ verbose = False
 # If True, Nobby will open the HTML file in the default browser.
 launch_browser = False
 
-# Number of worker processes to compile fragments.
+# If True, Nobby converts the file again whenever it, or any file it includes,
+# changes. Nobby checks the files every 'watch_interval' seconds.
+watch = False
+watch_interval = 0.5
+
+# Number of documents that convert concurrently if Nobby converts several
+# files at once.
+max_documents = 2
+
+# Report the wall- and CPU time of every conversion stage, and the run times
+# of all external programs.
+profile = False
+
+# Report the source line, node name and tool times of the N fragments that
+# took longest to compile (0 disables the report).
+slowest_fragments = 0
+
+# Write a timeline of the stages, workers, fragments and external programs to
+# this file, in the Chrome trace event format (eg. for ui.perfetto.dev).
+trace = None
+
+# Run a daemon that converts files on behalf of other Nobby processes. It
+# listens on the Unix socket 'daemon_socket', and keeps the fragment pipelines
+# (ie. the idle TeX workers) of the last 'daemon_pipelines' documents warm.
+# It reports the status of the last 'daemon_history' jobs on request. Unless
+# 'use_daemon' is False, Nobby hands every conversion to the daemon if one is
+# running. Nobby only uses a socket in a directory that belongs to the user and
+# that nobody else can write to (by default the runtime directory of the user,
+# or a private directory that the daemon creates in the temporary directory).
+daemon = False
+daemon_status = False
+use_daemon = True
+daemon_socket = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        tempfile.gettempdir(), 'nobby-{}'.format(getpass.getuser())),
+    'nobby-{}.sock'.format(getpass.getuser()))
+daemon_pipelines = 2
+daemon_history = 100
+
+# Maximum number of external programs that compile and convert fragments at
+# the same time.
 num_processes = multiprocessing.cpu_count()
 
+# Adapt the number of concurrent processes to the system while Nobby compiles
+# fragments. It starts at 'num_processes' and changes every
+# 'adaptive_interval' seconds, depending on the load average, the available
+# memory (at least 'adaptive_min_memory' bytes) and the throughput, but never
+# exceeds 'max_processes'. Nobby prints every adjustment.
+adaptive_concurrency = False
+max_processes = 2 * multiprocessing.cpu_count()
+adaptive_interval = 5
+adaptive_min_memory = 512 * 2**20
+
+# Separate limits for individual programs. Every fragment passes through
+# pdflatex, then pdfseparate (or dvisvgm), pdftoppm and pdf2svg, and waits
+# in a queue for each of them. Rasterising with pdftoppm needs far more
+# memory than the other steps, which is why it runs on at most half the
+# cores. Programs without an entry here use 'num_processes', which is also
+# an upper bound for all entries.
+tool_limits = {'pdftoppm': max(1, multiprocessing.cpu_count() // 2)}
+
+# Maximum number of fragments that each pdfLaTeX run compiles (one page per
+# fragment). Use 1 to compile every fragment separately.
+max_batch_size = 20
+
+# Compile the preamble once into a pdfLaTeX format and start all fragment
+# compilations from that format instead of parsing the preamble every time.
+use_preamble_format = True
+
+# Typeset all fragments with long-lived pdfLaTeX processes (one per pdflatex
+# slot, see 'tool_limits') instead of starting pdfLaTeX for every batch of
+# fragments. Every worker hands its fragments on for conversion after
+# 'max_batch_size' fragments. Workers that do not finish a fragment within
+# 'fragment_timeout' seconds are restarted.
+use_tex_workers = True
+fragment_timeout = 60
+
 # Number of LaTeX invocations per file (only heeded when 'use_latexmk' is
 # False).
 num_compile_iter = 1
@@ -103,6 +243,17 @@ counter_dump_envs = ['align', 'equation', 'figure', 'table', 'subequations',
                      'proof']
 counter_dump_macros = ['section', 'subsection', 'subsubsection']
 
+# The appearance of a fragment depends on the LaTeX counters only if it
+# contains one of the environments and macros in 'counter_dump_envs' and
+# 'counter_dump_macros', a '\the<counter>' macro for one of the counters in
+# 'counter_names', or one of the following macros. Nobby compiles all other
+# fragments without counter values, which means identical fragments share a
+# single image. If you define macros that display counter values, add them to
+# this list.
+counter_macros = ['arabic', 'roman', 'Roman', 'alph', 'Alph', 'fnsymbol',
+                  'value', 'footnote', 'caption', 'stepcounter',
+                  'refstepcounter', 'addtocounter', 'setcounter']
+
 # Nobby will track these LaTeX counters. If you specify new theorem like
 # environments with '\newtheorem{foo}{Foo} then you must add 'foo' to the
 # list. Augment the list with all additional counters you want Nobby to track.
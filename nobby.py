@@ -28,21 +28,47 @@ Source code:   https://github.com/olitheolix/nobby
 import re
 import os
 import sys
+import json
 import time
+import heapq
 import shutil
+import bisect
+import socket
+import struct
 import config
 import plugins
-import IPython
+import hashlib
+import difflib
+import asyncio
 import argparse
-import webbrowser
+import itertools
+import resource
+import contextlib
 import subprocess
-import numpy as np
+import contextvars
 import collections
-import multiprocessing
-import PIL.Image as Image
 
+# IPython, NumPy, PIL and the web browser take longer to import than Nobby
+# needs for the command line, the daemon client, or a conversion from the
+# cache. The functions that need them import them on first use instead.
+ipshell = plugins.ipshell
 
-ipshell = IPython.embed
+# Semaphores that limit the number of concurrent runs of every external
+# program while Nobby compiles fragments (see toolSlot).
+tool_slots = contextvars.ContextVar('tool_slots', default=None)
+
+# State that concurrent documents share when Nobby converts several files at
+# once (see convertFiles): a lock for the global state of the HTML conversion
+# (see convertDocument), the {(preamble, files): format task} of all formats
+# (see buildPreambleFormat), and the {frag['hash']: future} of all fragments
+# (see compileFragments).
+convert_lock = contextvars.ContextVar('convert_lock', default=None)
+shared_formats = contextvars.ContextVar('shared_formats', default=None)
+shared_fragments = contextvars.ContextVar('shared_fragments', default=None)
+
+# Running number that makes the names of the LaTeX files that Nobby writes
+# next to the source file unique (see scratchName).
+scratch_ids = itertools.count()
 
 # Meta information about delimiters in LaTeX code (eg. '$' or \begin).
 Delim = collections.namedtuple('Delim', 'span isOpen type name')
@@ -51,10 +77,43 @@ Delim = collections.namedtuple('Delim', 'span isOpen type name')
 PathNames = collections.namedtuple(
     'PathNames', 'f_source f_tex f_html d_base d_build d_html')
 
+# Output files of a LaTeX run (see runPDFLaTeX).
+TexOut = collections.namedtuple('TexOut', 'tex log aux out nobby fls')
+
+# Counter values at a position in the document body (see
+# compileWithCounters).
+NTCounter = collections.namedtuple('NTCounter', 'start stop counters')
+
 # Record all macros and environments for which no plugin exists.
 # Nobby will print the list in verbose (-v) mode.
 no_plugins = []
 
+# Collects the run times of the stages and external programs if the user
+# asked for them with --profile or --trace (see Profile). The trace shows
+# every task on the track of its document and worker.
+profiler = None
+trace_track = contextvars.ContextVar('trace_track', default='main')
+
+# The fragments of the current fragment task. Every tool the task runs adds
+# its time to them (see profileTool and reportSlowestFragments).
+charged_fragments = contextvars.ContextVar('charged_fragments', default=())
+
+# The options that make every external program print its version (see
+# findTools). The default is '--version'.
+tool_version_args = {'pdf2svg': (), 'pdftoppm': ('-v', ),
+                     'pdfseparate': ('-v', ), 'latexmk': ('-v', )}
+
+# The settings in ``config`` that the command line sets for a single
+# conversion. A client passes them to the daemon with every job (see
+# submitJob and runJob).
+job_options = ('skip_existing_fragments', 'cache_dir', 'pdf_scale',
+               'textwidth_addon', 'max_svg_size', 'show_unconverted_envs',
+               'keep_builddir', 'max_batch_size', 'use_preamble_format',
+               'use_tex_workers', 'backend', 'verbose', 'errtex_showfull',
+               'html_dir', 'num_compile_iter', 'use_latexmk', 'profile',
+               'trace', 'slowest_fragments', 'num_processes',
+               'adaptive_concurrency')
+
 # ----------------------------------------------------------------------------
 #                               LaTeX Parsing
 # ----------------------------------------------------------------------------
@@ -456,15 +515,23 @@ def findDelimiters(body):
     """
     Return list of all **Delim** instances.
 
-    The delimiters comprise '$', \begin and \end, etc.
+    The delimiters comprise '$', \\begin and \\end, etc.
 
     The returned list accounts for every byte in the LaTeX ``body``. Its
     constituents specify the position and length of every delimiter.
 
     Delimiters have different lengths. For instance, '$' and '$$' environments
-    have one- and two byte long delimiters, whereas '\begin{itemize}' is 15
+    have one- and two byte long delimiters, whereas '\\begin{itemize}' is 15
     characters long, and plain text delimiters are zero bytes long.
 
+    This function scans ``body`` exactly once. The result is identical to
+    running :func:`findComments`, :func:`findBeginEnd`, :func:`findCurly`,
+    :func:`findDollar`, :func:`findNewline` and :func:`findMacros` in that
+    order, each on the sanitised output of its predecessor. The precedence
+    those parsers derive from their order is encoded in the regular expression
+    below (eg. '\\\\$' is an escaped dollar preceded by a single backslash, not
+    a LaTeX newline followed by a dollar).
+
     The output of this function almost certainly requires some pruning to
     ensure consistency. :func:`pruneDelimiters` will do that.
 
@@ -476,67 +543,128 @@ def findDelimiters(body):
     if body == '':
         return {}
 
-    delim = {}
-
-    # ------------------------------------------------------------------------
-    # Run all the delimiter parser. Their order matters because the substitute
-    # all their matches with blank space. For instance, \begin looks like any
-    # other macro (eg. \ldots), which is why ``findBeginEnd`` must run before
-    # ``findMacro``. If not, the latter would blank out every \begin and \end.
-    # ------------------------------------------------------------------------
-    body_sane, tmp = findComments(body)
-    delim.update(tmp)
-
-    body_sane, tmp = findBeginEnd(body_sane)
-    delim.update(tmp)
-
-    body_sane, tmp = findCurly(body_sane)
-    delim.update(tmp)
-
-    body_sane, tmp = findDollar(body_sane)
-    delim.update(tmp)
-
-    body_sane, tmp = findNewline(body_sane)
-    delim.update(tmp)
-
-    body_sane, tmp = findMacros(body_sane)
-    delim.update(tmp)
-
-    # Sanity check: all spans must increase monotonically.
-    keys = list(delim.keys())
-    keys.sort()
-    for idx in range(len(keys) - 1):
-        d0 = delim[keys[idx]]
-        d1 = delim[keys[idx + 1]]
-        assert d0.span[1] <= d1.span[0]
-
     # ------------------------------------------------------------------------
-    # Add text delimiters. These span from the stop of the previous delimiter
-    # to the start of the next.
+    # Build the scanner. The alternatives are tried in this order at every
+    # position, and the first one that matches consumes its characters:
+    #
+    #  * comments: from '%' up to, and including, the next newline. A '%' in
+    #    the last line is no comment because it has no terminating newline.
+    #  * escaped special characters: '\%', '\{', '\}' and '\$'.
+    #  * \begin{name} and \end{name} on a single line. The name must not
+    #    contain the start of a comment, and the name of an \end must not
+    #    contain another \begin{ (which would take precedence).
+    #  * LaTeX newline '\\', unless its second backslash escapes the next
+    #    character or starts a \begin{} or \end{}.
+    #  * macros, ie. a backslash followed by letters or '*'.
+    #  * the '$' and '$$' delimiters, and curly braces.
+    #
+    # Everything else (including a backslash followed by none of the above)
+    # is plain text.
     # ------------------------------------------------------------------------
+    name_begin = r'(?:\\%|[^\n%}]|%(?![^\n]*\n))*'
+    name_end = r'(?:\\%|\\(?!begin\{)|[^\n%}\\]|%(?![^\n]*\n))*'
+    pat = re.compile(
+        r'(?=[%\\${}])(?:'
+        r'(?P<comment>%[^\n]*\n)'
+        r'|(?P<escape>\\[%{}$])'
+        r'|(?P<begin>\\begin\{(?P<bname>' + name_begin + r')\})'
+        r'|(?P<end>\\end\{(?P<ename>' + name_end + r')\})'
+        r'|(?P<newline>\\\\(?![%{}$]|begin\{' + name_begin + r'\}'
+        r'|end\{' + name_end + r'\}))'
+        r'|(?P<macro>\\[a-zA-Z*]+)'
+        r'|(?P<dollar>\${1,2})'
+        r'|(?P<curly>[{}]))'
+    )
+
+    # The output list and the end of the last delimiter in it.
     out = []
+    append = out.append
     start = 0
-    for key in sorted(delim):
-        # Find the span from the end of the last delimiter to the start of the
-        # current one.
-        d = delim[key]
-        stop = d.span[0]
-
-        # Sanity check.
-        assert start <= stop
-
-        # If start < stop, but not start == stop, then the span has non-zero
-        # length and thus requires a start/stop delimiter for the text in
-        # between.
-        if start < stop:
-            out.append(Delim((start, start), True, 'text', None))
-            out.append(Delim((stop, stop), False, 'text', None))
-
-        # Add the original delimiter and set the new start position to the end
-        # of the current delimiter.
-        out.append(d)
-        start = d.span[1]
-        del d, stop
+
+    # Inside a '$' or '$$' environment only comments, environments and curly
+    # braces produce delimiters. While the scanner is inside such an
+    # environment ``dollar`` holds the opening delimiter, as well as the
+    # length of ``out`` and the value of ``start`` before it was added.
+    dollar = None
+    use_dollar = True
+    pos = 0
+    while True:
+        for m in pat.finditer(body, pos):
+            kind = m.lastgroup
+            if kind == 'escape':
+                continue
+            m_start, m_stop = m.span()
+
+            if kind == 'macro':
+                # Macros inside '$' and '$$' environments are not delimiters.
+                if dollar is not None:
+                    continue
+                d = Delim((m_start, m_stop), None, 'macro', m.group()[1:])
+            elif kind == 'curly':
+                if m.group() == '{':
+                    d = Delim((m_start, m_stop), True, '{', None)
+                else:
+                    d = Delim((m_start, m_stop), False, '}', None)
+            elif kind == 'dollar':
+                ch = m.group()
+                if dollar is not None:
+                    # The closing delimiter must match the opening one.
+                    assert ch == dollar[0].type
+                    d = Delim((m_start, m_stop), False, ch, None)
+                    dollar = None
+                elif use_dollar:
+                    d = Delim((m_start, m_stop), True, ch, None)
+                    dollar = (d, len(out), start)
+                else:
+                    continue
+            elif kind == 'newline':
+                if dollar is not None:
+                    continue
+                d = Delim((m_start, m_stop), None, 'macro', '\\')
+            elif kind == 'comment':
+                # Add the opening delimiter here, and let the code below add
+                # the closing one (ie. the newline character).
+                if start < m_start:
+                    append(Delim((start, start), True, 'text', None))
+                    append(Delim((m_start, m_start), False, 'text', None))
+                append(Delim((m_start, m_start + 1), True, '%', None))
+                start = m_start + 1
+                m_start = m_stop - 1
+                d = Delim((m_start, m_stop), False, '%', None)
+            elif kind == 'begin':
+                name = m.group('bname').replace('\\%', '  ')
+                d = Delim((m_start, m_stop), True, 'env', name)
+            else:
+                name = m.group('ename').replace('\\%', '  ')
+                d = Delim((m_start, m_stop), False, 'env', name)
+
+            # Add a text delimiter for the gap between the previous delimiter
+            # and the current one, followed by the current one.
+            if start < m_start:
+                append(Delim((start, start), True, 'text', None))
+                append(Delim((m_start, m_start), False, 'text', None))
+            append(d)
+            start = m_stop
+
+        # Done, unless the last '$' or '$$' environment was never closed. In
+        # that case discard everything since its opening delimiter and scan
+        # that part again without any '$' delimiters. An unmatched '$$' is
+        # an empty '$' environment.
+        if dollar is None:
+            break
+        d, num_out, start = dollar
+        del out[num_out:]
+        pos = d.span[0] + 1
+        if d.type == '$$':
+            if start < d.span[0]:
+                out.append(Delim((start, start), True, 'text', None))
+                out.append(Delim((d.span[0], d.span[0]), False, 'text', None))
+            out.append(Delim((d.span[0], pos), True, '$', None))
+            out.append(Delim((pos, d.span[1]), False, '$', None))
+            start = pos = d.span[1]
+        dollar = None
+        use_dollar = False
+        del d, num_out
 
     # Manually insert the text beyond the last delimiter.
     if start < len(body):
@@ -546,10 +674,6 @@ def findDelimiters(body):
         out.extend([d0, d1])
         del stop, d0, d1
 
-    # The very first span may be zero due to the algorithm above. Remove it.
-    if out[1].span == (0, 0):
-        out = out[2:]
-
     # Sanity check.
     for idx in range(len(out) - 1):
         s0 = out[idx].span
@@ -590,21 +714,6 @@ class TreeNode():
         assert isinstance(span, (tuple, list)) and (len(span) == 2)
         self.span = span
 
-        # Find the set of LaTeX counters closes to the span of this node.
-        counters = config.counter_values
-        for idx, cc in enumerate(counters):
-            if self.span[0] == cc.start:
-                self.counters = cc.counters
-                break
-            elif self.span[0] < cc.start:
-                if idx == 0:
-                    self.counters = counters[0].counters
-                else:
-                    self.counters = counters[idx - 1].counters
-                break
-            else:
-                pass
-
         # Contains the LaTeX code *without* the delimiter strings (eg. '{')
         self.body = None
 
@@ -624,6 +733,27 @@ class TreeNode():
         # LaTeX delimiters for the node type (eg. '{' '$', '$$', etc).
         self.updateNode()
 
+    @property
+    def counters(self):
+        """
+        Return the LaTeX counter values closest to the span of this node.
+
+        The values come from ``config.counter_values`` when a plugin asks for
+        them, ie. during the conversion of the tree, because Nobby builds the
+        tree while the document still compiles (see :func:`convertDocument`).
+
+        :return: {counter name: value}
+        :rtype: **dict**
+        """
+        counters = config.counter_values
+        if len(counters) == 0:
+            return {}
+
+        # The last counter dump at or before the node. Nodes before the first
+        # dump use the first one.
+        idx = bisect.bisect_right([_.start for _ in counters], self.span[0])
+        return counters[max(idx - 1, 0)].counters
+
     def reconstructBody(self, node=None):
         """
         Reconstruct and return the LaTeX code fragment including delimiters.
@@ -1122,6 +1252,33 @@ def runPlugin(func, node):
     return out
 
 
+def fragmentUsesCounters(tex):
+    """
+    Return **True** if the LaTeX counters may affect the appearance of ``tex``.
+
+    This is the case if ``tex`` contains a numbered environment (see
+    ``config.counter_dump_envs``), a sectioning macro (see
+    ``config.counter_dump_macros``), or any macro that displays or modifies
+    counter values (eg. '\\theequation' or '\\arabic', see
+    ``config.counter_macros``).
+
+    .. inline-python::
+
+        import nobby
+        print(nobby.fragmentUsesCounters(r'$x$'))
+        print(nobby.fragmentUsesCounters(r'\\begin{equation}x\\end{equation}'))
+
+    :param *str* tex: LaTeX code of fragment.
+    :rtype: **bool**
+    """
+    envs = '|'.join(config.counter_dump_envs)
+    macros = list(config.counter_dump_macros) + list(config.counter_macros)
+    macros.append('the(?:' + '|'.join(config.counter_names) + ')')
+    macros = '|'.join(macros)
+    pat = r'\\begin{(' + envs + r')}|\\(' + macros + r')(?![a-zA-Z*])'
+    return re.search(pat, tex) is not None
+
+
 def createFragmentDescriptor(child, frag_list):
     """
     Add fragment for ``child`` to ``frag_list`` and return HTML <img> tag.
@@ -1146,9 +1303,11 @@ def createFragmentDescriptor(child, frag_list):
     ph = config.ph_format.format(child.name, len(frag_list))
     cur_frag['placeholder'] = ph
 
-    # Create the HTML image tag, ie. something like <img=src="...">
+    # Create the HTML image tag, ie. something like <img=src="...">. The
+    # style of the image is unknown until Nobby has compiled the fragment.
+    # Until then, a dedicated placeholder takes its place.
     tag = config.tag_format
-    tag = tag.format(ph)
+    tag = tag.format(ph, ph + '-style')
 
     # In the HTML code, place the image in a new paragraph if its source code
     # constitutes an environment (ie. anything between a '\begin' '\end' block
@@ -1156,14 +1315,17 @@ def createFragmentDescriptor(child, frag_list):
     # equations in the HTML output.
     if child.type == 'env':
         tag = '<div align="center">' + tag + '</div><p>'
-        cur_frag['inline'] = False
-    else:
-        cur_frag['inline'] = True
+
+    # Environments and display math are not part of a line of text, which is
+    # why Nobby neither aligns them with the baseline nor measures them in a
+    # horizontal box (see fragmentPage), where '$$' is not even valid.
+    cur_frag['inline'] = child.type not in ('env', '$$')
 
     # Add the LaTeX code fragment to finalise the fragment, then add it to the
     # already existing ``frag_list``.
     cur_frag['tex'] = child.reconstructBody()
     cur_frag['span'] = child.span
+    cur_frag['node'] = child.name
 
     # Convenience.
     counters = config.counter_values
@@ -1189,6 +1351,12 @@ def createFragmentDescriptor(child, frag_list):
         else:
             cur_frag['counters'] = counters[-1].counters
 
+    # Drop the counters if they cannot affect the fragment. Identical
+    # fragments then also have identical descriptors and will share an image
+    # (see :func:`processFragments`).
+    if not fragmentUsesCounters(cur_frag['tex']):
+        cur_frag['counters'] = {}
+
     frag_list.append(cur_frag)
     return tag
 
@@ -1198,7 +1366,172 @@ def createFragmentDescriptor(child, frag_list):
 # ----------------------------------------------------------------------------
 
 
-def runPDFLaTeX(build_dir: str, fname_tex: str):
+def toolLimit(tool, num_processes=None):
+    """
+    Return the maximum number of concurrent runs of the program ``tool``.
+
+    This is the entry for ``tool`` in ``config.tool_limits``, but never more
+    than ``num_processes`` (default: ``config.num_processes``).
+
+    :param **str** tool: program name (eg. 'pdf2svg').
+    :param **int** num_processes: overall limit of concurrent processes.
+    :rtype: **int**
+    """
+    if num_processes is None:
+        num_processes = config.num_processes
+    limit = config.tool_limits.get(tool, num_processes)
+    return max(1, min(limit, num_processes))
+
+
+def maxProcesses():
+    """
+    Return the largest number of concurrent processes during this run.
+
+    This is ``config.max_processes`` in adaptive mode (see
+    :func:`adaptConcurrency`), and ``config.num_processes`` otherwise.
+
+    :rtype: **int**
+    """
+    if config.adaptive_concurrency:
+        return max(config.num_processes, config.max_processes)
+    return config.num_processes
+
+
+class ToolSlots():
+    """
+    Limit the number of concurrent runs of every external program.
+
+    Every program has :func:`toolLimit` slots for the current
+    ``num_processes``. Tasks that wait for the same program queue up in
+    order. Unlike `asyncio.Semaphore`, the limits can change while tasks
+    occupy or wait for slots (see :meth:`resize`).
+    """
+    def __init__(self, num_processes):
+        self.num_processes = num_processes
+
+        # Number of occupied slots, and the queue of waiting tasks (ie. their
+        # futures) for every program.
+        self.used = collections.Counter()
+        self.waiters = collections.defaultdict(collections.deque)
+
+    async def acquire(self, tool):
+        """
+        Wait for, and then occupy, a slot for ``tool``.
+        """
+        waiters = self.waiters[tool]
+        if len(waiters) == 0 and self.used[tool] < toolLimit(
+                tool, self.num_processes):
+            self.used[tool] += 1
+            return
+
+        # The slot is already occupied on behalf of this task once the future
+        # has a result (see wake). Return it if the task was cancelled in the
+        # meantime.
+        fut = asyncio.get_running_loop().create_future()
+        waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError as e:
+            if fut.done() and not fut.cancelled():
+                self.release(tool)
+            else:
+                waiters.remove(fut)
+            raise e
+
+    def release(self, tool):
+        """
+        Free a slot for ``tool`` and pass it on to the next waiting task.
+        """
+        self.used[tool] -= 1
+        self.wake(tool)
+
+    def resize(self, num_processes):
+        """
+        Change the overall limit of concurrent processes.
+
+        A lower limit only takes effect as tasks release their slots. A
+        higher limit immediately wakes up waiting tasks.
+        """
+        self.num_processes = num_processes
+        for tool in list(self.waiters):
+            self.wake(tool)
+
+    def wake(self, tool):
+        """
+        Hand free slots for ``tool`` to waiting tasks.
+        """
+        waiters = self.waiters[tool]
+        limit = toolLimit(tool, self.num_processes)
+        while len(waiters) > 0 and self.used[tool] < limit:
+            fut = waiters.popleft()
+            if not fut.done():
+                self.used[tool] += 1
+                fut.set_result(None)
+
+
+@contextlib.asynccontextmanager
+async def toolSlot(tool):
+    """
+    Wait for, and then occupy, a slot to run the program ``tool``.
+
+    The slots exist once per fragment pipeline (see :class:`ToolSlots` and
+    :func:`compileFragments`), or once for the entire document (see
+    :func:`convertDocument`). Outside a pipeline, ie. if ``tool_slots`` is
+    not set, there is no limit.
+
+    :param **str** tool: program name (eg. 'pdf2svg').
+    """
+    slots = tool_slots.get()
+    if slots is None:
+        yield
+        return
+    await slots.acquire(tool)
+    try:
+        yield
+    finally:
+        slots.release(tool)
+
+
+async def runTool(args, cwd=None, limit=True):
+    """
+    Run the external program ``args`` and return its standard output.
+
+    This is the asynchronous counterpart of `subprocess.check_output`. All
+    fragment tasks run their external programs with this function (see
+    :func:`runFragmentTasks`). The process is killed if the task that awaits
+    it is cancelled.
+
+    The program waits for a slot first (see :func:`toolSlot`), unless
+    ``limit`` is **False** because the caller already holds one.
+
+    :param **tuple** args: program name and its arguments.
+    :param **str** cwd: working directory of the program (optional).
+    :param **bool** limit: wait for a slot of the program.
+    :return: standard output of the program.
+    :rtype: **bytes**
+    :raises subprocess.CalledProcessError: if the program fails.
+    """
+    if limit:
+        async with toolSlot(args[0]):
+            return await runTool(args, cwd, False)
+
+    with profileTool(args[0], {'args': ' '.join(args)}):
+        proc = await asyncio.create_subprocess_exec(
+            *args, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        try:
+            out, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, out)
+    return out
+
+
+async def runPDFLaTeX(build_dir: str, fname_tex: str, fmt: str=None,
+                      backend: str='pdf', jobname: str=None):
     """
     Compile the file ``fname_tex`` with pdfLaTeX.
 
@@ -1206,14 +1539,25 @@ def runPDFLaTeX(build_dir: str, fname_tex: str):
     pdfLaTeX, including the final PDF file. This avoids clutter in the main
     directory.
 
-    This function changes to the directory with the LaTeX file to avoid
-    problems with relative file paths inside the LaTeX document. Afterwards, it
-    will change back to the original working directory.
+    pdfLaTeX runs in the directory of the LaTeX file to avoid problems with
+    relative file paths inside the LaTeX document. The working directory of
+    Nobby itself never changes, which is why several compilations can run
+    concurrently (see :func:`runFragmentTasks`). Use `asyncio.run` to call
+    this function outside an event loop.
+
+    If ``fmt`` is not **None** then pdfLaTeX starts from that format file
+    instead of the default LaTeX format (see :func:`buildPreambleFormat`).
+    If ``backend`` is 'dvi' then pdfLaTeX produces a DVI file instead of a
+    PDF file. If ``jobname`` is not **None** then all output files are named
+    after it instead of ``fname_tex``.
 
     :param *str* fname_tex: name of LaTeX file (eg. 'my_file.tex').
     :param *str* build_dir: pdfLaTeX will put its output there.
+    :param *str* fmt: format file name (optional).
+    :param *str* backend: 'pdf' (default) or 'dvi'.
+    :param *str* jobname: name of the output files (optional).
     :return: **namedtuple** with all auxiliary output files produced by LaTeX,
-      including 'aux', 'out', and 'log'.
+      including 'aux', 'out', 'log', and 'fls'.
     """
     # Return immediately if the source file cannot be read.
     if not os.path.exists(fname_tex):
@@ -1230,50 +1574,59 @@ def runPDFLaTeX(build_dir: str, fname_tex: str):
     # Get absolute path to build directory.
     build_dir = os.path.abspath(build_dir)
 
-    # Backup current working directory.
-    cur_path = os.getcwd()
-
-    # Switch to the directory with the LaTeX file to ensure pdflatex has the
+    # Run pdflatex in the directory with the LaTeX file to ensure it has the
     # correct relative paths specified in the document (eg. \includegraphics
     # directives).
     compile_path, compile_file = os.path.split(fname_tex)
     if compile_path == '':
         compile_path = './'
-    os.chdir(compile_path)
+
+    if jobname is None:
+        jobname = os.path.splitext(compile_file)[0]
 
     if config.verbose:
         print('Compiling <{}>'.format(fname_tex))
-    try:
-        if config.use_latexmk:
-            # Compile the LaTeX file.
-            args = ('latexmk', '-quiet', '-output-directory=' + build_dir,
-                    '-pdf', ('-pdflatex=pdflatex -halt-on-error '
-                             '-interaction=nonstopmode'), compile_file)
+    opts = () if fmt is None else ('-fmt=' + fmt,)
+    if backend == 'dvi':
+        opts += ('-output-format=dvi',)
+    if jobname == os.path.splitext(compile_file)[0]:
+        opt_job = ()
+    else:
+        opt_job = ('-jobname=' + jobname,)
+    if config.use_latexmk:
+        # Compile the LaTeX file.
+        opt_tex = ' '.join(('pdflatex -halt-on-error '
+                            '-interaction=nonstopmode',) + opts)
+        if backend == 'dvi':
+            opt_tex = ('-dvi', '-latex=' + opt_tex)
         else:
-            # Compile the LaTeX file.
-            args = ('pdflatex', '-halt-on-error', '-interaction=nonstopmode',
-                    '-output-directory=' + build_dir, compile_file)
+            opt_tex = ('-pdf', '-pdflatex=' + opt_tex)
+        args = ('latexmk', '-quiet', '-output-directory=' + build_dir)
+        args += opt_tex + opt_job + (compile_file,)
+        del opt_tex
+    else:
+        # Compile the LaTeX file.
+        args = ('pdflatex', '-halt-on-error', '-interaction=nonstopmode',
+                '-recorder', '-output-directory=' + build_dir) + opts
+        args += opt_job + (compile_file,)
 
+    # Keep the slot for all iterations to not queue up again in between.
+    async with toolSlot(args[0]):
         for ii in range(config.num_compile_iter):
-            subprocess.check_call(args, stdout=subprocess.DEVNULL,
-                                  stderr=subprocess.DEVNULL)
-    except Exception as e:
-        # Switch back to the original directory and propagate the error.
-        os.chdir(cur_path)
-        raise e
+            await runTool(args, compile_path, False)
 
     # ----------------------------------------------------------------------
     # Load all auxiliary output files produced by LaTeX and put their
     # content into a named tuple.
     # ----------------------------------------------------------------------
     # Load the source file.
-    aux_files = {'tex': open(compile_file, 'r').read()}
+    aux_files = {'tex': open(fname_tex, 'r').read()}
 
     # These files must exist.
     try:
         for name in ['log', 'aux', 'out']:
             # Build the file name and load it, if it exists.
-            fname = os.path.join(build_dir, compile_file[:-3] + name)
+            fname = os.path.join(build_dir, jobname + '.' + name)
             try:
                 aux_files[name] = open(fname, 'r').read()
             except UnicodeDecodeError as err:
@@ -1285,461 +1638,2164 @@ def runPDFLaTeX(build_dir: str, fname_tex: str):
         raise e
 
     # The .nobby file only exists if Nobby salted the LaTeX file with
-    # counter dumps.
-    try:
-        fname = os.path.join(build_dir, compile_file[:-3] + 'nobby')
-        aux_files['nobby'] = open(fname, 'r').read()
-    except FileNotFoundError:
-        aux_files['nobby'] = None
+    # counter dumps. The .fls file lists all files LaTeX has read (see
+    # the '-recorder' option).
+    for name in ['nobby', 'fls']:
+        try:
+            fname = os.path.join(build_dir, jobname + '.' + name)
+            aux_files[name] = open(fname, 'r').read()
+        except (FileNotFoundError, UnicodeDecodeError):
+            aux_files[name] = None
 
     # Convert the dictionary to a named tuple and return the result.
-    TexOut = collections.namedtuple('TexOut', 'tex log aux out nobby')
     val = [aux_files[_] for _ in TexOut._fields]
-    tex_out = TexOut(*val)
+    return TexOut(*val)
 
-    # Switch back to the original directory, then return the auxiliary files.
-    os.chdir(cur_path)
-    return tex_out
 
-
-def getCropBox(fname):
-    """
-    Return the crop box size of the ``fname`` PDF as returned by `pdfinfo`.
-
-    Example:
-
-    .. inline-python::
-
-        import pprint, nobby
-        crop_box = nobby.getCropBox('source/code_snippets/demo.pdf')
-        pprint.pprint(crop_box)
-
-    :param **str** fname: name of PDF.
-    :return: `[left, top, right and bottom]`
-    :rtype: [**float**, **float**, **float**, **float**]
+def computeCropBox(img, inline):
     """
-    # Run pdfinfo on ``fname``.
-    try:
-        out = subprocess.check_output(('pdfinfo', '-box', fname))
-    except subprocess.CalledProcessError as e:
-        # Process returned with non-zero exit code: dump its output.
-        msg = 'Command <{}> returned with error code: {}\n'
-        msg = msg.format(e.cmd, e.returncode)
-        print(msg)
-        print('-' * 70)
-        print(e.output.decode('utf8').strip())
-        print('-' * 70)
-        return None
-    except FileNotFoundError as e:
-        # Program not found.
-        print(e)
-        return None
+    Return the crop box of the rendered fragment ``img`` in pixels.
 
-    # Decode output and ensure it contains 'CropBox'.
-    out = out.decode('utf8')
-    assert 'CropBox' in out
+    The ``img`` is a grey scale NumPy array with values between 0 (black) and
+    1 (white). The crop box encloses all pixels that are not white.
 
-    # Search for the line that starts with 'CropBox' and extract the values.
-    for line in out.splitlines():
-        if 'CropBox' in line:
-            break
+    For ``inline`` fragments, this function assumes ``img`` does indeed
+    feature the \\\\rule block to the left (see :func:`fragmentPage`). It
+    removes that block, and then extends the crop box at the top or bottom
+    until the block would sit precisely in the vertical middle. This
+    vertically aligns the image with the surrounding text.
 
-    # Split the line. This will result in plenty of empty list entries because
-    # there are many blank spaces in that line. Remove those entries.
-    line = line.strip()
-    line = [_ for _ in line.split() if _ != '']
+    The crop box is a tuple of four floats (left, top, right, bottom) where
+    (0, 0) denotes the top left corner of ``img``. Return **None** if
+    ``img`` contains no visible content, or if an inline fragment contains
+    nothing but the block.
 
-    # Drop the first because it is the 'CropBox' string.
-    line = line[1:]
+    Example:
 
-    # Convert the other entries to floats and return the result.
-    box = [float(_) for _ in line]
-    assert len(box) == 4
-    return box
+    .. inline-python::
 
+        import numpy as np, nobby
+        img = np.ones((20, 30))
+        img[8:12, 2:5] = 0
+        img[5:15, 10:20] = 0
+        print(nobby.computeCropBox(img, True))
 
-def computeMargins(fname_img, cropBox):
+    :param **ndarray** img: grey scale image of the fragment.
+    :param **bool** inline: whether the fragment is inline.
+    :return: crop box (eg. (7.0, 5.0, 20.0, 15.0))
+    :rtype: (**float**, **float**, **float**, **float**)
     """
-    Return the PDF margins that would vertically center the \\\\rule block.
-
-    This function assumes the image in ``fname`` does indeed feature a
-    \\\\rule block to the left. If not, the result is unspecified.
-
-    The ``cropBox`` is a list of four floats that denote the PDF dimensions in
-    `big point` (bp). The values mean [left, top, right, bottom] and usually
-    comes from :func:`getCropBox`.
-
-    The return value is a Python string of four floats, unlike `cropBox``,
-    which is a Python list of four floats. It does not denote absolute length
-    etc, like the ``cropBox`` input, but rather the margin amount to add/remove
-    on the respective side, in this order: [left, top, right, bottom]. This
-    string can be passed directly to the `-margin` parameter of `pdfcrop`.
+    import numpy as np
 
-    :param **str** fname: name of image file.
-    :param **list** cropBox: dimensions of PDF (eg. [0.0, 0.0, 87.11, 13.41])
-    :return: Margins (eg. '[1.0 2.0, 3.0, 4.0]')
-    :rtype: **str**
-    """
-    # Load the image.
-    img = np.array(Image.open(fname_img).convert('L'), np.float32) / 255
+    # Find the rows and columns that contain anything but white pixels.
+    ink = img < 0.95
+    rows = np.nonzero(ink.any(axis=1))[0]
+    cols = np.nonzero(ink.any(axis=0))[0]
+    if len(rows) == 0:
+        return None
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    del ink, rows, cols
 
-    # For convenience.
-    img_height, img_width = img.shape
-    cb_width, cb_height = cropBox[2:4]
+    # No special treatment is necessary for images that will go into a
+    # dedicated paragraph.
+    if not inline:
+        return (float(left), float(top), float(right), float(bottom))
 
-    # Find all (almost) black pixels. Then create a new matrix and set all
-    # elements corresponding to a black pixel to 1.
-    idx = np.nonzero(img < 0.1)
-    img = np.zeros_like(img)
-    img[idx] = 1
-    del idx
+    # Find all (almost) black pixels in the cropped image.
+    img = img[top:bottom, left:right] < 0.1
+    img_height = bottom - top
 
     # Determine the width of the block. To do so, look for the first white
     # column, because Nobby will have inserted a white space after the block,
     # so there are *should* be several such. However, some fragments may well
     # be empty (eg. '\label{}' commands produce no visible text) so that no
     # white space remains. In that case, ...
-    blk_width = -1
-    for col in range(img_width):
-        if sum(img[:, col]) == 0:
-            blk_width = col
-            break
-    del col
-
-    if blk_width == -1:
+    white = np.nonzero(~img.any(axis=0))[0]
+    if len(white) == 0:
         return None
 
     # Double the width because the image contained a second rule of the same
     # width but zero height to ensure there is a proper space between the block
     # and the first character.
-    blk_width = np.floor(1.95 * blk_width)
+    blk_width = np.floor(1.95 * white[0])
+    del white
 
     # Determine vertical block boundaries. Once again, slice the block
     # vertically at half its width (determined just above), and look for the
     # index of the first/last black pixel in that column. The final values are
     # the distances from the top/bottom of the image.
-    tmp = img[:, int(blk_width / 2)]
-    idx = np.nonzero(tmp)[0]
+    idx = np.nonzero(img[:, int(blk_width / 2)])[0]
     gap_top, gap_bottom = idx[0], img_height - 1 - idx[-1]
-    del tmp, idx
+    del idx
 
-    # Determine how many rows at either the top or bottom of the image are
-    # necessary to vertically center the block. Then convert this number of
-    # matrix/image rows into a PDF margin based on the crop box height.
-    num_rows = abs(gap_top - gap_bottom)
-    delta_margin = num_rows * cb_height / img_height
+    # Add as many rows at either the top or bottom of the image as are
+    # necessary to vertically center the block.
     if gap_top > gap_bottom:
-        bottom, top = delta_margin, 0
-    elif gap_top < gap_bottom:
-        bottom, top = 0, delta_margin
+        bottom += gap_top - gap_bottom
     else:
-        top = bottom = 0
+        top -= gap_bottom - gap_top
 
-    # Compute the amount of PDF margin that corresponds to the block width.
-    left = -blk_width * cb_width / img_width
+    # Remove the block.
+    left += blk_width
+    return (float(left), float(top), float(right), float(bottom))
 
-    # This empirical hack may better align the SVG images with the base line of
-    # the surrounding text.
-    top += 1
 
-    # Convert the four margins to a single string with four floats.
-    out = ['{0:.2f}'.format(_) for _ in (left, top, 0, bottom)]
-    return ' '.join(out)
+def cropSVG(svg, box, scale=1):
+    """
+    Return ``svg`` with a view box that only shows the area inside ``box``.
 
+    The ``box`` is a tuple of four floats that denote the (left, top, right,
+    bottom) boundaries in points. This function only replaces the `width`,
+    `height` and `viewBox` attributes of the root element, which is why the
+    SVG file retains all elements outside the ``box`` (they are merely
+    invisible). The `width` and `height` are ``scale`` times the size of
+    ``box``.
 
-def compileFragmentToImage(arg_tuple):
-    """
-    Convert ``frag`` into an SVG image and save it in ``target_dir``.
+    Example:
 
-    To produce the SVG image, this function will first create a standalone
-    LaTeX file based on the ``preamble`` and ``frag['tex']``, compile it into
-    an auxiliary PDF file in the ``build_dir`` directory, and then convert it
-    with `pdf2svg <http://www.cityinthesky.co.uk/opensource/pdf2svg/>`_
+    .. inline-python::
 
-    The ``base_dir`` is the directory of the original LaTeX file. Knowing this
-    directory is necessary because the fragment may include references to other
-    files (eg. images) that are relative to that directory.
+        import nobby
+        svg = '<svg width="100pt" height="50pt" viewBox="0 0 100 50">'
+        print(nobby.cropSVG(svg, (10, 5, 30, 15)))
 
-    The name of the final SVG depends on frag['placeholder'].
+    :param **str** svg: SVG code (eg. from `pdf2svg`).
+    :param **tuple** box: crop box in points.
+    :param **float** scale: scale factor for the image size.
+    :return: cropped SVG code.
+    :rtype: **str**
+    """
+    left, top, right, bottom = box
+    attr = {'width': '{0:.2f}pt'.format(scale * (right - left)),
+            'height': '{0:.2f}pt'.format(scale * (bottom - top)),
+            'viewBox': '{0:.2f} {1:.2f} {2:.2f} {3:.2f}'.format(
+                left, top, right - left, bottom - top)}
+
+    # Find the root element and replace its attributes.
+    m = re.search(r'<svg\b[^>]*>', svg)
+    assert m is not None
+    root = m.group()
+    for key, value in attr.items():
+        root, num = re.subn(r'\b{}="[^"]*"'.format(key),
+                            '{}="{}"'.format(key, value), root)
+        assert num == 1
+    return svg[:m.start()] + root + svg[m.end():]
+
+
+def referencedFiles(tex, d_base):
+    """
+    Return the files that ``tex`` reads, along with their state.
 
-    The conversion to SVG suffers from cropping too much of the PDF image.
-    While this removes all unnecessary white space, it also causes vertical
-    alignment problems when the image is inserted in the HTML document. For
-    instance, the cropped images for 'I' and 'y' have similar height, yet 'y'
-    reaches lower than 'I'.
+    These are the arguments of all macros in ``config.input_macros`` (eg.
+    '\\includegraphics{plot}'). Nobby resolves them relative to ``d_base``
+    with the extensions in ``config.input_extensions``, like LaTeX would. The
+    state is the (mtime, size) of the file, or **None** if ``d_base`` does not
+    contain it (eg. for '\\usepackage{amsmath}'). Only the names of missing
+    files are relative, which is why a ``tex`` that reads no local files
+    produces the same list in every directory.
 
-    To circumvent this problem a \\\\rule{1ex}{1ex} (ie a black box the size of
-    an 'x' in the current font) precedes all fragments. This rule serves as a
-    reference point to compute the PDF margins such that it sits precisely in
-    the middle. For a good overview of the alignment options in HTML see
-    `<http://www.maxdesign.com.au/articles/vertical-align/>`_.
+    .. inline-python::
 
-    To compute the margin, the PDF is (temporarily) converted to a PDF and
-    analyses as a NumPy array. The black box is easy to identify there, as is
-    the computation of the required margin. The margin is extra space (not
-    cropped space) at either the top or bottom such that the box is vertically
-    centred. A similar process yields the width of the box, and the
-    corresponding margin is removed from the image as well.
+        import nobby
+        print(nobby.referencedFiles(r'\\input{foo} \\usepackage{a,b}', '.'))
 
-    This elaborate process requires these external tools:
+    :param *str* tex: LaTeX code.
+    :param *str* d_base: directory of the LaTeX file.
+    :return: sorted list of (file name, state) tuples.
+    :rtype: **list**
+    """
+    macros = '|'.join(config.input_macros)
+    pat = (r'\\(?:' + macros + r')\*?\s*(?:\[[^\]]*\]\s*)*{([^{}]*)}'
+           r'|\\input\s+([^\s{}\\%]+)')
+    out = set()
+    for m in re.finditer(pat, tex):
+        for name in (m.group(1) or m.group(2)).split(','):
+            name = name.strip()
+            if name == '':
+                continue
+            state = None
+            for ext in config.input_extensions:
+                fname = os.path.abspath(os.path.join(d_base, name + ext))
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                if os.path.isfile(fname):
+                    name, state = fname, (st.st_mtime_ns, st.st_size)
+                    break
+            out.add((name, state))
+    return sorted(out, key=repr)
+
+
+def fragmentHash(preamble, frag, d_base):
+    """
+    Return a hash of everything that determines the image of ``frag``.
+
+    The hash covers the ``preamble``, the LaTeX code of the fragment, its
+    counter values, and all configuration options that affect the image
+    (eg. ``config.pdf_scale``). Two fragments with the same hash therefore
+    produce the same image, irrespective of their position in the document.
+
+    Fragments compile in the directory of their document, which is why the
+    hash also covers the absolute ``d_base``, and the state of all files that
+    the preamble and the fragment read (see :func:`referencedFiles`). The
+    image of '\\includegraphics{plot}' thus changes with the 'plot.pdf' in
+    the directory of the document.
+
+    :param *str* preamble: LaTeX preamble.
+    :param *dict* frag: fragment data (see :func:`createFragmentDescriptor`).
+    :param *str* d_base: directory of the LaTeX file.
+    :return: hash as a hex string.
+    :rtype: **str**
+    """
+    counters = sorted(frag['counters'].items())
+    inputs = referencedFiles(preamble, d_base)
+    inputs += referencedFiles(frag['tex'], d_base)
+    data = ('nobby-fragment-5', preamble, frag['tex'], frag['inline'],
+            counters, os.path.abspath(d_base), inputs, config.pdf_scale,
+            config.textwidth_addon, config.max_svg_size,
+            config.alt_image_format, config.raster_dpi, config.measure_inline,
+            config.fragment_padding, config.backend)
+    return hashlib.sha256(repr(data).encode('utf8')).hexdigest()
+
+
+def findCachedFragment(frag_hash):
+    """
+    Return the file name of the cached image for ``frag_hash``.
 
-    * `pdf2svg <http://www.cityinthesky.co.uk/opensource/pdf2svg/>`_
-    * pdfinfo
-    * `pdfcrop
-      <http://manpages.ubuntu.com/manpages/gutsy/man1/pdfcrop.1.html>`_
+    Return **None** if the fragment cache is disabled, or does not contain
+    an image for ``frag_hash``. The modification time of the cached image is
+    updated to mark it as recently used (see :func:`pruneFragmentCache`).
 
-    For compatibility with Python's process pools, this function takes only a
-    single tuple argument, which it then expands to the actual arguments.
+    :param *str* frag_hash: fragment hash (see :func:`fragmentHash`).
+    :return: file name of cached image, or **None**.
+    :rtype: **str**
+    """
+    if config.cache_dir is None:
+        return None
 
-    :param **str** base_dir: directory of the source file.
-    :param **str** build_dir: temporary directory to use for PDF creation.
-    :param **str** target_dir: output directory of SVG file.
-    :param **str** preamble: LaTeX preamble.
-    :param **dict** frag: fragment data (typically from
-        :func:`replaceFragments`)
+    fname = os.path.join(config.cache_dir, frag_hash[:2], frag_hash)
+    for ext in ('.svg', '.' + config.alt_image_format):
+        try:
+            os.utime(fname + ext)
+            return fname + ext
+        except FileNotFoundError:
+            pass
+    return None
+
+
+def findCachedMetrics(frag_hash):
     """
-    # Expand the arguments.
-    base_dir, build_dir, target_dir, preamble, frag = arg_tuple
+    Return the image metrics that were cached alongside ``frag_hash``.
 
-    # Convenience.
-    tex, frag_name = frag['tex'], frag['placeholder']
+    Return **None** if the fragment cache is disabled, or if the image has
+    no metrics (see :func:`convertFragmentPDF`).
 
-    # Create the document preamble. It consists of the original preamble plus
-    # some special options that Nobby requires.
-    tmp_tw = '\\addtolength{{\\textwidth}}{{{0:0.2f}cm}}'
-    tmp_tw = tmp_tw.format(config.textwidth_addon)
-    preamble += ('\n'
-                 '\\pagestyle{empty}\n'
-                 '\\addtolength{\\paperwidth}{20cm}\n'
-                 '\\addtolength{\\paperheight}{20cm}\n'
-                 + tmp_tw
-                 )
-    for key, value in frag['counters'].items():
-        preamble += '\\setcounter{{{}}}{{{}}}\n'.format(key, value)
-    del tmp_tw
+    :param *str* frag_hash: fragment hash (see :func:`fragmentHash`).
+    :return: (width, height, depth) in points, or **None**.
+    :rtype: (**float**, **float**, **float**)
+    """
+    if config.cache_dir is None:
+        return None
 
-    # Ensure the target- directory exists.
+    fname = os.path.join(config.cache_dir, frag_hash[:2], frag_hash + '.box')
     try:
-        os.mkdir(target_dir)
-    except FileExistsError:
-        pass
+        metrics = tuple(float(_) for _ in open(fname, 'r').read().split())
+    except (FileNotFoundError, ValueError):
+        return None
+    os.utime(fname)
+    return metrics if len(metrics) == 3 else None
 
-    # Name of fragment file (must be in same directory as the original source
-    # code to ensure image include tags access the correct files).
-    fname_tex = os.path.join(base_dir, frag_name + '.tex')
 
-    # Name for SVG- and alternative image name.
-    fname_svg = os.path.join(target_dir, frag_name + '.svg')
-    fname_alt = os.path.join(target_dir, frag_name + '.' +
-                             config.alt_image_format)
+def storeCachedFragment(frag_hash, fname_img, metrics=None):
+    """
+    Add the image ``fname_img`` and its ``metrics`` to the fragment cache.
 
-    # Do not compile already existing fragments.
-    if config.skip_existing_fragments:
-        if os.path.exists(fname_svg) or os.path.exists(fname_alt):
-            return
+    The cache entry inherits the file extension of ``fname_img``. The
+    ``metrics`` go into a dedicated file with a '.box' extension. This
+    function does nothing if the fragment cache is disabled.
 
-    # Names of auxiliary files (all reside in a dedicated build directory).
-    # Note that the cropped file is always a PNG image, irrespective of the
-    # value `config.alt_image_format`. The reason is that PNG does not employ
-    # lossy image compression which blurs the artificially added \rule block in
-    # the process. This makes the identification of that block easier (see
-    # `computeMargins` function).
-    tmp = os.path.join(build_dir, frag_name)
-    fname_pdf = tmp + '.pdf'
-    fname_crop = tmp + '_0_crop.pdf'
-    fname_crop_aux = tmp + '_2_crop.pdf'
-    fname_crop_png = fname_crop_aux[:-3] + 'png'
-    del tmp
+    :param *str* frag_hash: fragment hash (see :func:`fragmentHash`).
+    :param *str* fname_img: image file to cache.
+    :param *tuple* metrics: (width, height, depth) in points, or **None**.
+    :return: **None**
+    """
+    if config.cache_dir is None:
+        return
 
-    def closeTex(data, scale):
-        """
-        Convenience function.
-        """
-        out = '\\begin{document}\n'
-        out += '\pdfsetmatrix {%f 0 0 %f}\n' % (scale, scale)
-        out += data + '\n\\end{document}'
-        return out
+    # Create the cache directory. Like Git, distribute the cache entries over
+    # sub-directories named after the first two characters of the hash.
+    dname = os.path.join(config.cache_dir, frag_hash[:2])
+    os.makedirs(dname, exist_ok=True)
 
-    def removeStaleFiles():
-        # Remove the temporary LaTeX file.
-        try:
-            os.remove(fname_tex)
-        except FileNotFoundError:
-            pass
+    # Copy the image into a temporary file first and then rename it. This
+    # ensures that concurrent Nobby processes never see incomplete images.
+    ext = os.path.splitext(fname_img)[1]
+    fname = os.path.join(dname, frag_hash + ext)
+    fname_tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    shutil.copyfile(fname_img, fname_tmp)
+    os.replace(fname_tmp, fname)
 
-    # Convenience.
-    check_output = subprocess.check_output
+    # Store the metrics the same way.
+    if metrics is not None:
+        fname = os.path.join(dname, frag_hash + '.box')
+        fname_tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        open(fname_tmp, 'w').write(' '.join(repr(_) for _ in metrics))
+        os.replace(fname_tmp, fname)
 
-    try:
-        # Turn the fragment into a PDF.
-        if frag['inline'] is True:
-            # -----------------------------------------------------------------
-            # A \rule the size of an 'x' precedes every fragment and will be
-            # used as a reference to crop the PDF image such as to vertically
-            # center it.
-            # -----------------------------------------------------------------
-
-            # This prefix contains a box that has exactly the height and width
-            # of an 'x' character in the current font set.
-            prefix = r'\rule{1ex}{1ex}\rule{1ex}{0ex}'
-
-            # Create the LaTeX code for `frag` and write it to a temporary
-            # file.
-            tex = preamble + '\n'
-            tex += closeTex(prefix + frag['tex'], config.pdf_scale)
-
-            # Write the LaTeX code into a temporary file and compile it.
-            open(fname_tex, 'w').write(tex)
-            runPDFLaTeX(build_dir, fname_tex)
-            del tex
-
-            # Crop the PDF as tightly as possible.
-            check_output(('pdfcrop', '--hires', fname_pdf, fname_crop_aux))
-
-            # Ask 'pdfinfo' for the PDF size.
-            cropBox = getCropBox(fname_crop_aux)
-            if cropBox is None:
-                return None
 
-            # Turn the PDF into a PNG and determine how much to crop/extend the
-            # margins to ensure the image is vertically centred.
-            check_output(('convert', fname_crop_aux, fname_crop_png))
-            marg = computeMargins(fname_crop_png, cropBox)
-            if marg is None:
-                open(fname_crop, 'w').write('')
-            else:
-                # Adjust the margins with pdfcrop.
-                check_output(('pdfcrop', '--hires', '--margin',
-                             marg, fname_crop_aux,  fname_crop))
-            del cropBox, marg, prefix, fname_crop_png
-        else:
-            # -----------------------------------------------------------------
-            # No special treatment is necessary for images that will go into a
-            # dedicated paragraph.
-            # -----------------------------------------------------------------
-            tex = preamble + '\n' + closeTex(frag['tex'], config.pdf_scale)
-            open(fname_tex, 'w').write(tex)
-            runPDFLaTeX(build_dir, fname_tex)
-            check_output(('pdfcrop', '--hires', fname_pdf, fname_crop))
-            del tex
-
-        # Convert PDF to SVG.
-        if os.stat(fname_crop).st_size == 0:
-            open(fname_svg, 'w').write(config.empty_svg)
-        else:
-            subprocess.check_output(('pdf2svg', fname_crop, fname_svg))
-
-        # Replace the SVG file with the alternative image format if it exceeds
-        # the max_svg_size threshold. However, only replace it if the
-        # alternative image is indeed smaller.
-        if os.stat(fname_svg).st_size > config.max_svg_size:
-            subprocess.check_output(('convert', '-density', '120',
-                                     fname_crop, fname_alt))
-
-            # Only retain the alternative image if it is smaller than the SVG.
-            if os.stat(fname_svg).st_size > os.stat(fname_alt).st_size:
-                os.remove(fname_svg)
-            else:
-                os.remove(fname_alt)
-        removeStaleFiles()
-    except subprocess.CalledProcessError as e:
-        # Process returned with non-zero exit code: dump the error message and
-        # the complete process output.
-        removeStaleFiles()
-        msg = 'Command <{}> returned with error code: {}\n'
-        msg = msg.format(e.cmd, e.returncode)
-        print(msg)
-        print('-' * 70)
-        msg = 'Problematic Source code'
-        print(' ' * (35 - len(msg) // 2), msg)
-        print('-' * 70)
-        if config.errtex_showfull:
-            print(open(fname_tex, 'r').read())
-        else:
-            print(frag['tex'])
-        print('-' * 70)
-        raise e
-    except FileNotFoundError as e:
-        removeStaleFiles()
-        raise e
-    except AssertionError as e:
-        removeStaleFiles()
-        print('-' * 70)
-        msg = 'Problematic Source code'
-        print(' ' * (35 - len(msg) // 2), msg)
-        print('-' * 70)
-        if config.errtex_showfull:
-            print(open(fname_tex, 'r').read())
-        else:
-            print(frag['tex'])
-        print('-' * 70)
-        raise e
-    except (KeyboardInterrupt, SystemExit):
-        removeStaleFiles()
+def fragmentTimingKey(frag):
+    """
+    Return the key under which the compile time of ``frag`` is recorded.
 
+    Unlike :func:`fragmentHash`, the key only covers the LaTeX code of the
+    fragment and the backend. The recorded times therefore survive changes to
+    the preamble, which invalidate all cached images at once and are exactly
+    the runs where the schedule matters most.
 
-def processFragments(preamble, html, fragments, path):
+    :param *dict* frag: fragment data (see :func:`createFragmentDescriptor`).
+    :return: key as a hex string.
+    :rtype: **str**
+    """
+    data = ('nobby-timing-1', frag['tex'], frag['inline'], config.backend)
+    return hashlib.sha256(repr(data).encode('utf8')).hexdigest()
+
+
+def findCachedTiming(frag):
+    """
+    Return the recorded compile time of ``frag`` in seconds.
+
+    Return **None** if the fragment cache is disabled, or if Nobby has never
+    compiled the fragment before (see :func:`storeCachedTiming`).
+
+    :param *dict* frag: fragment data (see :func:`createFragmentDescriptor`).
+    :return: time of its programs in seconds, or **None**.
+    :rtype: **float**
+    """
+    if config.cache_dir is None:
+        return None
+
+    key = fragmentTimingKey(frag)
+    fname = os.path.join(config.cache_dir, key[:2], key + '.time')
+    try:
+        seconds = float(open(fname, 'r').read())
+    except (FileNotFoundError, ValueError):
+        return None
+    os.utime(fname)
+    return seconds
+
+
+def storeCachedTiming(frag, seconds):
+    """
+    Record that ``frag`` took ``seconds`` to compile and convert.
+
+    The time goes into the fragment cache, in a file with a '.time'
+    extension (see :func:`fragmentTimingKey`). This function does nothing if
+    the fragment cache is disabled.
+
+    :param *dict* frag: fragment data (see :func:`createFragmentDescriptor`).
+    :param *float* seconds: time of its programs in seconds.
+    :return: **None**
+    """
+    if config.cache_dir is None:
+        return
+
+    key = fragmentTimingKey(frag)
+    dname = os.path.join(config.cache_dir, key[:2])
+    os.makedirs(dname, exist_ok=True)
+    fname = os.path.join(dname, key + '.time')
+    fname_tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    open(fname_tmp, 'w').write(repr(seconds))
+    os.replace(fname_tmp, fname)
+
+
+def pruneFragmentCache():
+    """
+    Remove old images from the fragment cache.
+
+    First, remove all images that were not used for ``config.cache_max_age``
+    days. Then remove the least recently used images until the cache is
+    smaller than ``config.cache_max_size``.
+
+    An image and its metrics share the name of their hash and only ever leave
+    the cache together, ie. the entry as a whole counts as used when either
+    file was. The same applies to all other files that differ only in their
+    extension (eg. the cached counters of a document).
+
+    This function visits every file in the cache, which is why it does
+    nothing if it ran less than ``config.cache_prune_interval`` seconds ago.
+    The modification time of the 'pruned' file in the cache records the last
+    run.
+
+    :return: number of removed cache entries.
+    :rtype: **int**
+    """
+    if config.cache_dir is None or not os.path.exists(config.cache_dir):
+        return 0
+
+    fname_stamp = os.path.join(config.cache_dir, 'pruned')
+    try:
+        age = time.time() - os.stat(fname_stamp).st_mtime
+        if 0 <= age < config.cache_prune_interval:
+            return 0
+    except FileNotFoundError:
+        pass
+    open(fname_stamp, 'w').close()
+
+    # Compile the {name without extension: [mtime, size, fnames]} of all
+    # cache entries. The last use of an entry is that of its youngest file.
+    entries = {}
+    for dname, _, fnames in os.walk(config.cache_dir):
+        for fname in fnames:
+            fname = os.path.join(dname, fname)
+            if fname == fname_stamp:
+                continue
+            try:
+                st = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entry = entries.setdefault(os.path.splitext(fname)[0], [0, 0, []])
+            entry[0] = max(entry[0], st.st_mtime)
+            entry[1] += st.st_size
+            entry[2].append(fname)
+
+    # Sort the entries by their last use (oldest first) and remove them until
+    # the remaining ones are young enough and fit into the cache.
+    entries = sorted(entries.values())
+    t_min = time.time() - config.cache_max_age * 86400
+    size = sum(_[1] for _ in entries)
+    num_removed = 0
+    for mtime, esize, fnames in entries:
+        if mtime >= t_min and size <= config.cache_max_size:
+            break
+        for fname in fnames:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+        size -= esize
+        num_removed += 1
+    return num_removed
+
+
+def copyCachedFragment(target_dir, frag):
+    """
+    Copy the image of ``frag`` from the fragment cache into ``target_dir``.
+
+    This function first removes all images of ``frag`` from previous runs
+    because they may have been for a different fragment, or in a different
+    format. It then copies the cached image, unless the fragment cache is
+    disabled, does not contain the image, or the user requested a rebuild.
+
+    :param **str** target_dir: output directory of image file.
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: **True** if the image came from the cache.
+    :rtype: **bool**
+    """
+    fname = os.path.join(target_dir, frag['placeholder'])
+    for ext in ('.svg', '.' + config.alt_image_format):
+        try:
+            os.remove(fname + ext)
+        except FileNotFoundError:
+            pass
+
+    if not config.skip_existing_fragments:
+        return False
+    fname_cache = findCachedFragment(frag['hash'])
+    if fname_cache is None:
+        return False
+    shutil.copyfile(fname_cache, fname + os.path.splitext(fname_cache)[1])
+    return True
+
+
+def fragmentPreamble(preamble):
+    """
+    Return ``preamble`` plus the options that Nobby requires for fragments.
+
+    :param **str** preamble: LaTeX preamble.
+    :return: LaTeX preamble for fragment documents.
+    :rtype: **str**
+    """
+    tmp_tw = '\\addtolength{{\\textwidth}}{{{0:0.2f}cm}}'
+    tmp_tw = tmp_tw.format(config.textwidth_addon)
+    return (preamble + '\n'
+            '\\pagestyle{empty}\n'
+            '\\addtolength{\\paperwidth}{20cm}\n'
+            '\\addtolength{\\paperheight}{20cm}\n'
+            + tmp_tw + '\n')
+
+
+async def buildPreambleFormat(preamble, path):
+    """
+    Return the pdfLaTeX format file with the precompiled ``preamble``.
+
+    Loading a format is much faster than parsing the preamble, especially
+    for preambles with large packages like TikZ. This function therefore
+    dumps the fragment preamble (see :func:`fragmentPreamble`) into a format
+    once, and all fragment documents start from that format (see
+    :func:`fragmentDocument`).
+
+    The format file is named after a hash of the preamble, the files it
+    reads (see :func:`referencedFiles`), and the pdfLaTeX version. It resides in the fragment cache, or in the build directory if
+    the cache is disabled. Formats from previous runs are reused as long as
+    the preamble did not change. The dump occupies a `pdflatex` slot (see
+    :func:`toolSlot`), and can thus run while the original document compiles
+    (see :func:`convertDocument`).
+
+    Return **None** if ``config.use_preamble_format`` is **False**, or if the
+    preamble cannot be dumped into a format (eg. because a package opens
+    files). The fragments then compile from the full preamble as usual.
+
+    :param *str* preamble: LaTeX preamble.
+    :param *tuple* path: the usual set of path names.
+    :return: absolute file name of the format, or **None**.
+    :rtype: **str**
+    """
+    if not config.use_preamble_format:
+        return None
+
+    # Formats are specific to the TeX version.
+    try:
+        version = findTools(['pdflatex'])['pdflatex'][1]
+    except FileNotFoundError:
+        return None
+    inputs = referencedFiles(preamble, path.d_base)
+    preamble = fragmentPreamble(preamble)
+    data = ('nobby-format-2', preamble, inputs, version, config.backend)
+    fmt_hash = hashlib.sha256(repr(data).encode('utf8')).hexdigest()
+    del data, version
+
+    # Formats go into the cache (if it is enabled).
+    if config.cache_dir is None:
+        dname = os.path.abspath(path.d_build)
+    else:
+        dname = os.path.abspath(os.path.join(config.cache_dir, 'formats'))
+    os.makedirs(dname, exist_ok=True)
+    fname_fmt = os.path.join(dname, fmt_hash + '.fmt')
+
+    # Reuse the format from a previous run, and update its modification time
+    # to mark it as recently used (see :func:`pruneFragmentCache`).
+    if config.skip_existing_fragments:
+        try:
+            os.utime(fname_fmt)
+            return fname_fmt
+        except FileNotFoundError:
+            pass
+
+    # Dump the preamble. The LaTeX file must be in the same directory as the
+    # original source code in case the preamble includes other files. The
+    # job name contains the PID to ensure concurrent Nobby processes cannot
+    # overwrite each other's format while pdfLaTeX writes it.
+    job = '{}-{}'.format(fmt_hash, os.getpid())
+    fname_tex = os.path.join(path.d_base, job + '.tex')
+    open(fname_tex, 'w').write(preamble + '\n\\dump\n')
+    args = ('pdflatex', '-ini', '-interaction=nonstopmode', '-halt-on-error',
+            '-jobname=' + job, '-output-directory=' + dname)
+    if config.backend == 'dvi':
+        args += ('-output-format=dvi', '&latex')
+    else:
+        args += ('&pdflatex',)
+    args += (os.path.basename(fname_tex),)
+    try:
+        await runTool(args, path.d_base)
+        os.replace(os.path.join(dname, job + '.fmt'), fname_fmt)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        if config.verbose:
+            print('Cannot dump the preamble into a format - compile every '
+                  'fragment with the full preamble instead')
+        fname_fmt = None
+    finally:
+        os.remove(fname_tex)
+        try:
+            os.remove(os.path.join(dname, job + '.log'))
+        except FileNotFoundError:
+            pass
+    return fname_fmt
+
+
+def fragmentDocument(preamble, fmt, body):
+    """
+    Return a complete LaTeX document for the fragment pages in ``body``.
+
+    The document contains the full fragment preamble (see
+    :func:`fragmentPreamble`) unless it compiles from the format ``fmt`` (see
+    :func:`buildPreambleFormat`), which already contains it. The document
+    also opens the '.box' file for the fragment metrics (see
+    :func:`fragmentPage`).
+
+    :param **str** preamble: LaTeX preamble.
+    :param **str** fmt: format file name, or **None**.
+    :param **str** body: fragment pages (see :func:`fragmentPage`).
+    :return: LaTeX document.
+    :rtype: **str**
+    """
+    out = '' if fmt is not None else fragmentPreamble(preamble)
+    out += ('\\begin{document}\n'
+            '\\newwrite\\nobbybox\n'
+            '\\immediate\\openout\\nobbybox=\\jobname.box\\relax\n')
+    return out + body + '\\end{document}\n'
+
+
+def fragmentPage(frag):
+    """
+    Return the LaTeX code that puts ``frag`` on a page of its own.
+
+    The code sets the counters of the fragment inside a group. The group
+    confines local definitions to the page, but not LaTeX counters or
+    global definitions (eg. '\\gdef'), which therefore reach the fragments
+    on subsequent pages of the same document (see
+    :func:`compileFragmentBatch` and :class:`TeXWorker`). This is why every
+    page also resets all other counters in ``config.counter_names`` (if the
+    preamble defines them) to zero, ie. the value they have in a document of
+    their own. Global definitions still leak.
+
+    Measured fragments (see :func:`fragmentIsMeasured`) go into a box. When
+    TeX ships out the page it writes the placeholder, the width, height and
+    depth of that box, and the position of its reference point on the page
+    (all in sp) into the '.box' file (see :func:`readFragmentBoxes`). Nobby
+    uses these metrics to crop the image and align it with the surrounding
+    text (see :func:`convertFragmentPDF`). For the 'dvi' backend, the box
+    also becomes the bounding box of the page (see
+    :func:`convertFragmentDVI`).
+
+    Otherwise, the code scales the page by ``config.pdf_scale`` (only for the
+    'pdf' backend) and precedes inline fragments with the \\\\rule block
+    (see :func:`compileFragmentToImage`).
+
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: LaTeX code for the document body.
+    :rtype: **str**
+    """
+    out = '\\begingroup\n'
+    for key in sorted(set(config.counter_names) | set(frag['counters'])):
+        if key in frag['counters']:
+            out += '\\setcounter{{{}}}{{{}}}\n'.format(
+                key, frag['counters'][key])
+        else:
+            out += ('\\ifcsname c@{0}\\endcsname\\setcounter{{{0}}}{{0}}'
+                    '\\fi\n'.format(key))
+
+    if fragmentIsMeasured(frag):
+        # Expand the box metrics immediately, but the position only when TeX
+        # ships out the page (ie. after \pdfsavepos has recorded it).
+        out += '\\setbox0=\\hbox{' + frag['tex'] + '%\n}%\n'
+        out += ('\\edef\\nobbywrite{\\write\\nobbybox{' +
+                frag['placeholder'] + ' '
+                '\\number\\wd0 \\space\\number\\ht0 \\space'
+                '\\number\\dp0 \\space'
+                '\\noexpand\\number\\noexpand\\pdflastxpos\\space'
+                '\\noexpand\\number\\noexpand\\pdflastypos}}%\n')
+        out += '\\noindent\\pdfsavepos\\nobbywrite'
+
+        # Tell dvisvgm to use the box as the bounding box of the page.
+        if config.backend == 'dvi':
+            out += ('\\special{dvisvgm:bbox r \\the\\wd0 \\space\\the\\ht0 '
+                    '\\space\\the\\dp0}\\special{dvisvgm:bbox lock}')
+        out += '\\box0\n'
+        return out + '\\endgroup\n\\clearpage\n'
+
+    if config.backend == 'pdf':
+        out += '\\pdfsetmatrix {%f 0 0 %f}\n' % (config.pdf_scale,
+                                                 config.pdf_scale)
+
+    # This prefix contains a box that has exactly the height and width of an
+    # 'x' character in the current font set. Only the 'pdf' backend removes
+    # it again (see :func:`compileFragmentToImage`).
+    if frag['inline'] is True and config.backend == 'pdf':
+        out += r'\rule{1ex}{1ex}\rule{1ex}{0ex}'
+    out += frag['tex'] + '\n\\endgroup\n\\clearpage\n'
+    return out
+
+
+def fragmentIsMeasured(frag):
+    """
+    Return **True** if TeX measures the size and baseline of ``frag``.
+
+    This is the case for inline math (ie. '$' fragments) if
+    ``config.measure_inline`` is set, or if the backend is 'dvi' (which
+    cannot locate the \\\\rule block of :func:`compileFragmentToImage`).
+    Other inline fragments (eg. macros without a plugin) may need vertical
+    mode (eg. '\\\\maketitle' or '\\\\section'), which a horizontal box does
+    not provide.
+
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :rtype: **bool**
+    """
+    if frag['inline'] is not True or frag['name'] != '$':
+        return False
+    return config.measure_inline or config.backend == 'dvi'
+
+
+def readFragmentBoxes(fname):
+    """
+    Return the fragment metrics from the '.box' file ``fname``.
+
+    The return value maps the placeholder of every measured fragment (see
+    :func:`fragmentPage`) to a tuple with its width, height, depth, and the
+    x- and y position of its reference point. All values are in TeX points
+    (1/72.27 inch). The position is relative to the bottom left corner of the
+    page.
+
+    Example:
+
+    .. inline-python::
+
+        import nobby
+        open('/tmp/demo.box', 'w').write('dollar-000001 65536 131072 0 6553600 0')
+        print(nobby.readFragmentBoxes('/tmp/demo.box'))
+
+    :param **str** fname: name of '.box' file.
+    :return: {placeholder: (width, height, depth, x, y)}
+    :rtype: **dict**
+    """
+    try:
+        lines = open(fname, 'r').read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    out = {}
+    for line in lines:
+        line = line.split()
+        if len(line) != 6:
+            continue
+        out[line[0]] = tuple(int(_) / 65536 for _ in line[1:])
+    return out
+
+
+def printFragmentSource(frag, fname_tex):
+    """
+    Print the LaTeX code of ``frag`` that could not be converted.
+
+    Print the entire ``fname_tex`` file instead if ``config.errtex_showfull``
+    is set.
+    """
+    print('-' * 70)
+    msg = 'Problematic Source code'
+    print(' ' * (35 - len(msg) // 2), msg)
+    print('-' * 70)
+    if config.errtex_showfull and os.path.exists(fname_tex):
+        print(open(fname_tex, 'r').read())
+    else:
+        print(frag['tex'])
+    print('-' * 70)
+
+
+async def convertFragmentPDF(build_dir, target_dir, frag):
+    """
+    Convert the compiled PDF of ``frag`` into an image in ``target_dir``.
+
+    The PDF must be in ``build_dir`` and be named after frag['placeholder'].
+    It must contain nothing but the fragment on a single page (see
+    :func:`fragmentPage`).
+
+    If TeX measured the fragment (ie. frag['box'] contains the output of
+    :func:`readFragmentBoxes`) then this function converts the PDF with
+    `pdf2svg` and crops the SVG to the measured box, plus
+    ``config.fragment_padding``. It also scales the SVG by
+    ``config.pdf_scale``.
+
+    Otherwise, it renders the PDF with `pdftoppm` and determines the crop box
+    from that bitmap (see :func:`computeCropBox`). See
+    :func:`compileFragmentToImage` for the details of the alignment.
+
+    If the SVG is too large, the alternative image is simply the cropped
+    bitmap. The final image is also added to the fragment cache.
+
+    :param **str** build_dir: temporary directory to use for PDF creation.
+    :param **str** target_dir: output directory of SVG file.
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: (width, height, depth) of the image in points if TeX measured
+        the fragment, or **None**.
+    :rtype: (**float**, **float**, **float**)
+    """
+    # Convenience.
+    frag_name = frag['placeholder']
+
+    # Name for SVG- and alternative image name.
+    fname_svg = os.path.join(target_dir, frag_name + '.svg')
+    fname_alt = os.path.join(target_dir, frag_name + '.' +
+                             config.alt_image_format)
+
+    # Names of auxiliary files (all reside in a dedicated build directory).
+    # Note that the bitmap is always a PNG image, irrespective of the value
+    # `config.alt_image_format`. The reason is that PNG does not employ lossy
+    # image compression which blurs the artificially added \rule block in the
+    # process. This makes the identification of that block easier (see
+    # `computeCropBox` function).
+    tmp = os.path.join(build_dir, frag_name)
+    fname_pdf = tmp + '.pdf'
+    fname_png = tmp + '.png'
+
+    # Inline fragments were typeset without scaling if Nobby measured them
+    # (see fragmentPage). The SVG then scales them instead.
+    measured = fragmentIsMeasured(frag)
+    scale = config.pdf_scale if measured else 1
+    box = frag.get('box')
+
+    async def render():
+        import PIL.Image
+        dpi = config.raster_dpi * scale
+        await runTool(('pdftoppm', '-r', str(dpi), '-png', '-singlefile',
+                       fname_pdf, tmp))
+        return PIL.Image.open(fname_png).convert('RGB'), dpi
+
+    if box is not None:
+        # Convert the metrics from TeX points to PDF points.
+        wd, ht, dp, x, y = [_ * 72 / 72.27 for _ in box]
+        pad = config.fragment_padding
+        if wd <= 0 or ht + dp <= 0:
+            open(fname_svg, 'w').write(config.empty_svg)
+            storeCachedFragment(frag['hash'], fname_svg)
+            return None
+
+        # The position of the box is relative to the bottom left corner of
+        # the page, whereas the SVG coordinates start at the top left.
+        await runTool(('pdf2svg', fname_pdf, fname_svg))
+        svg = open(fname_svg, 'r').read()
+        m = re.search(r'<svg\b[^>]*\bviewBox="([^"]*)"', svg)
+        assert m is not None
+        height = float(m.group(1).split()[3])
+        box_pt = (x - pad, height - y - ht - pad,
+                  x + wd + pad, height - y + dp + pad)
+        metrics = (scale * (wd + 2 * pad), scale * (ht + dp + 2 * pad),
+                   scale * (dp + pad))
+        del wd, ht, dp, x, y, pad, m, height
+        img = None
+    else:
+        # Render the PDF and determine the crop box in pixels.
+        import numpy as np
+        img, dpi = await render()
+        block = frag['inline'] is True and not measured
+        with profileTool('computeCropBox'):
+            box = computeCropBox(np.array(img.convert('L'), np.float32) / 255,
+                                 block)
+        if box is None:
+            open(fname_svg, 'w').write(config.empty_svg)
+            storeCachedFragment(frag['hash'], fname_svg)
+            return None
+
+        # Convert the crop box to points. This empirical hack (1pt extra at
+        # the top) may better align the SVG images with the base line of the
+        # surrounding text.
+        box_pt = [_ * 72 / dpi for _ in box]
+        if block:
+            box_pt[1] -= 1
+        await runTool(('pdf2svg', fname_pdf, fname_svg))
+        svg = open(fname_svg, 'r').read()
+        metrics = None
+        del box, block
+
+    # Crop the SVG.
+    with profileTool('cropSVG'):
+        svg = cropSVG(svg, box_pt, scale)
+    open(fname_svg, 'w').write(svg)
+    del svg
+
+    # Replace the SVG file with the alternative image format if it exceeds the
+    # max_svg_size threshold. However, only replace it if the alternative
+    # image is indeed smaller.
+    if os.stat(fname_svg).st_size > config.max_svg_size:
+        if img is None:
+            img, dpi = await render()
+        img.crop([int(round(_ * dpi / 72)) for _ in box_pt]).save(fname_alt)
+
+        # Only retain the alternative image if it is smaller than the SVG.
+        if os.stat(fname_svg).st_size > os.stat(fname_alt).st_size:
+            os.remove(fname_svg)
+        else:
+            os.remove(fname_alt)
+    del img, box_pt
+
+    # Add the image to the fragment cache.
+    if os.path.exists(fname_svg):
+        storeCachedFragment(frag['hash'], fname_svg, metrics)
+    else:
+        storeCachedFragment(frag['hash'], fname_alt, metrics)
+    return metrics
+
+
+def convertFragmentDVI(build_dir, target_dir, frag):
+    """
+    Crop the SVG image that `dvisvgm` produced for ``frag``.
+
+    The SVG must be in ``build_dir`` and be named after frag['placeholder']
+    (see :func:`splitFragmentPages`). Its view box is the exact bounding box
+    of the page, or the box TeX measured if the fragment is measured (see
+    :func:`fragmentPage`). This function adds ``config.fragment_padding`` to
+    the view box of measured fragments, scales the SVG by
+    ``config.pdf_scale``, and saves it in ``target_dir``.
+
+    Unlike :func:`convertFragmentPDF` it never produces an alternative image.
+    The final image is also added to the fragment cache.
+
+    :param **str** build_dir: directory with the SVG file from `dvisvgm`.
+    :param **str** target_dir: output directory of SVG file.
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: (width, height, depth) of the image in points if TeX measured
+        the fragment, or **None**.
+    :rtype: (**float**, **float**, **float**)
+    """
+    frag_name = frag['placeholder']
+    fname_svg = os.path.join(target_dir, frag_name + '.svg')
+    svg = open(os.path.join(build_dir, frag_name + '.svg'), 'r').read()
+
+    # Pages without any visible content have an empty view box.
+    m = re.search(r'<svg\b[^>]*\bviewBox="([^"]*)"', svg)
+    assert m is not None
+    x, y, wd, ht = [float(_) for _ in m.group(1).split()]
+    del m
+    if wd <= 0 or ht <= 0:
+        open(fname_svg, 'w').write(config.empty_svg)
+        storeCachedFragment(frag['hash'], fname_svg)
+        return None
+
+    # The view box of measured fragments starts at the top of the box and
+    # includes its depth. The depth comes from TeX and must be converted from
+    # TeX points to SVG points.
+    scale = config.pdf_scale
+    box = frag.get('box')
+    if fragmentIsMeasured(frag) and box is not None:
+        pad = config.fragment_padding
+        dp = box[2] * 72 / 72.27
+        box_pt = (x - pad, y - pad, x + wd + pad, y + ht + pad)
+        metrics = (scale * (wd + 2 * pad), scale * (ht + 2 * pad),
+                   scale * (dp + pad))
+        del pad, dp
+    else:
+        box_pt = (x, y, x + wd, y + ht)
+        metrics = None
+
+    # Crop the SVG and add it to the fragment cache.
+    with profileTool('cropSVG'):
+        svg = cropSVG(svg, box_pt, scale)
+    open(fname_svg, 'w').write(svg)
+    storeCachedFragment(frag['hash'], fname_svg, metrics)
+    return metrics
+
+
+async def convertFragmentOutput(build_dir, target_dir, frag):
+    """
+    Convert the compiled ``frag`` into an image with the configured backend.
+
+    This calls :func:`convertFragmentPDF` or :func:`convertFragmentDVI`,
+    depending on ``config.backend``.
+
+    :param **str** build_dir: directory with the compiled fragment.
+    :param **str** target_dir: output directory of image files.
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: (width, height, depth) of the image in points, or **None**.
+    :rtype: (**float**, **float**, **float**)
+    """
+    if config.backend == 'dvi':
+        return convertFragmentDVI(build_dir, target_dir, frag)
+    return await convertFragmentPDF(build_dir, target_dir, frag)
+
+
+async def splitFragmentPages(build_dir, name, pages):
+    """
+    Split the output file ``name`` into one file per fragment.
+
+    The output file is the PDF or DVI file in ``build_dir`` that pdfLaTeX
+    produced for ``name`` + '.tex'. The ``pages`` argument is a list of
+    (page, frag) tuples, where the page numbers start at 1. This function also
+    attaches the metrics from the '.box' file to each fragment (see
+    :func:`fragmentPage`).
+
+    For the 'pdf' backend, `pdfseparate` extracts each page into
+    ``build_dir`` + frag['placeholder'] + '.pdf'.
+
+    For the 'dvi' backend, a single `dvisvgm` call converts all pages
+    into ``build_dir`` + frag['placeholder'] + '.svg'. The `--exact` option
+    ensures the view box of each page matches the glyph outlines, unless
+    the page locks its bounding box (see :func:`fragmentPage`).
+
+    :param **str** build_dir: directory with the compiled document.
+    :param **str** name: name of the document without extension.
+    :param **list** pages: list of (page, frag) tuples.
+    """
+    fname_doc = os.path.join(build_dir, name + '.' + config.backend)
+    if config.backend == 'dvi':
+        # dvisvgm may pad the page numbers with zeros, which is why the page
+        # numbers come from the file names it actually produced.
+        fname_page = os.path.join(build_dir, name + '-%p.svg')
+        await runTool(('dvisvgm', '--no-fonts', '--exact', '--page=1-',
+                       '--output=' + fname_page, fname_doc))
+        fnames = {}
+        prefix = name + '-'
+        for fname in os.listdir(build_dir):
+            if fname.startswith(prefix) and fname.endswith('.svg'):
+                num = fname[len(prefix):-4]
+                if num.isdigit():
+                    fnames[int(num)] = os.path.join(build_dir, fname)
+        ext = '.svg'
+        del prefix
+    else:
+        fname_page = os.path.join(build_dir, name + '-%d.pdf')
+        await runTool(('pdfseparate', fname_doc, fname_page))
+        fnames = {page: fname_page % page for page, frag in pages}
+        ext = '.pdf'
+
+    boxes = readFragmentBoxes(os.path.join(build_dir, name + '.box'))
+    for page, frag in pages:
+        fname = os.path.join(build_dir, frag['placeholder'] + ext)
+        os.replace(fnames[page], fname)
+        frag['box'] = boxes.get(frag['placeholder'])
+
+
+async def compileFragmentToImage(base_dir, build_dir, target_dir, preamble,
+                                 fmt, frag):
+    """
+    Convert ``frag`` into an SVG image and save it in ``target_dir``.
+
+    To produce the SVG image, this function will first create a standalone
+    LaTeX file based on the ``preamble`` and ``frag['tex']``, compile it into
+    an auxiliary PDF file in the ``build_dir`` directory, and then convert it
+    with `pdf2svg <http://www.cityinthesky.co.uk/opensource/pdf2svg/>`_
+
+    The ``base_dir`` is the directory of the original LaTeX file. Knowing this
+    directory is necessary because the fragment may include references to other
+    files (eg. images) that are relative to that directory.
+
+    The name of the final SVG depends on frag['placeholder']. If the fragment
+    cache already has an image for frag['hash'] (see :func:`fragmentHash`)
+    then this function copies that image instead of compiling the fragment.
+
+    The conversion to SVG suffers from cropping too much of the PDF image.
+    While this removes all unnecessary white space, it also causes vertical
+    alignment problems when the image is inserted in the HTML document. For
+    instance, the cropped images for 'I' and 'y' have similar height, yet 'y'
+    reaches lower than 'I'.
+
+    To circumvent this problem a \\\\rule{1ex}{1ex} (ie a black box the size of
+    an 'x' in the current font) precedes all fragments. This rule serves as a
+    reference point to compute the PDF margins such that it sits precisely in
+    the middle. For a good overview of the alignment options in HTML see
+    `<http://www.maxdesign.com.au/articles/vertical-align/>`_.
+
+    This rule is only necessary if ``config.measure_inline`` is **False**.
+    Otherwise, TeX reports the exact size and baseline of inline fragments
+    (see :func:`fragmentPage`), and the <img> tag specifies them explicitly
+    (see :func:`imageStyle`).
+
+    To compute the margin, the PDF is (temporarily) rendered to a PNG and
+    analysed as a NumPy array. The black box is easy to identify there, as is
+    the computation of the required margin. The margin is extra space (not
+    cropped space) at either the top or bottom such that the box is vertically
+    centred. A similar process yields the width of the box, and the
+    corresponding margin is removed from the image as well (see
+    :func:`computeCropBox`).
+
+    This process requires these external tools:
+
+    * `pdf2svg <http://www.cityinthesky.co.uk/opensource/pdf2svg/>`_
+    * pdftoppm (part of Poppler)
+
+    If ``config.backend`` is 'dvi' then pdfLaTeX produces a DVI file instead,
+    and `dvisvgm` converts it (see :func:`splitFragmentPages` and
+    :func:`convertFragmentDVI`).
+
+    :param **str** base_dir: directory of the source file.
+    :param **str** build_dir: temporary directory to use for PDF creation.
+    :param **str** target_dir: output directory of SVG file.
+    :param **str** preamble: LaTeX preamble.
+    :param **str** fmt: format with the precompiled preamble (see
+        :func:`buildPreambleFormat`), or **None**.
+    :param **dict** frag: fragment data (typically from
+        :func:`replaceFragments`)
+    :return: {frag['hash']: metrics} (see :func:`convertFragmentPDF`).
+    :rtype: **dict**
+    """
+    # Ensure the target- directory exists.
+    try:
+        os.mkdir(target_dir)
+    except FileExistsError:
+        pass
+
+    # Do not compile fragments whose image is already in the cache.
+    if copyCachedFragment(target_dir, frag):
+        return {frag['hash']: findCachedMetrics(frag['hash'])}
+
+    # Name of fragment file (must be in same directory as the original source
+    # code to ensure image include tags access the correct files). The output
+    # files are named after the placeholder.
+    name = frag['placeholder']
+    fname_tex = os.path.join(base_dir, scratchName(name) + '.tex')
+
+    def removeStaleFiles():
+        # Remove the temporary LaTeX file.
+        try:
+            os.remove(fname_tex)
+        except FileNotFoundError:
+            pass
+
+    try:
+        # Write the LaTeX code into a temporary file and compile it.
+        tex = fragmentDocument(preamble, fmt, fragmentPage(frag))
+        open(fname_tex, 'w').write(tex)
+        await runPDFLaTeX(build_dir, fname_tex, fmt, config.backend, name)
+        del tex
+
+        # Crop the output and convert it to an image. The DVI backend converts
+        # the page to SVG in this step already.
+        if config.backend == 'dvi':
+            await splitFragmentPages(build_dir, name, [(1, frag)])
+        else:
+            fname = os.path.join(build_dir, name + '.box')
+            frag['box'] = readFragmentBoxes(fname).get(name)
+            del fname
+        metrics = await convertFragmentOutput(build_dir, target_dir, frag)
+        removeStaleFiles()
+        return {frag['hash']: metrics}
+    except subprocess.CalledProcessError as e:
+        # Process returned with non-zero exit code: dump the error message and
+        # the complete process output.
+        msg = 'Command <{}> returned with error code: {}\n'
+        msg = msg.format(e.cmd, e.returncode)
+        print(msg)
+        printFragmentSource(frag, fname_tex)
+        removeStaleFiles()
+        raise e
+    except FileNotFoundError as e:
+        removeStaleFiles()
+        raise e
+    except AssertionError as e:
+        printFragmentSource(frag, fname_tex)
+        removeStaleFiles()
+        raise e
+    except asyncio.CancelledError as e:
+        removeStaleFiles()
+        raise e
+
+
+def scratchName(name):
+    """
+    Return a unique file name (without extension) derived from ``name``.
+
+    The LaTeX files of the fragments must be in the directory of the source
+    file (see :func:`compileFragmentToImage`). Documents in the same directory
+    may convert concurrently (see :func:`convertFiles`) and their fragments
+    may have the same placeholders, which is why every such file needs a
+    name of its own. The process ID separates concurrent Nobby processes.
+
+    :param *str* name: base name (eg. the placeholder of a fragment).
+    :return: unique name.
+    :rtype: **str**
+    """
+    return '_nobby_{}_{}_{}'.format(os.getpid(), next(scratch_ids), name)
+
+
+async def compileFragmentBatch(base_dir, build_dir, target_dir, preamble,
+                               fmt, frags):
+    """
+    Convert all ``frags`` into images with a single pdfLaTeX run.
+
+    This function puts every fragment on a dedicated page of a single LaTeX
+    document (see :func:`fragmentPage`), compiles that document, splits the
+    PDF into single pages with `pdfseparate`, and converts them as usual (see
+    :func:`convertFragmentPDF`). This saves the pdfLaTeX start-up and preamble
+    processing for all but the first fragment.
+
+    Every fragment must produce exactly one page. If that is not the case, or
+    if the document does not compile, then this function falls back to
+    :func:`compileFragmentToImage` for every fragment. This also ensures that
+    compile errors refer to the offending fragment.
+
+    The pages reset all counters that Nobby tracks, but a fragment that
+    changes other global state (eg. with '\\gdef' or '\\global') affects
+    all subsequent fragments of the batch without any error. Such fragments
+    need ``config.max_batch_size = 1`` (and ``config.use_tex_workers =
+    False``).
+
+    Unlike :func:`compileFragmentToImage`, this function does not consult the
+    fragment cache (:func:`compileFragments` already did).
+
+    :param **str** base_dir: directory of the source file.
+    :param **str** build_dir: temporary directory to use for PDF creation.
+    :param **str** target_dir: output directory of image files.
+    :param **str** preamble: LaTeX preamble.
+    :param **str** fmt: format with the precompiled preamble, or **None**.
+    :param **list** frags: list of fragment descriptors.
+    :return: {frag['hash']: metrics} for all ``frags`` (see
+        :func:`convertFragmentPDF`).
+    :rtype: **dict**
+    """
+    async def fallback():
+        out = {}
+        for frag in frags:
+            out.update(await compileFragmentToImage(
+                base_dir, build_dir, target_dir, preamble, fmt, frag))
+        return out
+
+    # A batch with a single fragment is just a fragment.
+    if len(frags) == 1:
+        return await fallback()
+
+    # Ensure the target- directory exists.
+    try:
+        os.mkdir(target_dir)
+    except FileExistsError:
+        pass
+
+    # The LaTeX file must be in the same directory as the original source code
+    # (see compileFragmentToImage). Name the output after the first fragment.
+    name = frags[0]['placeholder'] + '-batch'
+    fname_tex = os.path.join(base_dir, scratchName(name) + '.tex')
+
+    # Put every fragment on its own page. After each page, write the page
+    # counter into the log file. If every fragment produced exactly one page
+    # then the page counter is 2, 3, ... etc.
+    tex = ''
+    for frag in frags:
+        tex += fragmentPage(frag)
+        tex += '\\typeout{<nobby-page \\arabic{page}>}\n'
+    tex = fragmentDocument(preamble, fmt, tex)
+    open(fname_tex, 'w').write(tex)
+    del tex
+
+    try:
+        tex_out = await runPDFLaTeX(build_dir, fname_tex, fmt, config.backend,
+                                    name)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return await fallback()
+    finally:
+        os.remove(fname_tex)
+
+    # TeX wraps long lines in the log file. Join them before looking for the
+    # page counters.
+    try:
+        pages = re.findall(r'<nobby-page (\d+)>', tex_out.log.replace('\n', ''))
+    except (AttributeError, TypeError):
+        pages = []
+    if pages != [str(_ + 2) for _ in range(len(frags))]:
+        if config.verbose:
+            print('Batch <{}> produced an unexpected number of pages'.format(
+                fname_tex))
+        return await fallback()
+    del pages, tex_out
+
+    # Split the output into single pages and name each one after its
+    # fragment.
+    await splitFragmentPages(build_dir, name, list(enumerate(frags, 1)))
+
+    # Crop the pages and convert them to images.
+    out = {}
+    for frag in frags:
+        out.update(await convertFragment(build_dir, target_dir, frag))
+    return out
+
+
+async def convertFragment(build_dir, target_dir, frag):
+    """
+    Convert the compiled ``frag`` into an image in ``target_dir``.
+
+    This is a wrapper around :func:`convertFragmentOutput` that reports
+    errors together with the problematic LaTeX code of the fragment.
+
+    :param **str** build_dir: directory with the compiled fragment.
+    :param **str** target_dir: output directory of image files.
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :return: {frag['hash']: metrics} (see :func:`convertFragmentPDF`).
+    :rtype: **dict**
+    """
+    try:
+        metrics = await convertFragmentOutput(build_dir, target_dir, frag)
+        return {frag['hash']: metrics}
+    except subprocess.CalledProcessError as e:
+        msg = 'Command <{}> returned with error code: {}\n'
+        msg = msg.format(e.cmd, e.returncode)
+        print(msg)
+        printFragmentSource(frag, '')
+        raise e
+    except AssertionError as e:
+        printFragmentSource(frag, '')
+        raise e
+
+
+class TeXWorker():
+    """
+    A long-lived pdfLaTeX process that typesets one fragment after another.
+
+    The worker compiles a LaTeX document (see :meth:`start`) that reads the
+    name of a LaTeX file from its standard input, typesets that file, and
+    then reports the current page number on its standard output. It repeats
+    this until it reads 'nobby-stop' instead of a file name, at which point
+    it finishes the PDF file. The preamble is thus processed only once per
+    worker, rather than once per fragment.
+
+    Every fragment is a single page (see :func:`fragmentPage`). The worker
+    keeps track of which page belongs to which fragment in ``pages``, and
+    moves every page to a dedicated PDF file named after the fragment once
+    the PDF is complete (see :meth:`finish`). All fragments of a worker share
+    its global state (see :func:`fragmentPage`), which is why
+    :func:`typesetFragments` retires a worker after a fragment fails.
+
+    The worker reads data exclusively from its standard input, which is why
+    pdfLaTeX must run in scroll mode. Consequently, an error that asks the
+    user for input (eg. a missing file) will wedge the worker. The worker
+    therefore gives up on every fragment that takes longer than
+    ``config.fragment_timeout`` seconds.
+    """
+    def __init__(self, name, path):
+        # The name determines the name of the LaTeX driver file and all its
+        # output files.
+        self.name = name
+        self.path = path
+        self.fname_tex = os.path.join(path.d_base, name + '.tex')
+        self.fname_frag = os.path.join(path.d_base, name + '-frag.tex')
+        self.fname_out = os.path.join(path.d_build,
+                                      name + '.' + config.backend)
+
+        # List of (page, frag) tuples of all successfully typeset fragments,
+        # and the page that the next fragment will occupy. The page is
+        # **None** until the worker has processed its preamble.
+        self.pages = []
+        self.page = None
+        self.proc = None
+
+    async def start(self, preamble, fmt):
+        """
+        Write the LaTeX driver file and start pdfLaTeX on it.
+
+        The driver file reads lines from the terminal (ie. standard input)
+        with `\\endlinechar=-1` to avoid the trailing white space that TeX
+        would otherwise append to every line.
+
+        Return **True** if pdfLaTeX processed the preamble.
+        """
+        body = ('\\def\\nobbystop{nobby-stop}\n'
+                '\\def\\nobbyloop{%\n'
+                '  {\\endlinechar=-1 \\global\\read-1 to \\nobbyline}%\n'
+                '  \\ifx\\nobbyline\\nobbystop\\else\n'
+                '    \\input{\\nobbyline}%\n'
+                '    \\typeout{<nobby-done \\arabic{page}>}%\n'
+                '    \\expandafter\\nobbyloop\n'
+                '  \\fi}\n'
+                '\\typeout{<nobby-done \\arabic{page}>}%\n'
+                '\\nobbyloop\n')
+        open(self.fname_tex, 'w').write(fragmentDocument(preamble, fmt, body))
+        del body
+
+        # Create the build directory if it does not exist (pdflatex does not
+        # create it automatically).
+        os.makedirs(self.path.d_build, exist_ok=True)
+
+        # Run pdfLaTeX in the directory of the source file to ensure relative
+        # paths in the fragments (eg. \includegraphics) work.
+        args = ('pdflatex', '-interaction=scrollmode')
+        if config.backend == 'dvi':
+            args += ('-output-format=dvi',)
+        args += ('-output-directory=' + os.path.abspath(self.path.d_build),)
+        if fmt is not None:
+            args += ('-fmt=' + fmt,)
+        args += (os.path.basename(self.fname_tex),)
+        self.proc = await asyncio.create_subprocess_exec(
+            *args, cwd=self.path.d_base, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        ret = await self.read()
+        if ret is None:
+            return False
+        self.page = ret[0]
+        return True
+
+    async def read(self):
+        """
+        Read the output of the worker until it reports a page number.
+
+        Return the (page, error) tuple, where ``error`` is **True** if
+        pdfLaTeX reported an error in the meantime. Return **None** if the
+        worker has terminated, or did not report a page number within
+        ``config.fragment_timeout`` seconds.
+        """
+        error = False
+        t_max = time.time() + config.fragment_timeout
+        while True:
+            try:
+                line = await asyncio.wait_for(self.proc.stdout.readline(),
+                                              t_max - time.time())
+            except asyncio.TimeoutError:
+                if config.verbose:
+                    print('TeX worker <{}> is not responding'.format(
+                        self.name))
+                return None
+            if len(line) == 0:
+                return None
+
+            # TeX prefixes all error messages with an exclamation mark.
+            if line.startswith(b'! '):
+                error = True
+                continue
+            m = re.match(rb'<nobby-done (\d+)>', line)
+            if m is not None:
+                return int(m.group(1)), error
+
+    async def submit(self, frag):
+        """
+        Typeset ``frag`` and wait until the worker has finished it.
+
+        Return **True** if the fragment compiled without errors and occupies
+        exactly one page, **False** if it did not, and **None** if the worker
+        terminated or wedged (see :meth:`read`).
+        """
+        assert self.page is not None
+        open(self.fname_frag, 'w').write(fragmentPage(frag))
+        self.proc.stdin.write(os.path.basename(self.fname_frag).encode('utf8'))
+        self.proc.stdin.write(b'\n')
+        try:
+            await self.proc.stdin.drain()
+        except ConnectionError:
+            return None
+
+        ret = await self.read()
+        if ret is None:
+            return None
+        page, error = ret
+        ok = not error and page == self.page + 1
+        if ok:
+            self.pages.append((self.page, frag))
+        self.page = page
+        return ok
+
+    async def finish(self):
+        """
+        Stop the worker and split its PDF file into one file per fragment.
+
+        :return: list of all fragments the worker typeset successfully.
+        :rtype: **list**
+        """
+        try:
+            await asyncio.wait_for(self.proc.communicate(b'nobby-stop\n'),
+                                   config.fragment_timeout)
+        except asyncio.TimeoutError:
+            await self.kill()
+            return []
+        if len(self.pages) == 0 or not os.path.exists(self.fname_out):
+            return []
+
+        # Split the output into single pages and name each one after its
+        # fragment.
+        await splitFragmentPages(self.path.d_build, self.name, self.pages)
+        return [frag for page, frag in self.pages]
+
+    async def kill(self):
+        """
+        Kill the worker process.
+        """
+        if self.proc is None:
+            return
+        try:
+            self.proc.kill()
+        except ProcessLookupError:
+            pass
+        await self.proc.wait()
+
+    def removeStaleFiles(self):
+        """
+        Remove the LaTeX files of the worker.
+        """
+        for fname in (self.fname_tex, self.fname_frag):
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+
+class FragmentQueue():
+    """
+    A queue of fragments that hands out the most expensive fragment first.
+
+    Producers add fragments with :meth:`put` as soon as they exist, and call
+    :meth:`close` once there are no more. Consumers wait in :meth:`get` until
+    there is a fragment. Fragments leave the queue in the order of their
+    estimated cost (see :func:`estimateFragmentTime`), and in the order of
+    :meth:`put` for equal costs. The TeX workers can thus start typesetting
+    before the document has been converted completely (see
+    :func:`convertDocument`).
+    """
+    def __init__(self, frags=()):
+        # Heap of (-estimate, num, frag) tuples. The running number ``num``
+        # prevents Python from ever comparing two fragments.
+        self.heap = []
+        self.num = 0
+        self.closed = False
+        self.waiters = collections.deque()
+        for frag in frags:
+            self.put(frag)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, frag, estimate=0):
+        """
+        Add ``frag`` with the ``estimate`` of its cost in seconds.
+        """
+        heapq.heappush(self.heap, (-estimate, self.num, frag))
+        self.num += 1
+        self.wake()
+
+    def close(self):
+        """
+        Declare that no more fragments will arrive.
+        """
+        self.closed = True
+        self.wake()
+
+    async def get(self):
+        """
+        Wait for, and then return, the most expensive fragment.
+
+        Return **None** once the queue is closed and empty.
+        """
+        while len(self.heap) == 0 and not self.closed:
+            fut = asyncio.get_running_loop().create_future()
+            self.waiters.append(fut)
+            await fut
+        if len(self.heap) == 0:
+            return None
+        return heapq.heappop(self.heap)[2]
+
+    def wake(self):
+        """
+        Wake up all consumers that wait for a fragment.
+        """
+        while len(self.waiters) > 0:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+
+
+async def typesetFragments(preamble, fmt, frags, path, done=None):
+    """
+    Typeset all ``frags`` with a set of :class:`TeXWorker` processes.
+
+    This function runs as many workers concurrently as there are slots for
+    `pdflatex` (see :func:`toolSlot`), and every worker takes the next
+    fragment as soon as it has typeset the previous one. A worker only
+    occupies a slot while it processes its preamble, a fragment, or its
+    output, but not while it waits for fragments. After at most
+    ``config.max_batch_size`` fragments, or once the queue is empty, the
+    worker stops and produces one PDF per fragment in the build directory. A
+    fresh worker then takes over. If ``done`` is not **None** then this
+    function passes the list of fragments of every stopped worker to it. The
+    conversion of those fragments can thus start while the other workers are
+    still typesetting.
+
+    The ``frags`` are either a list, or a :class:`FragmentQueue` that other
+    tasks fill while the workers are running. In the latter case, the workers
+    process their preamble right away and then wait for fragments, until the
+    queue is closed.
+
+    Fragments that produce a LaTeX error, or not exactly one page, are
+    returned in a dedicated list. Their worker stops right after them, as if
+    it had a full batch, and a fresh worker takes over. The same is true for
+    fragments that wedge their worker (ie. do not finish within
+    ``config.fragment_timeout`` seconds) or crash it, except that all
+    fragments the old worker had already typeset go back into the queue.
+
+    If a worker terminates before it has even processed the preamble then
+    this function stops and returns all remaining fragments as failed.
+
+    :param **str** preamble: LaTeX preamble.
+    :param **str** fmt: format with the precompiled preamble, or **None**.
+    :param **list** frags: list of fragment descriptors, or a
+        :class:`FragmentQueue`.
+    :param **tuple** path: the usual set of path names.
+    :param **callable** done: callback for the fragments of every worker.
+    :return: (typeset, failed) fragments. The typeset fragments have a PDF
+        named after their placeholder in the build directory.
+    :rtype: (**list**, **list**)
+    """
+    if isinstance(frags, FragmentQueue):
+        queue = frags
+    else:
+        queue = FragmentQueue(frags)
+        queue.close()
+    typeset, failed = [], []
+    broken = False
+
+    async def runWorker(track):
+        trace_track.set('{}: TeX worker {}'.format(trace_track.get(), track))
+        while not (queue.closed and len(queue) == 0):
+            # Fail all remaining fragments if the workers cannot even process
+            # the preamble.
+            if broken:
+                frag = await queue.get()
+                if frag is not None:
+                    failed.append(frag)
+                continue
+
+            worker = TeXWorker(scratchName('worker'), path)
+            try:
+                await runFragments(worker)
+            except asyncio.CancelledError as e:
+                await worker.kill()
+                raise e
+            finally:
+                worker.removeStaleFiles()
+
+    async def runFragments(worker):
+        nonlocal broken
+        async with toolSlot('pdflatex'):
+            with profileSpan('start worker'):
+                ok = await worker.start(preamble, fmt)
+        if not ok:
+            # The worker did not even get past the preamble.
+            await worker.kill()
+            broken = True
+            return
+
+        # Typeset fragments until the worker has a full batch, the queue is
+        # closed and empty, or the worker dies. In the latter case, give the
+        # fragments it already typeset to the next worker, and report the
+        # current one as failed.
+        num = 0
+        while num < config.max_batch_size:
+            frag = await queue.get()
+            if frag is None:
+                break
+            num += 1
+            charged_fragments.set([frag])
+            async with toolSlot('pdflatex'):
+                with profileTool('pdflatex (worker)',
+                                 {'fragment': frag['placeholder']}):
+                    ok = await worker.submit(frag)
+            if not ok:
+                failed.append(frag)
+            if ok is None:
+                await worker.kill()
+                for page, frag in worker.pages:
+                    queue.put(frag)
+                return
+
+            # A fragment that failed half-way may have left the worker in
+            # any state (eg. inside a group, or with global definitions), so
+            # the next fragments go to a fresh worker.
+            if not ok:
+                break
+
+        charged_fragments.set([frag for page, frag in worker.pages])
+        async with toolSlot('pdflatex'):
+            with profileSpan('finish worker'):
+                out = await worker.finish()
+        typeset.extend(out)
+        if done is not None and len(out) > 0:
+            done(out)
+
+    num = toolLimit('pdflatex', maxProcesses())
+    if queue.closed:
+        num = min(num, len(queue))
+    await asyncio.gather(*[runWorker(_) for _ in range(num)])
+    return typeset, failed
+
+
+def fragmentBatchSize(num_frags):
+    """
+    Return the number of fragments to compile per pdfLaTeX run.
+
+    Larger batches save more pdfLaTeX start-ups, but there must also be
+    enough batches to keep all ``config.num_processes`` processes busy until
+    the end. This function aims for at least four batches per process, and at
+    most ``config.max_batch_size`` fragments per batch.
+
+    :param **int** num_frags: number of fragments to compile.
+    :rtype: **int**
+    """
+    num_batches = 4 * config.num_processes
+    size = (num_frags + num_batches - 1) // num_batches
+    return max(1, min(config.max_batch_size, size))
+
+
+def estimateFragmentTime(frag):
+    """
+    Return the expected time in seconds to compile and convert ``frag``.
+
+    This is the recorded time from a previous run if there is one (see
+    :func:`findCachedTiming`). Otherwise, it is a rough estimate based on the
+    type of the fragment and the length of its LaTeX code. Graphics (eg. TikZ
+    pictures and included images) are usually far more expensive than
+    equations of the same length.
+
+    :param **dict** frag: fragment data (see :func:`processFragments`).
+    :rtype: **float**
+    """
+    seconds = findCachedTiming(frag)
+    if seconds is not None:
+        return seconds
+
+    # Base cost of the fragment type plus a small cost per character.
+    seconds = 0.05 if frag['inline'] is True else 0.1
+    seconds += 1E-4 * len(frag['tex'])
+    if re.search(r'\\begin\{(tikzpicture|axis|pgfpicture)\}|'
+                 r'\\includegraphics', frag['tex']):
+        seconds += 1
+    return seconds
+
+
+def imageStyle(metrics):
+    """
+    Return the CSS style for an <img> tag of an image with ``metrics``.
+
+    Example:
+
+    .. inline-python::
+
+        import nobby
+        print(nobby.imageStyle((20.5, 10, 2.25)))
+        print(nobby.imageStyle(None))
+
+    :param **tuple** metrics: (width, height, depth) in points, or **None**
+        (see :func:`convertFragmentPDF`).
+    :return: CSS style.
+    :rtype: **str**
+    """
+    if metrics is None:
+        return 'vertical-align: middle;'
+    width, height, depth = metrics
+    style = 'vertical-align: {0:.2f}pt; width: {1:.2f}pt; height: {2:.2f}pt;'
+    return style.format(-depth, width, height)
+
+
+def systemLoad():
+    """
+    Return the current (load, memory) of the system.
+
+    The ``load`` is the average number of runnable processes during the last
+    minute, and ``memory`` the available memory in bytes. Either is **None**
+    if the operating system does not provide it (the memory only comes from
+    '/proc/meminfo' on Linux).
+
+    :rtype: (**float**, **int**)
     """
-    Convert all ``fragments`` to SVG images and update ``html``.
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = None
+
+    memory = None
+    try:
+        for line in open('/proc/meminfo', 'r'):
+            if line.startswith('MemAvailable:'):
+                memory = int(line.split()[1]) * 1024
+                break
+    except (OSError, ValueError, IndexError):
+        pass
+    return load, memory
+
+
+def nextConcurrency(num, increased, load, memory, rate, prev_rate):
+    """
+    Return the next number of concurrent processes and the reason for it.
+
+    The rules, in order of precedence, are:
+
+    * halve ``num`` if less than ``config.adaptive_min_memory`` bytes of
+      memory are available,
+    * reduce ``num`` by one if the ``load`` exceeds the number of cores,
+    * undo the last increase if the throughput ``rate`` (fragments per
+      second) dropped by more than 10% since then (``prev_rate``),
+    * otherwise, increase ``num`` by one if at least one core is idle.
+
+    The result is always between 1 and ``config.max_processes``. The reason
+    is **None** if ``num`` does not change.
+
+    Example:
+
+    .. inline-python::
+
+        import nobby
+        print(nobby.nextConcurrency(4, False, 1.5, None, 2.0, 2.0))
+
+    :param **int** num: current number of concurrent processes.
+    :param **bool** increased: whether the last adjustment was an increase.
+    :param **float** load: system load (see :func:`systemLoad`), or **None**.
+    :param **int** memory: available memory in bytes, or **None**.
+    :param **float** rate: fragments per second since the last adjustment.
+    :param **float** prev_rate: fragments per second before that, or **None**.
+    :rtype: (**int**, **str**)
+    """
+    num_cpu = os.cpu_count() or 1
+    dropped = prev_rate is not None and rate < 0.9 * prev_rate
+    if memory is not None and memory < config.adaptive_min_memory:
+        new, reason = num // 2, 'low memory'
+    elif load is not None and load > num_cpu:
+        new, reason = num - 1, 'high load'
+    elif increased and dropped:
+        new, reason = num - 1, 'lower throughput'
+    elif (load is None or load < num_cpu - 1) and not dropped:
+        new, reason = num + 1, 'idle cores'
+    else:
+        new, reason = num, None
+
+    new = max(1, min(new, max(num, config.max_processes)))
+    return (new, reason) if new != num else (num, None)
+
+
+async def adaptConcurrency(slots, progress):
+    """
+    Adjust the number of concurrent processes until cancelled.
+
+    Every ``config.adaptive_interval`` seconds, this function measures the
+    system load, the available memory, and the throughput (ie. the increase
+    in ``progress()`` per second), and resizes ``slots`` accordingly (see
+    :func:`nextConcurrency`). It prints every adjustment.
+
+    :param **ToolSlots** slots: the slots of the current fragment pipeline.
+    :param **callable** progress: returns the number of finished fragments.
+    :return: **None**
+    """
+    prev_rate, increased = None, False
+    cnt, t0 = progress(), time.time()
+    while True:
+        await asyncio.sleep(config.adaptive_interval)
+        cnt_new, t1 = progress(), time.time()
+        rate = (cnt_new - cnt) / max(t1 - t0, 1E-3)
+        load, memory = systemLoad()
+        num, reason = nextConcurrency(slots.num_processes, increased, load,
+                                      memory, rate, prev_rate)
+        if reason is not None:
+            msg = '\nConcurrency {} -> {}: {} (load {}, memory {}, {:.2f} '
+            msg += 'fragments/s)'
+            print(msg.format(
+                slots.num_processes, num, reason,
+                'n/a' if load is None else '{:.2f}'.format(load),
+                'n/a' if memory is None else '{}MB'.format(memory >> 20),
+                rate))
+            increased = num > slots.num_processes
+            slots.resize(num)
+        else:
+            increased = False
+        prev_rate, cnt, t0 = rate, cnt_new, t1
 
-    Every element in ``fragments`` contains a self contained LaTeX fragment,
-    save the common ``preamble``. Those fragments were created in
-    :func:`createFragmentDescriptor`.
 
-    This function is little more than a scheduler for the concurrent execution
-    of :func:`compileFragmentToImage`. The ``num_processes`` variable
-    determines how many processes to spawn. The compilation runs in the main
-    thread if ``num_processes == 1`` (useful for debugging).
+async def runFragmentTasks(queue, done):
+    """
+    Run the tasks from the `asyncio.Queue` ``queue`` until it returns **None**.
+
+    Every task is a (func, args) tuple, where ``func`` is a coroutine
+    function like :func:`convertFragment` or :func:`compileFragmentBatch`
+    that returns {frag['hash']: metrics} for all fragments of the task. The
+    tasks start in the order of the queue. Once a task has finished, this
+    function calls ``done(ret, seconds)`` with its return value and its wall
+    time.
+
+    Up to twice :func:`maxProcesses` tasks run at the same time. This
+    keeps every program busy, because each task only occupies a slot of the
+    program it currently runs (see :func:`toolSlot`). A task that raises an
+    exception does not affect the others. Its fragments are merely missing
+    from the results (:func:`insertFragmentImages` reports them).
+
+    :param **asyncio.Queue** queue: (func, args) tuples, then **None**.
+    :param **callable** done: callback for every finished task.
+    :return: **None**
+    """
+    if tool_slots.get() is None:
+        tool_slots.set(ToolSlots(config.num_processes))
+
+    async def runTasks(track):
+        trace_track.set('{}: task runner {}'.format(trace_track.get(), track))
+        while True:
+            task = await queue.get()
+            if task is None:
+                # Leave the marker in the queue for the other consumers.
+                queue.put_nowait(None)
+                return
+            func, args = task
+
+            # The last argument of every fragment task is its fragment, or
+            # the list of its fragments. Show them with the task in the
+            # trace.
+            frags = args[-1] if isinstance(args[-1], list) else [args[-1]]
+            span = None
+            if profiler is not None:
+                span = {'fragments': [_['placeholder'] for _ in frags]}
+            charged_fragments.set(frags)
+            t0 = time.time()
+            try:
+                with profileSpan(func.__name__, span):
+                    ret = await func(*args)
+            except Exception as e:
+                print('\nError: {}'.format(e))
+                ret = {}
+            done(ret, time.time() - t0)
+
+    await asyncio.gather(*[runTasks(_)
+                           for _ in range(2 * maxProcesses())])
+
+
+async def compileFragments(preamble, incoming, path, warm=False):
+    """
+    Compile the fragments from ``incoming`` into images as they arrive.
+
+    The `asyncio.Queue` ``incoming`` provides the fragment descriptors (see
+    :func:`createFragmentDescriptor`) and then **None**. Every fragment
+    receives its :func:`fragmentHash` in ``frag['hash']``.
+
+    Fragments with identical LaTeX code, counters and options (ie. identical
+    :func:`fragmentHash`) are compiled only once. Fragments that were compiled
+    in a previous run come straight from the fragment cache. By default, TeX
+    workers typeset all other fragments as they arrive, and the resulting PDF
+    files convert concurrently (see :func:`typesetFragments`). Otherwise,
+    the fragments compile in batches of up to :func:`fragmentBatchSize`
+    fragments once all of them have arrived (see :func:`compileFragmentBatch`).
+    Every program has its own limit of concurrent runs, and
+    ``config.num_processes`` is the upper bound for all of them (see
+    :func:`toolSlot` and :func:`runFragmentTasks`).
+
+    The format with the precompiled preamble (see :func:`buildPreambleFormat`)
+    and the TeX workers start with the first fragment that needs compiling,
+    or right away if ``warm`` is **True**. In the latter case, they are ready
+    by the time the first fragment arrives. The reported time starts with the
+    first fragment.
+
+    The fragments start in the order of their expected cost, longest first
+    (see :func:`estimateFragmentTime`), and the actual cost of every compiled
+    fragment is recorded for the next run (see :func:`storeCachedTiming`).
+
+    Concurrent documents (see :func:`convertFiles`) share the format of
+    identical preambles, and a fragment that another document already
+    compiles comes from the fragment cache once it is done.
 
     :param *str* preamble: LaTeX preamble. Used to compile all fragments.
+    :param *asyncio.Queue* incoming: fragment descriptors, then **None**.
+    :param *tuple* path: the usual set of path names.
+    :param *bool* warm: start the format and the TeX workers immediately.
+    :rtype *dict*:
+    :return: {frag['hash']: metrics} of all fragments (see
+        :func:`convertFragmentPDF`).
+    """
+    # Every compilation has its own set of program limits, which may adapt to
+    # the load of the system, unless the caller already shares its own set
+    # with other tasks (see convertDocument).
+    trace_track.set(path.f_tex)
+    slots = tool_slots.get()
+    if slots is None:
+        slots = ToolSlots(config.num_processes)
+        tool_slots.set(slots)
+
+    # Ensure the target- directory exists.
+    try:
+        os.mkdir(path.d_html)
+    except FileExistsError:
+        pass
+
+    # Record how long each fragment took, ie. the time its programs ran (see
+    # profileTool). Programs that work on several fragments (eg. batches)
+    # split their time evenly among them. The wall time of the task does not
+    # count, because it includes the time the fragment waited for a slot or a
+    # TeX worker, which says more about the load than about the fragment. The
+    # progress only shows once all fragments have arrived, because only then
+    # is their number known. Unless Nobby runs in verbose mode, replace the
+    # previous percentage value with the new one.
+    unique, metrics, estimates = {}, {}, {}
+    pending, msg, tot, cnt = [], None, None, 0
+    t0, cpu0 = None, None
+
+    # The fragments this document compiles on behalf of other documents, and
+    # the fragments it waits for instead of compiling them itself.
+    shared = shared_fragments.get()
+    owned, borrowed = [], []
+
+    def done(ret, seconds):
+        nonlocal cnt
+        metrics.update(ret)
+        for frag_hash in ret:
+            frag = unique[frag_hash]
+            frag['seconds'] = sum(frag.get('tools', {}).values())
+            storeCachedTiming(frag, frag['seconds'])
+            if shared is not None and not shared[frag_hash].done():
+                shared[frag_hash].set_result(None)
+        cnt += len(ret)
+        if tot is not None and not config.verbose:
+            per = '{}%'.format(int(100 * cnt / tot))
+            print('\r' + msg + per, end='', flush=True)
+
+    def byEstimate(frags):
+        return sorted(frags, key=lambda frag: estimates[frag['hash']],
+                      reverse=True)
+
+    # The tasks pair every function with its arguments, and start in the
+    # order of the queue.
+    adapt = None
+    if config.adaptive_concurrency:
+        adapt = asyncio.ensure_future(adaptConcurrency(slots, lambda: cnt))
+    queue = asyncio.Queue()
+    run = asyncio.ensure_future(runFragmentTasks(queue, done))
+    frag_queue = FragmentQueue()
+    fmt, typeset = None, None
+
+    async def typesetAll():
+        # Typeset all fragments with warm TeX workers. Convert the PDFs of
+        # every worker as soon as it has stopped, while the others are still
+        # typesetting. Compile all fragments the workers could not typeset
+        # individually (this also produces the error messages).
+        def convert(frags):
+            for frag in byEstimate(frags):
+                task = (path.d_build, path.d_html, frag)
+                queue.put_nowait((convertFragment, task))
+        fname_fmt = await fmt
+        _, failed = await typesetFragments(preamble, fname_fmt, frag_queue,
+                                           path, convert)
+        for frag in byEstimate(failed):
+            task = (path.d_base, path.d_build, path.d_html, preamble,
+                    fname_fmt, frag)
+            queue.put_nowait((compileFragmentToImage, task))
+
+    def start():
+        # Compile the preamble into a format that all fragments can share,
+        # and start the TeX workers.
+        nonlocal fmt, typeset
+        if fmt is not None:
+            return
+        formats = shared_formats.get()
+        if formats is None:
+            fmt = asyncio.ensure_future(buildPreambleFormat(preamble, path))
+        else:
+            # Other documents may still need the format after this one was
+            # cancelled. Documents only share the format if their preambles
+            # also read the same files.
+            key = (preamble, tuple(referencedFiles(preamble, path.d_base)))
+            if key not in formats:
+                formats[key] = asyncio.ensure_future(
+                    buildPreambleFormat(preamble, path))
+            fmt = asyncio.shield(formats[key])
+        if config.use_tex_workers:
+            typeset = asyncio.ensure_future(typesetAll())
+
+    # Stop all tasks of the pipeline if it is cancelled (see
+    # convertDocument), including the idle TeX workers.
+    try:
+        if warm:
+            start()
+
+        # Determine the hash of every fragment. Fragments with the same
+        # hash produce the same image, which is why only the first fragment
+        # with any given hash needs compiling. Copy the images of all
+        # fragments that were compiled in a previous run from the fragment
+        # cache. Hand all others to the TeX workers right away, most
+        # expensive first, or keep them for the batches.
+        while True:
+            frag = await incoming.get()
+            if t0 is None:
+                t0, cpu0 = time.time(), time.thread_time()
+            if frag is None:
+                break
+            frag['hash'] = fragmentHash(preamble, frag, path.d_base)
+            if frag['hash'] in unique:
+                continue
+            unique[frag['hash']] = frag
+            if copyCachedFragment(path.d_html, frag):
+                metrics[frag['hash']] = findCachedMetrics(frag['hash'])
+                continue
+            if shared is not None:
+                if frag['hash'] in shared:
+                    borrowed.append(frag)
+                    continue
+                shared[frag['hash']] = asyncio.Future()
+                owned.append(frag['hash'])
+            estimates[frag['hash']] = estimateFragmentTime(frag)
+            pending.append(frag)
+            start()
+            if config.use_tex_workers:
+                frag_queue.put(frag, estimates[frag['hash']])
+        frag_queue.close()
+
+        num_cached = len(unique) - len(pending) - len(borrowed)
+        if num_cached > 0:
+            print('Fragment cache: {} of {} fragments were up to date'.format(
+                num_cached, len(unique)))
+        if len(borrowed) > 0:
+            print('Fragment cache: {} of {} fragments come from other '
+                  'documents'.format(len(borrowed), len(unique)))
+
+        if config.use_tex_workers:
+            msg = 'Compiling {} fragments with {} TeX workers: '
+            num = min(len(pending), toolLimit('pdflatex'))
+            msg = msg.format(len(pending), num)
+            del num
+        else:
+            msg = 'Compiling {} fragments in {} processes: '
+            msg = msg.format(len(pending), config.num_processes)
+        tot = max(1, len(pending))
+        print(msg + '{}%'.format(int(100 * cnt / tot)), end='', flush=True)
+
+        if typeset is not None:
+            await typeset
+        elif len(pending) > 0:
+            # Start with the fragments that are expected to take longest.
+            # Otherwise, an expensive fragment near the end of the document may
+            # start last and keep one process busy long after all others have
+            # finished. Group the fragments into batches. Every batch compiles
+            # with a single pdfLaTeX run (see compileFragmentBatch).
+            fname_fmt = await fmt
+            pending = byEstimate(pending)
+            size = fragmentBatchSize(len(pending))
+            for idx in range(0, len(pending), size):
+                task = (path.d_base, path.d_build, path.d_html, preamble,
+                        fname_fmt, pending[idx:idx + size])
+                queue.put_nowait((compileFragmentBatch, task))
+        elif fmt is not None:
+            await fmt
+        queue.put_nowait(None)
+        await run
+
+        # Copy the fragments that other documents compiled into the cache.
+        for frag in borrowed:
+            await shared[frag['hash']]
+            if copyCachedFragment(path.d_html, frag):
+                metrics[frag['hash']] = findCachedMetrics(frag['hash'])
+    finally:
+        for task in (run, fmt, typeset, adapt):
+            if task is not None:
+                task.cancel()
+
+        # Do not let other documents wait for fragments that failed.
+        for frag_hash in owned:
+            if not shared[frag_hash].done():
+                shared[frag_hash].set_result(None)
+    print('\r' + msg + 'ok ({}s)'.format(int(time.time() - t0)))
+    if profiler is not None:
+        profiler.addStage('compile fragments',
+                          time.perf_counter() - (time.time() - t0),
+                          time.time() - t0, time.thread_time() - cpu0)
+    return metrics
+
+
+def insertFragmentImages(html, fragments, metrics, path):
+    """
+    Point the <img> tags of all ``fragments`` in ``html`` to their images.
+
+    The HTML code already contains the image tags and file names, but without
+    extensions (ie. no '.png' or '.svg'). This function adds them, points the
+    image tags of duplicate fragments to the image of the fragment that was
+    compiled, and replaces the style placeholders with the ``metrics`` of the
+    images (see :func:`createFragmentDescriptor`).
+
+    It also evicts old images from the fragment cache, and removes the build
+    directory (unless ``config.keep_builddir`` is **True**).
+
     :param *str* html: HTML code. Images are without suffix (eg. no '.svg').
-    :param *list* fragments: Contains self contained LaTeX code fragments.
+    :param *list* fragments: fragments with their hash (see
+        :func:`compileFragments`).
+    :param *dict* metrics: {frag['hash']: metrics} of all fragments.
     :param *tuple* path: the usual set of path names.
     :rtype *str*:
     :return: ``html`` string with correct image extension in <img> tags.
     """
-    # Generator: yield input tuple for compileFragmentToImage. The explicit
-    # generate is only necessary because `multiprocessing.Pool` can only pass
-    # along one argument. To compound this problem, the generator packs the
-    # arguments into a tuple.
-    gen = ((path.d_base, path.d_build, path.d_html, preamble, frag)
-           for frag in fragments)
-
-    # Compile every fragment.
-    msg = 'Compiling {} fragments in {} processes: '
-    msg = msg.format(len(fragments), config.num_processes)
-    print(msg, end='', flush=True)
-    if config.num_processes == 1:
-        # Run compilation in this very thread.
-        for desc in gen:
-            compileFragmentToImage(desc)
-    else:
-        # Push the compilation tasks into the available process pool.
-        with multiprocessing.Pool(config.num_processes) as pool:
-            if config.verbose:
-                pool.map(compileFragmentToImage, gen)
-            else:
-                t0 = time.time()
-                tot = len(fragments)
-                proc = pool.imap_unordered(compileFragmentToImage, gen)
-                for cnt, _ in enumerate(proc):
-                    # Delete the previous percentage value and replace
-                    # it with the new one.
-                    per = '{}%'.format(int(100 * cnt / tot))
-                    print('\r' + msg + per, end='', flush=True)
-                print('\r' + msg + 'ok ({}s)'.format(int(time.time() - t0)))
-                del t0, tot, per
-    del gen
+    # Evict old images from the cache.
+    pruneFragmentCache()
 
     # Remove auxiliary build directory.
     if os.path.exists(path.d_build) and not config.keep_builddir:
         shutil.rmtree(path.d_build)
 
-    # -------------------------------------------------------------------------
-    # The HTML code already contains the image tags and file names, but without
-    # extensions (ie. no '.png' or '.svg'). Rectify.
-    # -------------------------------------------------------------------------
+    # Only the first fragment with any given hash has an image.
+    unique = collections.OrderedDict()
     for frag in fragments:
+        unique.setdefault(frag['hash'], frag)
+
+    images = {}
+    for frag in unique.values():
         # Determine image file name without extension.
         placeholder = frag['placeholder']
         fname_ph = os.path.join(path.d_html, placeholder)
@@ -1753,13 +3809,54 @@ def processFragments(preamble, html, fragments, path):
         else:
             print('Error: could not find fragment <{}>'.format(fname_ph))
             continue
-
-        # Replace the original image name with the same one plus the correct
-        # image format extension (eg. 'png' or 'svg').
-        html = html.replace(placeholder, placeholder + ext)
+        images[frag['hash']] = placeholder + ext
+    images = {frag['placeholder']: images[frag['hash']]
+              for frag in fragments if frag['hash'] in images}
+    for frag in fragments:
+        style = imageStyle(metrics.get(frag['hash']))
+        images[frag['placeholder'] + '-style'] = style
+
+    # Replace all placeholders in a single pass. Try longer placeholders first
+    # in case one is a prefix of another.
+    if len(images) > 0:
+        pat = sorted(images, key=len, reverse=True)
+        pat = re.compile('|'.join(re.escape(_) for _ in pat))
+        html = pat.sub(lambda m: images[m.group()], html)
     return html
 
 
+def processFragments(preamble, html, fragments, path):
+    """
+    Convert all ``fragments`` to SVG images and update ``html``.
+
+    Every element in ``fragments`` contains a self contained LaTeX fragment,
+    save the common ``preamble``. Those fragments were created in
+    :func:`createFragmentDescriptor`.
+
+    This is the synchronous counterpart of :func:`compileFragments` followed
+    by :func:`insertFragmentImages` for a complete list of fragments.
+    Fragments with identical LaTeX code, counters and options (ie. identical
+    :func:`fragmentHash`) are compiled only once, and their <img> tags all
+    refer to the same image.
+
+    :param *str* preamble: LaTeX preamble. Used to compile all fragments.
+    :param *str* html: HTML code. Images are without suffix (eg. no '.svg').
+    :param *list* fragments: Contains self contained LaTeX code fragments.
+    :param *tuple* path: the usual set of path names.
+    :rtype *str*:
+    :return: ``html`` string with correct image extension in <img> tags.
+    """
+    async def run():
+        incoming = asyncio.Queue()
+        for frag in fragments:
+            incoming.put_nowait(frag)
+        incoming.put_nowait(None)
+        return await compileFragments(preamble, incoming, path)
+
+    metrics = asyncio.run(run())
+    return insertFragmentImages(html, fragments, metrics, path)
+
+
 # ----------------------------------------------------------------------------
 #                            Prepare LaTeX Code
 # ----------------------------------------------------------------------------
@@ -1977,9 +4074,16 @@ def findLaTeXMetaInfo(preamble):
     return title, author
 
 
-def compileWithCounters(preamble, body, path_names):
+class DocumentError(Exception):
+    """
+    The LaTeX document does not compile.
+    """
+    pass
+
+
+async def compileWithCounters(preamble, body, path_names):
     """
-    Return LaTeX counter values at various positions in source file ``body``.
+    Compile the document and return its LaTeX counter values.
 
     Nobby uses the LaTeX package 'newfile' to create an additional .nobby file
     during the compilation and populate it with counter values. The counter
@@ -1987,6 +4091,14 @@ def compileWithCounters(preamble, body, path_names):
     ``config.counter_dump_envs``. By default, these are all the standard
     environments like 'align', 'figure', ...
 
+    This "salted" document is the only compilation of the entire document.
+    It has the same job name as the original document, which is why it also
+    produces the PDF file, and the auxiliary files (eg. for references) in
+    the build directory. If it does not compile, this function compiles the
+    original document to determine whether the document itself or Nobby's
+    salt is to blame, and then raises :class:`DocumentError`. Use
+    `asyncio.run` to call this function outside an event loop.
+
     After the compilation this function parses the .nobby file into a list of
     named tuples, each of which specifies the position in the ``body`` and the
     counter values at that point.
@@ -1998,9 +4110,12 @@ def compileWithCounters(preamble, body, path_names):
 
     :param *str* preamble: document preamble.
     :param *str* body: document body
-    :rtype list:
-    :return: list of named tuples. Each tuple notes the position in ``body``
-      and holds a list of all counter values.
+    :param *tuple* path_names: the usual set of path names.
+    :rtype tuple:
+    :return: (tex_output, counters). The ``tex_output`` contains the output
+      files of LaTeX (see :func:`runPDFLaTeX`), and ``counters`` is a list of
+      named tuples. Each tuple notes the position in ``body`` and holds a
+      list of all counter values.
     """
 
     # ----------------------------------------------------------------------
@@ -2050,19 +4165,31 @@ def compileWithCounters(preamble, body, path_names):
     f_salted = '_nobby_counterdumps_' + path_names.f_tex
     p_salted = os.path.join(path_names.d_base, f_salted)
 
+    jobname = os.path.splitext(path_names.f_tex)[0]
+
     tex = preamble + '\n\\begin{document}\n' + body
     tex += '\n\n\\closeoutputstream{nobby}\n\\end{document}\n'
     open(p_salted, 'w').write(tex)
     del tex
     try:
-        runPDFLaTeX(build_dir, p_salted)
+        tex_out = await runPDFLaTeX(build_dir, p_salted, jobname=jobname)
     except (subprocess.CalledProcessError, FileNotFoundError,
             AssertionError) as e:
-        errmsg = ('Error: the salted document <{}> does not compile. This '
-                  'is probably a bug - Abort.')
-        print(errmsg.format(p_salted))
+        os.remove(p_salted)
+
+        # Blame the salt only if the original document compiles.
+        try:
+            await runPDFLaTeX(build_dir, path_names.f_source)
+            errmsg = ('Error: the salted document <{}> does not compile. '
+                      'This is probably a bug - Abort.')
+            print(errmsg.format(p_salted))
+        except (subprocess.CalledProcessError, FileNotFoundError,
+                AssertionError):
+            errmsg = ('Error: the original document <{}> does not compile '
+                      '- Abort.')
+            print(errmsg.format(path_names.f_source))
         print(e)
-        sys.exit(1)
+        raise DocumentError(path_names.f_source)
 
     # ----------------------------------------------------------------------
     # Parse the foo.nobby file. Each line has the same format, eg.
@@ -2073,10 +4200,8 @@ def compileWithCounters(preamble, body, path_names):
     # remaining entries are a ``sep`` separated list of counter- name and
     # value. The following code parses these lines into a list of named tuples.
     # ----------------------------------------------------------------------
-    fname = os.path.join(build_dir, f_salted[:-3]) + 'nobby'
-    NTCounter = collections.namedtuple('NTCounter', 'start stop counters')
     counters = []
-    for line in open(fname, 'r').readlines():
+    for line in (tex_out.nobby or '').splitlines():
         # Ignore empty lines.
         line = line.strip()
         if line == '':
@@ -2098,44 +4223,665 @@ def compileWithCounters(preamble, body, path_names):
 
     # Remove the temporary tex file.
     os.remove(p_salted)
-    return counters
+    return tex_out, counters
+
+
+def counterCacheFiles(path_names):
+    """
+    Return the names of the (data, PDF) files in the counter cache.
+
+    The counter cache holds one entry per document, named after a hash of the
+    absolute path of its source file, and every run replaces it. Return
+    **None** if the fragment cache (and thus the counter cache) is disabled.
+
+    :param *tuple* path_names: the usual set of path names.
+    :rtype: (**str**, **str**)
+    """
+    if config.cache_dir is None:
+        return None
+    data = ('nobby-counters-1', os.path.abspath(path_names.f_source))
+    key = hashlib.sha256(repr(data).encode('utf8')).hexdigest()
+    fname = os.path.join(config.cache_dir, 'documents', key)
+    return fname + '.json', fname + '.pdf'
+
+
+def counterCacheOptions():
+    """
+    Return the options that affect the compilation with counter dumps.
+    """
+    return repr(('nobby-counters-1', config.counter_dump_envs,
+                 config.counter_dump_macros, config.counter_names,
+                 config.num_compile_iter, config.use_latexmk))
+
+
+def recordedInputs(fls, path_names):
+    """
+    Return the files in the LaTeX recorder output ``fls`` with their state.
+
+    The state is the (mtime, size) of the file. This excludes the source file
+    itself, all files in the build directory, and files that no longer exist
+    (eg. the salted document of :func:`compileWithCounters`).
+
+    :param *str* fls: content of the .fls file (see :func:`runPDFLaTeX`).
+    :param *tuple* path_names: the usual set of path names.
+    :return: {file name: [mtime, size]}
+    :rtype: **dict**
+    """
+    d_build = os.path.abspath(path_names.d_build) + os.sep
+    f_source = os.path.abspath(path_names.f_source)
+    out = {}
+    for line in (fls or '').splitlines():
+        if not line.startswith('INPUT '):
+            continue
+        fname = os.path.join(path_names.d_base, line[6:])
+        fname = os.path.abspath(fname)
+        if fname == f_source or fname.startswith(d_build) or fname in out:
+            continue
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        out[fname] = [st.st_mtime_ns, st.st_size]
+    return out
+
+
+def storeCachedCounters(preamble, body, path_names, tex_out, counters):
+    """
+    Add the ``counters`` and the ``tex_out`` of the document to the cache.
+
+    The entry also records the ``preamble``, the ``body``, the options that
+    affect the counter dumps, and the state of every file that LaTeX read
+    (eg. included chapters, see :func:`recordedInputs`). The compiled PDF goes
+    into a file of its own. This function does nothing if the fragment cache
+    is disabled, or if some output of LaTeX is not valid UTF8.
+
+    :param *str* preamble: document preamble.
+    :param *str* body: document body.
+    :param *tuple* path_names: the usual set of path names.
+    :param *tuple* tex_out: LaTeX output files (see :func:`runPDFLaTeX`).
+    :param *list* counters: counter values (see :func:`compileWithCounters`).
+    :return: **None**
+    """
+    fnames = counterCacheFiles(path_names)
+    if fnames is None or any(isinstance(_, bytes) for _ in tex_out):
+        return
+    fname_data, fname_pdf = fnames
+    os.makedirs(os.path.dirname(fname_data), exist_ok=True)
+
+    # Copy the PDF first, because the data file is what makes the entry valid.
+    # Like the fragment cache, write temporary files and rename them.
+    src = os.path.join(path_names.d_build, path_names.f_tex[:-3] + 'pdf')
+    fname_tmp = '{}.{}.tmp'.format(fname_pdf, os.getpid())
+    try:
+        shutil.copyfile(src, fname_tmp)
+    except FileNotFoundError:
+        return
+    os.replace(fname_tmp, fname_pdf)
+
+    data = {
+        'options': counterCacheOptions(),
+        'preamble': preamble,
+        'body': body,
+        'inputs': recordedInputs(tex_out.fls, path_names),
+        'tex_output': tex_out._asdict(),
+        'counters': [list(_) for _ in counters],
+    }
+    fname_tmp = '{}.{}.tmp'.format(fname_data, os.getpid())
+    json.dump(data, open(fname_tmp, 'w'))
+    os.replace(fname_tmp, fname_data)
+
+
+def findCachedCounters(preamble, body, path_names):
+    """
+    Return the cached LaTeX output and counter values of the document.
+
+    The cache entry (see :func:`storeCachedCounters`) is only valid if the
+    ``preamble``, the relevant options, and all files LaTeX read are still
+    the same. If the ``body`` changed as well then this function remaps the
+    counter positions to the new body (see :func:`remapCounters`), provided
+    the edits cannot have affected any counter.
+
+    Return **None** if the cache is disabled or invalid, or if the user
+    requested a rebuild.
+
+    :param *str* preamble: document preamble.
+    :param *str* body: document body.
+    :param *tuple* path_names: the usual set of path names.
+    :rtype: tuple
+    :return: (tex_out, counters, fname_pdf). The ``fname_pdf`` is the cached
+        PDF file if the ``body`` is unchanged, and **None** otherwise.
+    """
+    fnames = counterCacheFiles(path_names)
+    if fnames is None or not config.skip_existing_fragments:
+        return None
+    fname_data, fname_pdf = fnames
+    try:
+        data = json.load(open(fname_data, 'r'))
+    except (FileNotFoundError, ValueError):
+        return None
+    if data.get('options') != counterCacheOptions():
+        return None
+    if data['preamble'] != preamble or not os.path.exists(fname_pdf):
+        return None
+
+    # Every file LaTeX read must still be the same.
+    for fname, state in data['inputs'].items():
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        if [st.st_mtime_ns, st.st_size] != state:
+            return None
+
+    tex_out = TexOut(**data['tex_output'])
+    counters = [NTCounter(*_) for _ in data['counters']]
+    if data['body'] == body:
+        os.utime(fname_data)
+        os.utime(fname_pdf)
+        return tex_out, counters, fname_pdf
+
+    counters = remapCounters(data['body'], body, counters)
+    if counters is None:
+        return None
+    return tex_out, counters, None
+
+
+def remapCounters(old, new, counters):
+    """
+    Return the ``counters`` of body ``old`` with their positions in ``new``.
+
+    The positions of the counter dumps (see :func:`compileWithCounters`) are
+    offsets into the body, which is why every edit shifts all subsequent
+    ones. This function determines the edits with a line-by-line diff of the
+    two bodies, followed by a character diff of the changed lines.
+
+    Return **None** if an edit may have changed a counter value. This is
+    the case if the edit overlaps a counter dump, or if the edit, extended to
+    the words it touches and their neighbouring characters, contains any
+    character that is special to LaTeX (eg. '\\', '$', '{' or '%'). Edits of
+    plain text, like the fix of a typo, thus retain all counters.
+
+    Example:
+
+    .. inline-python::
+
+        import nobby
+        cnt = [nobby.NTCounter(10, 26, {'equation': '0'})]
+        print(nobby.remapCounters(r'Some txet \\begin{equation}',
+                                  r'Some text here \\begin{equation}', cnt))
+        print(nobby.remapCounters(r'Some text \\begin{equation}',
+                                  r'Some \\emph{text} \\begin{equation}',
+                                  cnt))
+
+    :param *str* old: body the ``counters`` belong to.
+    :param *str* new: new body.
+    :param *list* counters: counter values (see :func:`compileWithCounters`).
+    :return: remapped counters or **None**.
+    :rtype: **list**
+    """
+    def offsets(lines):
+        out = [0]
+        for line in lines:
+            out.append(out[-1] + len(line))
+        return out
+
+    # Find the changed lines first, and then the changed characters within
+    # those lines. This is much faster than a character diff of the entire
+    # body. Every edit is an (old start, old stop, new start, new stop) tuple.
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    old_ofs, new_ofs = offsets(old_lines), offsets(new_lines)
+    sm = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    edits = []
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == 'equal':
+            continue
+        a, b = old_ofs[i1], new_ofs[j1]
+        sub = difflib.SequenceMatcher(None, old[a:old_ofs[i2]],
+                                      new[b:new_ofs[j2]], autojunk=False)
+        for tag, k1, k2, l1, l2 in sub.get_opcodes():
+            if tag != 'equal':
+                edits.append((a + k1, a + k2, b + l1, b + l2))
+    del old_lines, new_lines, old_ofs, new_ofs, sm
+
+    def isPlain(text, start, stop):
+        # Extend the edit to the words it touches, plus one character on
+        # either side. This catches edits of macro and environment names.
+        while start > 0 and text[start - 1].isalpha():
+            start -= 1
+        while stop < len(text) and text[stop].isalpha():
+            stop += 1
+        start, stop = max(0, start - 1), min(len(text), stop + 1)
+        return re.search(r'[\\$%{}&#^_~\[\]]', text[start:stop]) is None
+
+    for k1, k2, l1, l2 in edits:
+        if not (isPlain(old, k1, k2) and isPlain(new, l1, l2)):
+            return None
+
+    # Shift every counter dump by the length difference of all edits before
+    # it. Edits inside a counter dump invalidate it.
+    out = []
+    for nt in counters:
+        shift = 0
+        for k1, k2, l1, l2 in edits:
+            if k2 <= nt.start:
+                shift += (l2 - l1) - (k2 - k1)
+            elif k1 < nt.stop:
+                return None
+        out.append(NTCounter(nt.start + shift, nt.stop + shift, nt.counters))
+    return out
+
+
+async def compileOriginal(path_names):
+    """
+    Compile the original document.
+
+    Nobby only compiles the unsalted document if it took the counter values
+    from the cache (see :func:`findCachedCounters`) but still needs the PDF.
+
+    :param *tuple* path_names: the usual set of path names.
+    :return: LaTeX output files (see :func:`runPDFLaTeX`).
+    :raises DocumentError: if the document does not compile.
+    """
+    try:
+        return await runPDFLaTeX(path_names.d_build, path_names.f_source)
+    except (subprocess.CalledProcessError, FileNotFoundError,
+            AssertionError) as e:
+        errmsg = 'Error: the original document <{}> does not compile - Abort.'
+        print(errmsg.format(path_names.f_source))
+        print(e)
+        raise DocumentError(path_names.f_source)
+
+
+# ----------------------------------------------------------------------------
+#                               Miscellaneous
+# ----------------------------------------------------------------------------
+
+class Profile():
+    """
+    Wall- and CPU times of the conversion stages and the external programs.
+
+    Every stage (eg. 'build tree') records its wall time and the CPU time of
+    the thread it ran in (see :func:`profileStage`). The stages overlap (see
+    :func:`convertDocument`), and the stages in the event loop also account
+    for the CPU time of the concurrent coroutines. Every external program
+    and expensive function records the wall time of each run (see
+    :func:`profileTool`).
+
+    All of them, and the fragments of every task and TeX worker (see
+    :func:`profileSpan`), are also spans of the trace (see
+    :meth:`writeTrace`).
+    """
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.children0 = self.childrenTime()
+
+        # {name: [count, wall, cpu]} and {name: [wall, ...]}.
+        self.stages = collections.OrderedDict()
+        self.tools = collections.OrderedDict()
+
+        # (name, category, track, start, wall, args) of all trace spans.
+        self.spans = []
+
+    @staticmethod
+    def childrenTime():
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def addStage(self, name, start, wall, cpu):
+        stage = self.stages.setdefault(name, [0, 0, 0])
+        stage[0] += 1
+        stage[1] += wall
+        stage[2] += cpu
+        self.addSpan(name, 'stage', 'stage: ' + name, start, wall)
+
+    def addTool(self, name, start, wall, args=None):
+        self.tools.setdefault(name, []).append(wall)
+        self.addSpan(name, 'tool', trace_track.get(), start, wall, args)
+
+    def addSpan(self, name, cat, track, start, wall, args=None):
+        self.spans.append((name, cat, track, start - self.t0, wall, args))
+
+    def writeTrace(self, fname):
+        """
+        Write all spans to ``fname`` in the Chrome trace event format.
+
+        The stages each have a track of their own, and a marker across all
+        tracks where they begin. Every task runner and TeX worker of every
+        document has its own track as well, which shows its fragments and
+        the external programs within them. Chrome (chrome://tracing) and
+        Perfetto (ui.perfetto.dev) display the file.
+
+        :param *str* fname: output file.
+        :return: **None**
+        """
+        # The tracks are threads of a single process in the trace. The
+        # stages come first, in the order they started, followed by the
+        # tracks of every document (eg. 'doc.tex: TeX worker 2').
+        first = {}
+        for name, cat, track, start, wall, args in self.spans:
+            first[track] = min(first.get(track, start), start)
+
+        def order(track):
+            if track.startswith('stage: '):
+                return (0, first[track])
+            return (1, [int(_) if _.isdigit() else _
+                        for _ in re.split(r'(\d+)', track)])
+        tracks = sorted(first, key=order)
+        tids = {track: tid + 1 for tid, track in enumerate(tracks)}
+        events = []
+        for track, tid in tids.items():
+            events.append({'ph': 'M', 'pid': 1, 'tid': tid,
+                           'name': 'thread_name', 'args': {'name': track}})
+            events.append({'ph': 'M', 'pid': 1, 'tid': tid,
+                           'name': 'thread_sort_index',
+                           'args': {'sort_index': tid}})
+        for name, cat, track, start, wall, args in self.spans:
+            event = {'ph': 'X', 'pid': 1, 'tid': tids[track], 'name': name,
+                     'cat': cat, 'ts': round(start * 1E6, 1),
+                     'dur': round(wall * 1E6, 1)}
+            if args is not None:
+                event['args'] = args
+            events.append(event)
+            if cat == 'stage':
+                events.append({'ph': 'i', 's': 'g', 'pid': 1,
+                               'tid': tids[track], 'name': name,
+                               'cat': cat, 'ts': event['ts']})
+
+        fname_tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        out = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        open(fname_tmp, 'w').write(json.dumps(out))
+        os.replace(fname_tmp, fname)
+
+    def report(self):
+        """
+        Return the stages and tools in a human readable table.
+
+        The percentiles are those of the individual runs of each tool.
+        """
+        def percentile(times, q):
+            return times[int(round(q * (len(times) - 1)))]
+
+        out = ['Profile:', '  {:25s} {:>5s} {:>9s} {:>9s}'.format(
+            'Stage', 'Count', 'Wall', 'CPU')]
+        for name, (cnt, wall, cpu) in self.stages.items():
+            out.append('  {:25s} {:5d} {:8.2f}s {:8.2f}s'.format(
+                name, cnt, wall, cpu))
+
+        out.append('  {:25s} {:>5s} {:>9s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+            'Tool', 'Count', 'Total', 'p50', 'p90', 'p99', 'Max'))
+        for name, times in self.tools.items():
+            times = sorted(times)
+            out.append(
+                '  {:25s} {:5d} {:8.2f}s {:7.3f}s {:7.3f}s {:7.3f}s '
+                '{:7.3f}s'.format(name, len(times), sum(times),
+                                  percentile(times, 0.5),
+                                  percentile(times, 0.9),
+                                  percentile(times, 0.99), times[-1]))
+
+        out.append('  Total: {:.2f}s wall, {:.2f}s CPU in Nobby, {:.2f}s CPU '
+                   'in external programs'.format(
+                       time.perf_counter() - self.t0,
+                       time.process_time() - self.cpu0,
+                       self.childrenTime() - self.children0))
+        return '\n'.join(out)
+
+
+@contextlib.contextmanager
+def profileStage(name):
+    """
+    Record the wall- and thread CPU time of the stage ``name`` (see
+    :class:`Profile`), if the user asked for it with --profile.
+    """
+    if profiler is None:
+        yield
+        return
+    t0, cpu0 = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        profiler.addStage(name, t0, time.perf_counter() - t0,
+                          time.thread_time() - cpu0)
+
+
+@contextlib.contextmanager
+def profileTool(name, args=None):
+    """
+    Record the wall time of a single run of the tool ``name`` (see
+    :class:`Profile`), if the user asked for it with --profile.
+
+    The optional ``args`` dictionary appears with the span in the trace.
+
+    The time also counts towards the fragments of the current task (see
+    ``charged_fragments``). Every fragment records the time of each tool in
+    ``frag['tools']`` (see :func:`reportSlowestFragments`).
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        frags = charged_fragments.get()
+        for frag in frags:
+            tools = frag.setdefault('tools', {})
+            tools[name] = tools.get(name, 0) + wall / len(frags)
+        if profiler is not None:
+            profiler.addTool(name, t0, wall, args)
+
+
+@contextlib.contextmanager
+def profileSpan(name, args=None):
+    """
+    Record a trace span ``name`` on the current track (see :class:`Profile`),
+    if the user asked for it with --trace.
+
+    Unlike :func:`profileTool`, the span does not appear in the report.
+    """
+    if profiler is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.addSpan(name, 'fragment', trace_track.get(), t0,
+                         time.perf_counter() - t0, args)
+
+
+def startProfile():
+    """
+    Start a new profile if the user asked for one with --profile or --trace.
+    """
+    global profiler
+    if config.profile or config.trace is not None:
+        profiler = Profile()
+    else:
+        profiler = None
+
+
+def finishProfile():
+    """
+    Print the profile and write the trace, as requested by the user.
+    """
+    if profiler is None:
+        return
+    if config.profile:
+        print(profiler.report())
+    if config.trace is not None:
+        profiler.writeTrace(config.trace)
+        print('Trace: <{}>'.format(config.trace))
+
+
+async def profileCoroutine(name, coro):
+    """
+    Await ``coro`` as the stage ``name`` (see :func:`profileStage`).
+    """
+    with profileStage(name):
+        return await coro
+
+
+class LineIndex():
+    """
+    Map positions in the document body to line numbers in the LaTeX file.
+
+    The spans of all tree nodes and fragments refer to the body (see
+    :func:`splitLaTeXDocument`), not to the ``source`` file. The index
+    records where the body starts in the file and where its lines start, and
+    then finds the line of any position with a binary search.
+
+    Example:
+
+    .. inline-python::
+
+        import nobby
+        source = ('preamble\\n\\\\begin{document}\\n'
+                  '  a\\nb $x$\\n\\\\end{document}')
+        body = 'a\\nb $x$'
+        index = nobby.LineIndex(source, body)
+        print(index.line(body.index('$')))
+    """
+    def __init__(self, source, body):
+        m = re.search(r'\\begin *{document}', source)
+        start = source.find(body, 0 if m is None else m.end())
+        self.first = source.count('\n', 0, max(0, start)) + 1
+        self.newlines = [_.start() for _ in re.finditer('\n', body)]
+
+    def line(self, pos):
+        """
+        Return the line number (starting at 1) of position ``pos`` in the
+        body.
+        """
+        return self.first + bisect.bisect_left(self.newlines, pos)
 
 
-# ----------------------------------------------------------------------------
-#                               Miscellaneous
-# ----------------------------------------------------------------------------
+def reportSlowestFragments(fragments, index, num):
+    """
+    Return a table of the ``num`` fragments that took longest to compile.
+
+    Every row shows the source line of the fragment (see :class:`LineIndex`),
+    the name of its node (eg. 'tikzpicture'), the length of its LaTeX code,
+    its total time, and the time of every tool (see :func:`profileTool`).
+    Fragments that appear several times in the document compiled only once,
+    which is why their row also shows how often they appear. Fragments from
+    the cache took no time and do not appear at all.
+
+    :param *list* fragments: all fragments of the document.
+    :param *LineIndex* index: line index of the document.
+    :param *int* num: number of fragments to report.
+    :return: the report.
+    :rtype: **str**
+    """
+    uses = collections.Counter(_['hash'] for _ in fragments)
+    timed = [_ for _ in fragments if 'seconds' in _]
+    timed.sort(key=lambda _: _['seconds'], reverse=True)
+    if len(timed) == 0:
+        return 'Slowest fragments: none compiled'
+
+    out = ['Slowest fragments:']
+    out.append('  {:>6s} {:15s} {:>6s} {:>4s} {:>8s}  {}'.format(
+        'Line', 'Node', 'Length', 'Uses', 'Time', 'Tools'))
+    for frag in timed[:num]:
+        tools = sorted(frag.get('tools', {}).items(), key=lambda _: -_[1])
+        tools = ', '.join('{} {:.2f}s'.format(*_) for _ in tools)
+        out.append('  {:6d} {:15s} {:6d} {:4d} {:7.2f}s  {}'.format(
+            index.line(frag['span'][0]), str(frag['node']), len(frag['tex']),
+            uses[frag['hash']], frag['seconds'], tools))
+    return '\n'.join(out)
+
+
+def requiredTools():
+    """
+    Return the external programs that the current settings require.
+
+    The 'pdf' backend converts fragments with the Poppler tools and
+    `pdf2svg`, whereas the 'dvi' backend only needs `dvisvgm`.
+
+    :return: program names.
+    :rtype: **list**
+    """
+    tools = ['pdflatex']
+    if config.use_latexmk:
+        tools.append('latexmk')
+    if config.backend == 'dvi':
+        tools.append('dvisvgm')
+    else:
+        tools += ['pdf2svg', 'pdftoppm', 'pdfseparate']
+    return tools
+
+
+def findTools(tools):
+    """
+    Return the location and version of all programs in ``tools``.
+
+    Querying the version of a program means starting it, which takes a
+    noticeable amount of time for TeX in particular. This function therefore
+    records the results in the cache (if it is enabled), and queries a
+    program again only if ``PATH`` changed, or if the program it finds is a
+    different file, or was modified since.
+
+    :param *list* tools: program names.
+    :return: {name: (absolute file name, version)}. The version is the first
+        line the program prints, or an empty string.
+    :rtype: **dict**
+    :raises FileNotFoundError: if a program is missing.
+    """
+    # Load the results of previous runs, unless PATH has changed since.
+    if config.cache_dir is None:
+        fname_cache = None
+    else:
+        fname_cache = os.path.join(config.cache_dir, 'tools.json')
+    path = os.environ.get('PATH', '')
+    try:
+        cache = json.loads(open(fname_cache, 'r').read())
+        assert cache['PATH'] == path
+    except (TypeError, OSError, ValueError, KeyError, AssertionError):
+        cache = {'PATH': path, 'tools': {}}
+
+    out, modified = {}, False
+    for tool in tools:
+        fname = shutil.which(tool)
+        if fname is None:
+            raise FileNotFoundError('Missing <{}>'.format(tool))
+        st = os.stat(fname)
+        entry = cache['tools'].get(tool)
+        state = [fname, st.st_mtime_ns, st.st_size]
+        if entry is None or entry[:3] != state:
+            # Not all programs support a version option, and some print
+            # their version to stderr.
+            args = tool_version_args.get(tool, ('--version', ))
+            ret = subprocess.run((fname, ) + args, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            lines = ret.stdout.decode('utf8', 'replace').strip().splitlines()
+            entry = state + [lines[0].strip() if len(lines) > 0 else '']
+            cache['tools'][tool] = entry
+            modified = True
+            del args, ret, lines
+        out[tool] = (entry[0], entry[3])
+
+    if modified and fname_cache is not None:
+        os.makedirs(config.cache_dir, exist_ok=True)
+        fname_tmp = '{}.{}.tmp'.format(fname_cache, os.getpid())
+        open(fname_tmp, 'w').write(json.dumps(cache))
+        os.replace(fname_tmp, fname_cache)
+    return out
+
 
 def checkDependencies():
     """
-    Check that all required programs are installed.
-    """
-    def run(cmd):
-        """
-        Convenience function. It simply runs ``cmd`` and prints error messages,
-        should there by any.
-        """
-        dn = subprocess.DEVNULL
-        try:
-            subprocess.call(cmd, stdout=dn, stderr=dn)
-            out = True
-        except subprocess.CalledProcessError as e:
-            # Process return with non-zero error code.
-            out = False
-        except FileNotFoundError as e:
-            # Specified program does not exist in the path on this computer.
-            out = False
-            print('Missing <{}>'.format(cmd))
-
-        # Abort immediately if an error has occurred.
-        if not out:
-            sys.exit(1)
+    Check that all programs the current settings require are installed.
+
+    Print the missing program and quit if there is one.
 
-    # The programs required by Nobby.
-    run('pdfinfo')
-    run('pdf2svg')
-    run('pdfcrop')
-    run(('convert', '-version'))
-    run(('pdflatex', '--version'))
+    :return: location and version of all programs (see :func:`findTools`).
+    :rtype: **dict**
+    """
+    try:
+        return findTools(requiredTools())
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
 
 
 def createHTMLMetaInfo(title, author):
@@ -2153,6 +4899,18 @@ def createHTMLMetaInfo(title, author):
     return out
 
 
+def launchBrowser(fname_html):
+    """
+    Open ``fname_html`` in a new tab of the default web browser.
+
+    :param *str* fname_html: HTML file.
+    :return: **None**
+    """
+    import webbrowser
+    wb = webbrowser.get(None)
+    wb.open(fname_html, new=2, autoraise=True)
+
+
 def parseCmdline():
     """
     Parse the command line arguments.
@@ -2170,7 +4928,12 @@ def parseCmdline():
 
     # Add the command line options.
     padd('--rebuild', '-r', action='store_true',
-         help='Rebuild all fragments images')
+         help='Rebuild all fragments images (ignore the fragment cache)')
+    padd('--cache-dir', type=str, default=config.cache_dir, metavar='dir',
+         help='Fragment cache directory (default: {})'.format(
+             config.cache_dir))
+    padd('--no-cache', action='store_true',
+         help='Do not use the fragment cache')
     padd('--scale', '-s', type=float, metavar='S', default=config.pdf_scale,
          help='Scale all images by a factor of "S" (a float, S>0)')
     padd('--textwidth', type=float, metavar='W',
@@ -2189,7 +4952,18 @@ def parseCmdline():
          help='Use latexmk to determine number of compilations (slower)')
     padd('-j', type=int, default=config.num_processes,
          metavar='N', help='Number of concurrent compilation processes')
-    padd('-o', type=str, default=None,
+    padd('--adaptive', action='store_true',
+         default=config.adaptive_concurrency,
+         help='Adapt the number of concurrent processes to the system load')
+    padd('--batch-size', type=int, default=config.max_batch_size,
+         metavar='N', help='Compile at most N fragments per pdfLaTeX run')
+    padd('--no-fmt', action='store_true',
+         help='Do not precompile the preamble into a pdfLaTeX format')
+    padd('--no-workers', action='store_true',
+         help='Do not typeset fragments with long-lived pdfLaTeX processes')
+    padd('--backend', choices=('pdf', 'dvi'), default=config.backend,
+         help='Convert fragments via PDF + pdf2svg or DVI + dvisvgm')
+    padd('-o', type=str, default=config.html_dir,
          metavar='dir', help='HTML output directory')
     padd('-v', action='store_true', default=config.verbose,
          help='Verbose')
@@ -2197,29 +4971,61 @@ def parseCmdline():
          help='More Verbose')
     padd('-w', action='store_true', default=False,
          help='Open HTML file in browser')
-    padd('file', help='LaTeX file')
+    padd('--profile', action='store_true', default=config.profile,
+         help='Report the time of every stage and external program')
+    padd('--trace', type=str, default=config.trace, metavar='file',
+         help='Write a timeline of the run to a Chrome trace file')
+    padd('--slowest', type=int, default=config.slowest_fragments,
+         metavar='N', help='Report the N fragments that took longest')
+    padd('--watch', action='store_true', default=config.watch,
+         help='Convert the file again whenever it changes')
+    padd('--daemon', action='store_true', default=config.daemon,
+         help='Run a daemon that converts files on behalf of other Nobby '
+         'processes')
+    padd('--daemon-status', action='store_true',
+         help='Show the recent jobs of the daemon')
+    padd('--no-daemon', action='store_true',
+         help='Do not convert the file with a running daemon')
+    padd('file', nargs='*',
+         help='LaTeX files, or directories with LaTeX files')
 
     # Let argparse parse the command line.
     args = parser.parse_args()
 
     # Add the command line options to the global ``config`` module.
     config.skip_existing_fragments = not args.rebuild
-    config.pdf_scale = args.scale
-    config.textwidth_addon = args.textwidth
+    config.cache_dir = None if args.no_cache else args.cache_dir
+    config.pdf_scale = float(args.scale)
+    config.textwidth_addon = float(args.textwidth)
     config.max_svg_size = args.max_svg_size
     config.show_unconverted_envs = not args.no_env_warning
     config.keep_builddir = args.keep_build_dir
     config.num_processes = args.j
+    config.max_batch_size = args.batch_size
+    config.use_preamble_format = not args.no_fmt
+    config.use_tex_workers = not args.no_workers
+    config.adaptive_concurrency = args.adaptive
+    config.backend = args.backend
     config.verbose = args.v
     config.errtex_showfull = args.vv
     config.html_dir = args.o
     config.num_compile_iter = args.num_compile
     config.use_latexmk = args.use_latexmk
+    config.watch = args.watch
+    config.profile = args.profile
+    config.trace = args.trace
+    config.slowest_fragments = args.slowest
+    config.daemon = args.daemon
+    config.daemon_status = args.daemon_status
+    config.use_daemon = not args.no_daemon
 
     # Sanity check.
     if args.num_compile < 1:
         print('--num-compile must be a positive integer')
         sys.exit(1)
+    if args.batch_size < 1:
+        print('--batch-size must be a positive integer')
+        sys.exit(1)
 
     if args.vv:
         config.verbose = True
@@ -2227,12 +5033,57 @@ def parseCmdline():
     if args.w:
         config.launch_browser = True
 
-    # Quit the program if the input file does not exist.
-    fname = args.file
-    if not os.path.exists(fname):
-        print('File not found: {}'.format(fname))
+    # The daemon has no input file of its own.
+    if args.daemon or args.daemon_status:
+        return []
+
+    # Quit the program if an input file does not exist.
+    if len(args.file) == 0:
+        parser.error('the following arguments are required: file')
+    for fname in args.file:
+        if not os.path.exists(fname):
+            print('File not found: {}'.format(fname))
+            sys.exit(1)
+    fnames = findLaTeXFiles(args.file)
+    if len(fnames) == 0:
+        print('No LaTeX files found')
+        sys.exit(1)
+
+    # The images of different documents would overwrite each other in the
+    # same HTML directory.
+    if len(fnames) > 1 and config.html_dir is not None:
+        print('-o requires a single LaTeX file')
         sys.exit(1)
-    return fname
+    if len(fnames) > 1 and config.watch:
+        print('--watch requires a single LaTeX file')
+        sys.exit(1)
+    return fnames
+
+
+def findLaTeXFiles(names):
+    """
+    Return the LaTeX files in ``names``.
+
+    ``names`` contains files and directories. This function replaces every
+    directory with its LaTeX documents, ie. the files that end in '.tex' and
+    contain '\\begin{document}' (as opposed to files for '\\input').
+
+    :param *list* names: file- and directory names.
+    :return: LaTeX files.
+    :rtype: **list**
+    """
+    fnames = []
+    for name in names:
+        if not os.path.isdir(name):
+            fnames.append(name)
+            continue
+        for fname in sorted(os.listdir(name)):
+            fname = os.path.join(name, fname)
+            if not fname.endswith('.tex') or not os.path.isfile(fname):
+                continue
+            if '\\begin{document}' in open(fname, 'r').read():
+                fnames.append(fname)
+    return fnames
 
 
 def definePathNames(fname_source):
@@ -2274,34 +5125,652 @@ def definePathNames(fname_source):
     return path_names
 
 
+# ----------------------------------------------------------------------------
+#                                  Daemon
+# ----------------------------------------------------------------------------
+
+class JobOutput():
+    """
+    A file-like object that forwards the output of a job to its client.
+
+    The daemon redirects the standard output to this object while a job
+    runs (see :func:`runJob`). Every write becomes an event in the
+    `asyncio.Queue` ``events`` of the job. The writes go through the event
+    ``loop`` because the worker threads of :func:`convertDocument` print as
+    well.
+    """
+    def __init__(self, loop, events):
+        self.loop = loop
+        self.events = events
+
+    def write(self, text):
+        if len(text) > 0:
+            self.loop.call_soon_threadsafe(self.events.put_nowait,
+                                           {'output': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def jobStatus(job):
+    """
+    Return the status of ``job`` as a dictionary for the client.
+
+    The 'wait' and 'run' entries are the seconds the job spent in the queue
+    and converting, respectively, so far.
+    """
+    now = time.time()
+    started = job['started'] or now
+    return {'id': job['id'], 'file': job['file'], 'status': job['status'],
+            'wait': started - job['queued'],
+            'run': (job['finished'] or now) - started if job['started']
+            else 0}
+
+
+async def runJob(job, pipelines, defaults):
+    """
+    Convert the document of ``job`` with the options of the job.
+
+    Options that the job does not set have their value from ``defaults``,
+    ie. the settings the daemon started with, rather than the value from the
+    previous job. The options include the number of concurrent processes,
+    which is why this function also resizes the program limits that all jobs
+    share (see :class:`ToolSlots`).
+
+    The output of the conversion goes to the client (see :class:`JobOutput`).
+    Afterwards, a warm fragment pipeline for the document waits for the next
+    job with the same document and options (see
+    :func:`startFragmentPipeline`). ``pipelines`` maps (path names, options)
+    to these pipelines, and holds at most ``config.daemon_pipelines`` of them
+    (the most recently used ones).
+
+    :param **dict** job: job description (see :func:`handleClient`).
+    :param **OrderedDict** pipelines: warm fragment pipelines.
+    :param **dict** defaults: {name: value} of all ``job_options``.
+    :return: **None**
+    """
+    job['status'], job['started'] = 'running', time.time()
+    options = dict(defaults, **job['options'])
+
+    out = JobOutput(asyncio.get_running_loop(), job['events'])
+    with contextlib.redirect_stdout(out):
+        try:
+            for name in job_options:
+                setattr(config, name, options[name])
+            startProfile()
+
+            # The program limits of the daemon follow the number of processes
+            # of the job (see the -j command line argument).
+            slots = tool_slots.get()
+            if slots is not None:
+                slots.resize(config.num_processes)
+
+            # The options of the job may require other programs (eg. for the
+            # 'dvi' backend).
+            findTools(requiredTools())
+            path_names = definePathNames(job['file'])
+            key = (path_names, repr(sorted(options.items())))
+            pipeline = pipelines.pop(key, None)
+            preamble = await convertFile(path_names, pipeline)
+            pipelines[key] = startFragmentPipeline(preamble, path_names)
+            job['status'] = 'ok'
+        except DocumentError:
+            job['status'] = 'error'
+        except Exception as e:
+            print('Error: {}'.format(e))
+            job['status'] = 'error'
+        finally:
+            job['finished'] = time.time()
+            finishProfile()
+
+        # Evict the least recently used pipelines.
+        while len(pipelines) > config.daemon_pipelines:
+            (path_names, _), pipeline = pipelines.popitem(last=False)
+            await stopFragmentPipeline(pipeline, path_names)
+
+
+def optionTypes(default):
+    """
+    Return the types that a job option with the value ``default`` accepts.
+
+    Strings may also be **None** (eg. ``config.cache_dir``) and vice versa,
+    and floats may also be integers, but not the other way around.
+
+    :param default: value of the option in the daemon (see :func:`runJob`).
+    :rtype: **tuple**
+    """
+    if default is None or isinstance(default, str):
+        return (str, type(None))
+    if type(default) is float:
+        return (float, int)
+    return (type(default),)
+
+
+def checkJobRequest(request, defaults):
+    """
+    Return the reason why the daemon cannot accept the 'convert' ``request``.
+
+    A valid request names the LaTeX file, and sets only ``job_options``, each
+    with a value of the same type as in ``defaults`` (see
+    :func:`optionTypes`).
+
+    :param **dict** request: request of a client (see :func:`submitJob`).
+    :param **dict** defaults: {name: value} of all ``job_options``.
+    :return: reason, or **None** if the request is valid.
+    :rtype: **str**
+    """
+    if not isinstance(request.get('file'), str):
+        return 'the request names no file'
+    options = request.get('options')
+    if not isinstance(options, dict):
+        return 'the request has no options'
+    unknown = sorted(set(options) - set(job_options))
+    if len(unknown) > 0:
+        return 'unknown options: {}'.format(', '.join(unknown))
+    invalid = sorted(name for name, value in options.items()
+                     if type(value) not in optionTypes(defaults[name]))
+    if len(invalid) > 0:
+        return 'invalid values for: {}'.format(', '.join(invalid))
+    return None
+
+
+async def handleClient(reader, writer, jobs, queue, defaults):
+    """
+    Serve the request of a single client of the daemon.
+
+    Every request and every response is a JSON object on a line of its own.
+    A 'status' request returns the status of the recent ``jobs`` (see
+    :func:`jobStatus`). A 'convert' request adds a job to the ``queue``, and
+    streams its output back to the client, followed by its status. The
+    response to an invalid request (see :func:`checkJobRequest`) is an
+    'error' object with the reason.
+
+    :param **asyncio.StreamReader** reader: input from the client.
+    :param **asyncio.StreamWriter** writer: output to the client.
+    :param **deque** jobs: recent jobs.
+    :param **asyncio.Queue** queue: pending jobs.
+    :param **dict** defaults: {name: value} of all ``job_options``.
+    :return: **None**
+    """
+    try:
+        request = json.loads((await reader.readline()).decode('utf8'))
+        command = request['command']
+    except (ValueError, KeyError, TypeError):
+        command = None
+    reason = 'invalid request'
+    if command == 'convert':
+        reason = checkJobRequest(request, defaults)
+
+    if command == 'status':
+        writer.write(json.dumps({'jobs': [jobStatus(_) for _ in jobs]})
+                     .encode('utf8') + b'\n')
+    elif reason is not None:
+        writer.write(json.dumps({'error': reason}).encode('utf8') + b'\n')
+    else:
+        job = {'id': len(jobs) and jobs[-1]['id'] + 1, 'file': request['file'],
+               'options': request['options'], 'status': 'queued',
+               'queued': time.time(), 'started': None, 'finished': None,
+               'events': asyncio.Queue()}
+        jobs.append(job)
+        queue.put_nowait(job)
+
+        # Forward the events of the job until it has finished. The job
+        # continues even if the client disconnects.
+        while True:
+            event = await job['events'].get()
+            try:
+                writer.write(json.dumps(event).encode('utf8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass
+            if 'status' in event:
+                break
+    try:
+        await writer.drain()
+        writer.close()
+    except ConnectionError:
+        pass
+
+
+def isPrivateDirectory(dname):
+    """
+    Return **True** if the user owns ``dname`` and nobody else can write to it.
+
+    Nobody else can then create or replace the daemon socket in ``dname``
+    (see :func:`serveDaemon`).
+
+    :param *str* dname: directory.
+    :rtype: **bool**
+    """
+    try:
+        st = os.stat(dname)
+    except FileNotFoundError:
+        return False
+    return st.st_uid == os.getuid() and st.st_mode & 0o022 == 0
+
+
+def daemonOwner(writer):
+    """
+    Return the user ID of the daemon at the other end of ``writer``.
+
+    The kernel reports the user of the peer process (SO_PEERCRED). Where it
+    does not (eg. on macOS), the daemon counts as the user's own only if the
+    socket is in a private directory (see :func:`isPrivateDirectory`) and
+    belongs to the user.
+
+    :param **asyncio.StreamWriter** writer: connection to the daemon.
+    :return: user ID, or **None** if it is unknown.
+    :rtype: **int**
+    """
+    sock = writer.get_extra_info('socket')
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+    except (AttributeError, OSError):
+        pass
+
+    fname = os.path.abspath(config.daemon_socket)
+    if not isPrivateDirectory(os.path.dirname(fname)):
+        return None
+    try:
+        return os.stat(fname).st_uid
+    except FileNotFoundError:
+        return None
+
+
+async def connectDaemon():
+    """
+    Return the (reader, writer) connection to the daemon, if it is running.
+
+    Return **None** if no daemon listens on ``config.daemon_socket``, or if
+    the daemon belongs to another user (see :func:`daemonOwner`). The latter
+    prevents other users from intercepting the conversions of the user.
+    """
+    try:
+        reader, writer = await asyncio.open_unix_connection(
+            config.daemon_socket)
+    except (OSError, AttributeError):
+        return None
+    if daemonOwner(writer) != os.getuid():
+        print('Warning: ignoring the daemon on <{}> because it does not '
+              'belong to you'.format(config.daemon_socket))
+        writer.close()
+        return None
+    return reader, writer
+
+
+async def serveDaemon():
+    """
+    Run the conversion daemon until interrupted.
+
+    The daemon accepts jobs from clients on the Unix socket
+    ``config.daemon_socket`` (see :func:`handleClient` and
+    :func:`submitJob`). It thus saves every conversion the start-up of the
+    interpreter, the imports and the dependency check. All jobs share the
+    limits of the external programs, the fragment cache, and the warm
+    fragment pipelines of recent documents (see :func:`runJob`).
+
+    The jobs run one after the other, in the order they arrive, because the
+    conversion of a document keeps its state in the ``config`` module (eg.
+    ``config.counter_values``). Every job still compiles its fragments with
+    up to ``config.num_processes`` processes.
+
+    The daemon refuses to start unless the directory of the socket is
+    private (see :func:`isPrivateDirectory`). It creates the directory if
+    it does not exist.
+
+    :return: **None**
+    """
+    if await connectDaemon() is not None:
+        print('A daemon is already listening on <{}>'.format(
+            config.daemon_socket))
+        return
+
+    # Only the user must be able to replace the socket (see connectDaemon).
+    dname = os.path.dirname(os.path.abspath(config.daemon_socket))
+    os.makedirs(dname, mode=0o700, exist_ok=True)
+    if not isPrivateDirectory(dname):
+        print('Error: other users can write to <{}> - choose another '
+              'daemon_socket in config.py'.format(dname))
+        return
+
+    # Remove the socket of a daemon that did not shut down properly.
+    try:
+        os.remove(config.daemon_socket)
+    except FileNotFoundError:
+        pass
+
+    # Every job starts from the options the daemon started with (see runJob).
+    defaults = {name: getattr(config, name) for name in job_options}
+    tool_slots.set(ToolSlots(config.num_processes))
+    jobs = collections.deque(maxlen=config.daemon_history)
+    queue = asyncio.Queue()
+    pipelines = collections.OrderedDict()
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handleClient(reader, writer, jobs, queue,
+                                            defaults),
+        path=config.daemon_socket)
+    print('Daemon: listening on <{}> (Ctrl-C to stop)'.format(
+        config.daemon_socket))
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            job = await queue.get()
+            await runJob(job, pipelines, defaults)
+
+            # The status must reach the client after all output of the job
+            # (see JobOutput).
+            status = jobStatus(job)
+            loop.call_soon_threadsafe(job['events'].put_nowait, status)
+            print('Job {id} <{file}>: {status} (wait {wait:.1f}s, '
+                  'run {run:.1f}s)'.format(**status))
+    finally:
+        server.close()
+        for (path_names, _), pipeline in pipelines.items():
+            await stopFragmentPipeline(pipeline, path_names)
+        try:
+            os.remove(config.daemon_socket)
+        except FileNotFoundError:
+            pass
+
+
+async def submitJob(fname):
+    """
+    Convert the LaTeX file ``fname`` with a running daemon.
+
+    The job uses the current settings of all ``job_options``, and this
+    function prints the output of the job as it arrives.
+
+    :param *str* fname: LaTeX file.
+    :return: exit status (0 for success), or **None** if there is no daemon.
+    :rtype: **int**
+    """
+    conn = await connectDaemon()
+    if conn is None:
+        return None
+    reader, writer = conn
+
+    # The daemon runs in a different directory.
+    options = {name: getattr(config, name) for name in job_options}
+    for name in ('cache_dir', 'trace'):
+        if options[name] is not None:
+            options[name] = os.path.abspath(options[name])
+    request = {'command': 'convert', 'file': os.path.abspath(fname),
+               'options': options}
+    writer.write(json.dumps(request).encode('utf8') + b'\n')
+    await writer.drain()
+
+    status = None
+    while status is None:
+        line = await reader.readline()
+        if len(line) == 0:
+            print('Error: the daemon closed the connection')
+            status = {'status': 'error'}
+            break
+        event = json.loads(line.decode('utf8'))
+        if 'output' in event:
+            print(event['output'], end='', flush=True)
+        elif 'error' in event:
+            print('Error: the daemon rejected the job: {}'.format(
+                event['error']))
+            status = {'status': 'error'}
+        elif 'status' in event:
+            status = event
+            print('Daemon job {id}: {status} (wait {wait:.1f}s, '
+                  'run {run:.1f}s)'.format(**status))
+    writer.close()
+    return 0 if status['status'] == 'ok' else 1
+
+
+async def printDaemonStatus():
+    """
+    Print the status of the recent jobs of the running daemon.
+
+    :return: exit status (0 for success, 1 if there is no daemon).
+    :rtype: **int**
+    """
+    conn = await connectDaemon()
+    if conn is None:
+        print('No daemon is listening on <{}>'.format(config.daemon_socket))
+        return 1
+    reader, writer = conn
+    writer.write(b'{"command": "status"}\n')
+    await writer.drain()
+    jobs = json.loads((await reader.readline()).decode('utf8'))['jobs']
+    writer.close()
+    for job in jobs:
+        print('Job {id:4d} {status:8s} wait {wait:6.1f}s  run {run:6.1f}s  '
+              '{file}'.format(**job))
+    return 0
+
+
 # ----------------------------------------------------------------------------
 #                               Main
 # ----------------------------------------------------------------------------
 
-def main():
-    # Parse command line arguments and retrieve source file.
-    fname_source = parseCmdline()
+class FragmentStream(list):
+    """
+    A list of fragments that also passes every new fragment to ``queue``.
 
-    # Ensure all dependencies are met.
-    print('Dependency check: ', end='', flush=True)
-    checkDependencies()
-    print('\rDependency check: ok')
+    :func:`convertTreeToHTML` appends the fragments from a worker thread.
+    Every fragment therefore goes into the `asyncio.Queue` ``queue`` via the
+    event ``loop`` (see :func:`convertDocument`).
+    """
+    def __init__(self, loop, queue):
+        super().__init__()
+        self.loop = loop
+        self.queue = queue
 
-    # Determine all path- and file names Nobby needs in due course.
-    path_names = definePathNames(fname_source)
+    def append(self, frag):
+        super().append(frag)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, frag)
+
+
+def generateTree(body):
+    """
+    Return the tree of the LaTeX ``body`` (see :func:`buildTree`).
+    """
+    with profileStage('build tree'):
+        # Find all LaTeX environment delimiters known to Nobby (eg. '$',
+        # '\begin{}', etc) and prune it to remove nested environments.
+        delim_list = findDelimiters(body)
+        delim_list = pruneDelimiters(delim_list, plugins.plugins)
+
+        # Convert the LaTeX code into a tree based on the position of the
+        # environment delimiters from the previous step.
+        return buildTree(body, delim_list)
+
+
+def startFragmentPipeline(preamble, path_names):
+    """
+    Start a fragment pipeline for ``preamble`` and return it.
+
+    The pipeline is a :func:`compileFragments` task that warms up right
+    away, ie. it dumps the preamble format and starts the TeX workers before
+    any fragment exists. Pass it to :func:`convertDocument` to use it.
+
+    :param *str* preamble: document preamble.
+    :param *tuple* path_names: the usual set of path names.
+    :rtype: tuple
+    :return: (preamble, incoming, task). The fragments go into the
+        `asyncio.Queue` ``incoming``.
+    """
+    incoming = asyncio.Queue()
+    task = asyncio.ensure_future(
+        compileFragments(preamble, incoming, path_names, warm=True))
+    return preamble, incoming, task
+
+
+async def stopFragmentPipeline(pipeline, path_names):
+    """
+    Stop the unused ``pipeline`` and remove the build directory.
+
+    This kills the idle TeX workers of the pipeline (see
+    :func:`startFragmentPipeline`). The build directory remains if
+    ``config.keep_builddir`` is **True**.
+
+    :param *tuple* pipeline: warm fragment pipeline.
+    :param *tuple* path_names: the usual set of path names.
+    :return: **None**
+    """
+    pipeline[2].cancel()
+    await asyncio.gather(pipeline[2], return_exceptions=True)
+    if os.path.exists(path_names.d_build) and not config.keep_builddir:
+        shutil.rmtree(path_names.d_build)
+
+
+async def convertDocument(preamble, body, path_names, pipeline=None):
+    """
+    Compile the document, convert it to HTML, and compile all its fragments.
+
+    The stages overlap as far as their dependencies permit. The original
+    document compiles (see :func:`compileWithCounters`) while Nobby builds
+    the tree of the body, dumps the preamble format, and starts the TeX
+    workers (see :func:`compileFragments`). The conversion of the tree into
+    HTML needs the counter values and the auxiliary files (eg. for the
+    'ref' plugin), and therefore starts once the compilation has finished.
+    It runs in a separate thread, and every fragment goes to the TeX workers
+    as soon as :func:`convertTreeToHTML` creates it.
+
+    If the counter values of the previous run are still valid (see
+    :func:`findCachedCounters`) then Nobby skips the compilation with counter
+    dumps altogether. Unless the body is unchanged, the original document
+    still compiles to update the PDF, but nothing waits for it.
+
+    The fragments go into ``pipeline`` if it was started for the same
+    ``preamble`` (see :func:`startFragmentPipeline`). Otherwise, this
+    function cancels ``pipeline`` and starts a new one.
+
+    This function also sets ``config.tex_output`` and
+    ``config.counter_values``, which the conversion of the tree uses. Only
+    one document at a time converts its tree if several documents convert
+    concurrently (see :func:`convertFiles`). Nothing else may read these
+    two values, because they belong to whichever document holds the lock;
+    in particular, the tree nodes look up their counters only during the
+    conversion (see :attr:`TreeNode.counters`).
+
+    :param *str* preamble: document preamble.
+    :param *str* body: document body
+    :param *tuple* path_names: the usual set of path names.
+    :param *tuple* pipeline: warm fragment pipeline, or **None**.
+    :rtype tuple:
+    :return: (html, fragments, metrics). The <img> tags in ``html`` still
+        lack their file extension (see :func:`insertFragmentImages`), and
+        ``metrics`` are the {frag['hash']: metrics} of all ``fragments``.
+    :raises DocumentError: if the document does not compile.
+    """
+    loop = asyncio.get_running_loop()
+    trace_track.set(path_names.f_tex)
+
+    # All stages share the same program limits. Idle TeX workers do not
+    # occupy a slot (see typesetFragments), which is why the warm-up of the
+    # fragment pipeline cannot delay the compilation of the document.
+    if tool_slots.get() is None:
+        tool_slots.set(ToolSlots(config.num_processes))
+    cached = findCachedCounters(preamble, body, path_names)
+    if cached is None:
+        compile_doc = asyncio.ensure_future(profileCoroutine(
+            'compile document', compileWithCounters(preamble, body,
+                                                    path_names)))
+    elif cached[2] is None:
+        compile_doc = asyncio.ensure_future(profileCoroutine(
+            'compile original', compileOriginal(path_names)))
+    else:
+        # Restore the PDF of the unchanged document.
+        os.makedirs(path_names.d_build, exist_ok=True)
+        dst = os.path.join(path_names.d_build, path_names.f_tex[:-3] + 'pdf')
+        shutil.copyfile(cached[2], dst)
+        compile_doc = None
+    if pipeline is not None and pipeline[0] != preamble:
+        pipeline[2].cancel()
+        pipeline = None
+    if pipeline is None:
+        pipeline = startFragmentPipeline(preamble, path_names)
+    _, incoming, compile_frags = pipeline
+    lock = convert_lock.get() or asyncio.Lock()
 
-    # Compile the original LaTeX document and abort if that fails.
-    print('Compile original: ', end='', flush=True)
     try:
-        config.tex_output = runPDFLaTeX(path_names.d_build, fname_source)
-    except (subprocess.CalledProcessError, FileNotFoundError,
-            AssertionError) as e:
-        errmsg = 'Error: the original document <{}> does not compile - Abort.'
-        errmsg = errmsg.format(fname_source)
-        print(errmsg)
-        print(e)
-        sys.exit(1)
-    print('\rCompile original: ok')
+        # Build the tree in a separate thread to keep the event loop
+        # responsive. The nodes look up their counter values only during the
+        # conversion below (see TreeNode.counters).
+        tree = await loop.run_in_executor(None, generateTree, body)
+        print('Generate tree: ok')
+
+        # The counter values and auxiliary files must be available before
+        # the conversion starts.
+        if cached is None:
+            tex_out, counters = await compile_doc
+            storeCachedCounters(preamble, body, path_names, tex_out, counters)
+            print('Compile original: ok')
+        else:
+            tex_out, counters = cached[:2]
+            print('Compile original: counter values from cache')
+
+        # Convert the tree nodes into HTML code and a list of independent
+        # fragments, and compile every fragment as soon as it exists.
+        fragments = FragmentStream(loop, incoming)
+
+        def convertTree():
+            with profileStage('convert tree'):
+                return convertTreeToHTML(tree, fragments, plugins.plugins)
+
+        async with lock:
+            config.tex_output, config.counter_values = tex_out, counters
+            del no_plugins[:]
+            html = await loop.run_in_executor(None, convertTree)
+            if config.verbose and len(no_plugins) > 0:
+                print('Missing plugins for:')
+                for _ in no_plugins:
+                    print('  {}: <{}>'.format(*_))
+        incoming.put_nowait(None)
+        print('Convert tree: ok')
+
+        metrics = await compile_frags
+
+        # Record the remapped counters for the next run, along with the
+        # output of the new compilation.
+        if cached is not None and compile_doc is not None:
+            tex_out = await compile_doc
+            async with lock:
+                config.tex_output = tex_out
+            storeCachedCounters(preamble, body, path_names, tex_out, counters)
+    finally:
+        # Do not leave any compilation behind if something went wrong (eg.
+        # the document does not compile).
+        for task in (compile_doc, compile_frags):
+            if task is not None:
+                task.cancel()
+    return html, fragments, metrics
+
+
+async def convertFile(path_names, pipeline=None):
+    """
+    Convert the LaTeX file ``path_names.f_source`` into an HTML file.
+
+    The HTML file, the images of all fragments and a copy of the PDF file
+    all go into the HTML directory. See :func:`convertDocument` for the
+    ``pipeline``.
+
+    :param *tuple* path_names: the usual set of path names.
+    :param *tuple* pipeline: warm fragment pipeline, or **None**.
+    :return: preamble of the document.
+    :rtype: **str**
+    :raises DocumentError: if the document does not compile.
+    """
+    # Split LaTeX code into body and preamble.
+    stream = open(path_names.f_source, 'r').read()
+    preamble, body = splitLaTeXDocument(stream)
+
+    # Obtain meta information like document- author and title.
+    title, author = findLaTeXMetaInfo(preamble)
+
+    # Compile the LaTeX document, convert it into HTML code and compile all
+    # fragments into images.
+    html, fragments, metrics = await convertDocument(
+        preamble, body, path_names, pipeline)
 
     # Put a copy of the compiled PDF file to the HTML directory, in case the
     # HTML file wants to refer to the PDF version.
@@ -2309,65 +5778,272 @@ def main():
     dst = os.path.join(path_names.d_html, path_names.f_tex[:-3] + 'pdf')
     shutil.copy(src, dst)
 
-    # Split LaTeX code into body and preamble.
-    stream = open(path_names.f_source, 'r').read()
-    preamble, body = splitLaTeXDocument(stream)
+    # Add the correct file extension (eg. 'PNG' or 'SVG') to all <img> tags
+    # in the HTML code.
+    with profileStage('insert images'):
+        html = insertFragmentImages(html, fragments, metrics, path_names)
 
-    # Add counter dumps to LaTeX file and recompile.
-    print('Extract counters: ', end='', flush=True)
-    config.counter_values = compileWithCounters(preamble, body, path_names)
-    print('\rExtract counters: ok')
+    # Show the user which fragments slow down the build, if requested via
+    # the --slowest command line argument.
+    if config.slowest_fragments > 0:
+        index = LineIndex(stream, body)
+        print(reportSlowestFragments(fragments, index,
+                                     config.slowest_fragments))
 
-    # Obtain meta information like document- author and title.
-    title, author = findLaTeXMetaInfo(preamble)
+    with profileStage('prettify'):
+        # Remove all artificial line breaks to prevent Wordpress from
+        # enforcing them.
+        html = prettifyHTML(html)
+
+        # Insert line breaks around every paragraph to improve the
+        # readability of the HTML file.
+        html = re.sub(r'<p>', '\n\n<p>\n\n', html)
+
+    # Prefix the HTML code with the meta information from the LaTeX code.
+    html = createHTMLMetaInfo(title, author) + html
+
+    # Save the HTML file. Write a temporary file first to ensure a browser
+    # never sees an incomplete file in watch mode.
+    fname_tmp = path_names.f_html + '.tmp'
+    open(fname_tmp, 'w').write(html)
+    os.replace(fname_tmp, path_names.f_html)
+    return preamble
+
+
+async def convertFiles(fnames):
+    """
+    Convert all LaTeX files in ``fnames`` and print a timing summary.
+
+    Up to ``config.max_documents`` documents convert concurrently, and all
+    their stages and fragments share the same program limits (see
+    :func:`toolSlot`). The fragments of the next document thus keep the
+    processes busy while the last fragments of the previous one finish.
+    Documents with the same preamble share its format, and every fragment
+    compiles only once even if it appears in several documents (see
+    :func:`compileFragments`).
+
+    :param *list* fnames: LaTeX files.
+    :return: number of documents that failed to convert.
+    :rtype: **int**
+    """
+    tool_slots.set(ToolSlots(config.num_processes))
+    convert_lock.set(asyncio.Lock())
+
+    # Documents can only share formats and fragments via the cache.
+    if config.cache_dir is not None:
+        shared_formats.set({})
+        shared_fragments.set({})
+    documents = asyncio.Semaphore(config.max_documents)
+    results = {}
+
+    async def convert(fname):
+        async with documents:
+            print('Convert <{}>'.format(fname))
+            t0 = time.time()
+            try:
+                await convertFile(definePathNames(fname))
+                status = 'ok'
+            except DocumentError:
+                status = 'error'
+            except Exception as e:
+                print('Error: cannot convert <{}>: {}'.format(fname, e))
+                status = 'error'
+            results[fname] = (status, time.time() - t0)
+
+    t0 = time.time()
+    await asyncio.gather(*[convert(_) for _ in fnames])
+    wall = time.time() - t0
+
+    # Summary.
+    print('\nSummary:')
+    width = max(len(_) for _ in fnames)
+    for fname in fnames:
+        status, seconds = results[fname]
+        print('  {:{}}  {:5s}  {:6.1f}s'.format(fname, width, status, seconds))
+    total = sum(_[1] for _ in results.values())
+    failed = sum(_[0] != 'ok' for _ in results.values())
+    print('  {} documents ({} failed) in {:.1f}s, {:.1f}s per document, '
+          '{:.1f}s of document time'.format(
+              len(fnames), failed, wall, wall / len(fnames), total))
+    finishProfile()
+    return failed
+
+
+def watchedFiles(path_names):
+    """
+    Return the files that affect the document.
+
+    These are the source file itself and every file below its directory that
+    LaTeX read during the last compilation (eg. '\\input' files or images,
+    see :func:`recordedInputs`).
+
+    :param *tuple* path_names: the usual set of path names.
+    :return: sorted list of absolute file names.
+    :rtype: **list**
+    """
+    d_base = os.path.join(os.path.abspath(path_names.d_base), '')
+    out = {os.path.abspath(path_names.f_source)}
+    tex_out = getattr(config, 'tex_output', None)
+    if tex_out is not None:
+        inputs = recordedInputs(tex_out.fls, path_names)
+        out.update(_ for _ in inputs if _.startswith(d_base))
+    return sorted(out)
+
+
+def fileStates(fnames):
+    """
+    Return the {fname: (mtime, size)} of all ``fnames``.
+
+    The state of missing files is **None**.
+    """
+    out = {}
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+            out[fname] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            out[fname] = None
+    return out
+
+
+async def waitForChange(states):
+    """
+    Return once any file in ``states`` differs from its state.
+
+    This function polls the files every ``config.watch_interval`` seconds.
+    Editors often save a file in several steps, which is why this function
+    only returns once the files have stopped changing for one interval.
+
+    :param *dict* states: file states (see :func:`fileStates`).
+    :return: **None**
+    """
+    while fileStates(states) == states:
+        await asyncio.sleep(config.watch_interval)
+
+    states = fileStates(states)
+    while True:
+        await asyncio.sleep(config.watch_interval)
+        new = fileStates(states)
+        if new == states:
+            return
+        states = new
+
+
+async def watchDocument(path_names):
+    """
+    Convert the document again whenever it changes, until interrupted.
 
-    print('Generate tree: ', end='', flush=True)
-    # Find all LaTeX environment delimiters known to Nobby (eg. '$',
-    # '\begin{}', etc) and prune it to remove nested environments.
-    delim_list = findDelimiters(body)
-    delim_list = pruneDelimiters(delim_list, plugins.plugins)
+    Every rebuild only does what the edit requires. The counter cache skips
+    the compilation of the document unless the edit may have changed the
+    counter values (see :func:`findCachedCounters`), and the fragment cache
+    skips all fragments that have not changed. Between rebuilds, a fragment
+    pipeline with the current preamble format and TeX workers waits for the
+    next rebuild (see :func:`startFragmentPipeline`). If the document does
+    not compile then this function waits for the next change.
+
+    :param *tuple* path_names: the usual set of path names.
+    :return: **None**
+    """
+    tool_slots.set(ToolSlots(config.num_processes))
+    pipeline, fnames, first = None, [], True
+    try:
+        while True:
+            # Take the state of all files before the rebuild, to not miss
+            # any changes during the rebuild.
+            states = fileStates(watchedFiles(path_names) + fnames)
+            t0 = time.time()
+            startProfile()
+            try:
+                preamble = await convertFile(path_names, pipeline)
+                pipeline = startFragmentPipeline(preamble, path_names)
+                print('Rebuild: ok ({:.1f}s)'.format(time.time() - t0))
+                finishProfile()
+                if first and config.launch_browser:
+                    launchBrowser(path_names.f_html)
+                first = False
+            except DocumentError:
+                pipeline = None
+
+            # Also watch the files that LaTeX read for the first time.
+            fnames = watchedFiles(path_names)
+            for fname, state in fileStates(fnames).items():
+                states.setdefault(fname, state)
+            print('Watching <{}> for changes (Ctrl-C to stop)'.format(
+                path_names.f_source))
+            await waitForChange(states)
+            print()
+    finally:
+        if pipeline is not None:
+            await stopFragmentPipeline(pipeline, path_names)
 
-    # Convert the LaTeX code into a tree based on the position of the
-    # environment delimiters from the previous step.
-    tree = buildTree(body, delim_list)
-    print('\rGenerate tree: ok')
 
-    print('Convert tree: ', end='', flush=True)
-    # Convert the tree nodes into HTML code and a list of independent
-    # fragments.
-    fragments = []
-    html = convertTreeToHTML(tree, fragments, plugins.plugins)
-    print('\rConvert tree: ok')
+def main():
+    # Parse command line arguments and retrieve the source files.
+    fnames = parseCmdline()
+    if config.daemon_status:
+        sys.exit(asyncio.run(printDaemonStatus()))
+    fname_source = fnames[0] if len(fnames) == 1 else None
+
+    # Convert the file with the daemon if there is one, unless the user
+    # wants to watch the file.
+    use_daemon = config.use_daemon and not config.watch
+    if fname_source is not None and not config.daemon and use_daemon:
+        status = asyncio.run(submitJob(fname_source))
+        if status is not None:
+            if status == 0 and config.launch_browser:
+                launchBrowser(definePathNames(fname_source).f_html)
+            sys.exit(status)
+
+    # Time all stages and external programs, if requested via the --profile
+    # or --trace command line arguments.
+    startProfile()
 
+    # Ensure all dependencies are met.
+    print('Dependency check: ', end='', flush=True)
+    with profileStage('dependency check'):
+        tools = checkDependencies()
+    print('\rDependency check: ok')
     if config.verbose:
-        if len(no_plugins) > 0:
-            print('Missing plugins for:')
-            for _ in no_plugins:
-                print('  {}: <{}>'.format(*_))
+        for tool, (fname, version) in tools.items():
+            print('  {}: {} <{}>'.format(tool, version, fname))
 
-    # Compile all LaTeX fragments into SVG images and add the correct file
-    # extension (eg. 'PNG' or 'SVG') to all <img> tags in the HTML code.
-    html = processFragments(preamble, html, fragments, path_names)
+    # Serve conversion jobs until interrupted, if requested via the --daemon
+    # command line argument.
+    if config.daemon:
+        try:
+            asyncio.run(serveDaemon())
+        except KeyboardInterrupt:
+            print()
+        return
 
-    # Remove all artificial line breaks to prevent Wordpress from enforcing
-    # them.
-    html = prettifyHTML(html)
+    # Convert several documents concurrently.
+    if fname_source is None:
+        sys.exit(1 if asyncio.run(convertFiles(fnames)) > 0 else 0)
 
-    # Insert line breaks around every paragraph to improve the readability of
-    # the HTML file.
-    html = re.sub(r'<p>', '\n\n<p>\n\n', html)
+    # Determine all path- and file names Nobby needs in due course.
+    path_names = definePathNames(fname_source)
 
-    # Prefix the HTML code with the meta information from the LaTeX code.
-    html = createHTMLMetaInfo(title, author) + html
+    # Convert the document whenever it changes, if requested via the --watch
+    # command line argument.
+    if config.watch:
+        try:
+            asyncio.run(watchDocument(path_names))
+        except KeyboardInterrupt:
+            print()
+        return
 
-    # Save the HTML file.
-    open(path_names.f_html, 'w').write(html)
+    # Convert the document once and abort if it does not compile.
+    try:
+        asyncio.run(convertFile(path_names))
+    except DocumentError:
+        sys.exit(1)
+    finally:
+        finishProfile()
 
     # Open the HTML file in Firefox, if requested via the -wb command line
     # argument.
     if config.launch_browser:
-        wb = webbrowser.get(None)
-        wb.open(path_names.f_html, new=2, autoraise=True)
+        launchBrowser(path_names.f_html)
 
 
 if __name__ == '__main__':
@@ -29,7 +29,7 @@ import os
 import re
 import sys
 import hashlib
-import IPython
+import plugins
 import argparse
 import tempfile
 import subprocess
@@ -40,8 +40,8 @@ import wordpress_xmlrpc.methods as wpmethods
 # Convenience data structure to parse the postid file.
 Entry = collections.namedtuple('Entry', 'host type ID')
 
-# Convenience.
-ipshell = IPython.embed
+# Convenience (imports IPython only when called).
+ipshell = plugins.ipshell
 
 
 def updateImageTags(html, wp_path_img):
@@ -16,9 +16,18 @@
 
 import re
 import config
-import IPython
 
-ipshell = IPython.embed
+
+def ipshell(header=''):
+    """
+    Start an embedded IPython shell in the namespace of the caller.
+
+    This is a debugging aid. It imports IPython only when called, because
+    IPython takes longer to import than Nobby needs to start.
+    """
+    from IPython.terminal.embed import InteractiveShellEmbed
+    InteractiveShellEmbed()(header, stack_depth=2)
+
 
 # -----------------------------------------------------------------------------
 # Plugins are normal function that take one argument. That argument is always
@@ -0,0 +1,116 @@
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Nobby.
+#
+# Nobby is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Nobby is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nobby. If not, see <http://www.gnu.org/licenses/>.
+
+import nobby
+import benchmark
+
+generateDocument = benchmark.generateDocument
+dumpCounters = benchmark.dumpCounters
+timeStages = benchmark.timeStages
+compareResults = benchmark.compareResults
+
+
+class TestBenchmark():
+    def test_generateDocument(self):
+        """
+        The documents must be reproducible and reflect the parameters.
+        """
+        params = {'paragraphs': 20, 'math_density': 0.2, 'depth': 3,
+                  'macro_freq': 0.2}
+        doc = generateDocument(**params)
+        assert doc == generateDocument(**params)
+        assert doc != generateDocument(seed=1, **params)
+        assert doc.startswith('\\documentclass')
+        assert doc.endswith('\\end{document}\n')
+
+        # More paragraphs make a longer document.
+        assert len(generateDocument(paragraphs=40)) > len(doc)
+
+        # Without math there are no equations, and without macros there are
+        # no '\emph' et al.
+        params_none = dict(params, math_density=0, macro_freq=0)
+        doc_none = generateDocument(**params_none)
+        assert '$' in doc and '$' not in doc_none
+        assert 'equation' in doc and 'equation' not in doc_none
+        for macro in benchmark.macros:
+            assert '\\' + macro + '{' not in doc_none
+
+        # The lists must nest exactly ``depth`` levels deep.
+        def maxDepth(doc):
+            level = out = 0
+            for tok in doc.split():
+                if tok.startswith('\\begin{itemize}') or \
+                   tok.startswith('\\begin{enumerate}'):
+                    level += 1
+                    out = max(out, level)
+                elif tok.startswith('\\end{itemize}') or \
+                        tok.startswith('\\end{enumerate}'):
+                    level -= 1
+            return out
+
+        for depth in (0, 1, 4):
+            doc = generateDocument(paragraphs=10, depth=depth)
+            assert maxDepth(doc) == depth
+
+    def test_dumpCounters(self):
+        body = ('foo\\section{A}\\begin{equation}x\\end{equation}'
+                '\\section{B}\\sectionfoo')
+        counters = dumpCounters(body)
+        assert [_.start for _ in counters] == [3, 14, 45]
+        assert [_.counters['section'] for _ in counters] == ['0', '1', '1']
+        assert [_.counters['equation'] for _ in counters] == ['0', '0', '1']
+        assert dumpCounters('foo') == []
+
+    def test_timeStages(self):
+        """
+        Every stage must have a time and the generated document must contain
+        fragments.
+        """
+        counter_values = nobby.config.counter_values
+        doc = generateDocument(paragraphs=10, math_density=0.3)
+        seconds, num_frags = timeStages(doc, repeat=2)
+        assert tuple(seconds.keys()) == benchmark.stage_names
+        assert all(0 <= _ < 10 for _ in seconds.values())
+        assert num_frags > 0
+        assert nobby.config.counter_values is counter_values
+
+    def test_compareResults(self):
+        def results(params, seconds):
+            return {'results': [{'params': params, 'seconds': seconds}]}
+
+        params = {'paragraphs': 100}
+        old = results(params, {'buildTree': 0.010, 'findDelimiters': 0.010})
+
+        # Noise below the threshold is no regression.
+        new = results(params, {'buildTree': 0.012, 'findDelimiters': 0.009})
+        assert compareResults(old, new) == []
+
+        # The 'buildTree' stage is much slower.
+        new = results(params, {'buildTree': 0.020, 'findDelimiters': 0.010})
+        assert compareResults(old, new) == [(params, 'buildTree', 0.01, 0.02)]
+        assert compareResults(old, new, threshold=1.5) == []
+
+        # Tiny stages must be slower by at least ``min_seconds``.
+        old = results(params, {'buildTree': 0.0001})
+        new = results(params, {'buildTree': 0.0005})
+        assert compareResults(old, new) == []
+        assert len(compareResults(old, new, min_seconds=0)) == 1
+
+        # Results of other documents or stages are not comparable.
+        new = results({'paragraphs': 50}, {'buildTree': 1})
+        assert compareResults(old, new) == []
+        new = results(params, {'prettifyHTML': 1})
+        assert compareResults(old, new) == []
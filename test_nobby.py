@@ -14,9 +14,17 @@
 # You should have received a copy of the GNU General Public License along with
 # Nobby. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
+import json
+import time
+import numpy as np
 import config
 import nobby
+import pytest
 import IPython
+import asyncio
+import subprocess
 
 ipshell = IPython.embed
 config.ph_format = '|{0}-{1:d}|'
@@ -37,9 +45,56 @@ splitLaTeXDocument = nobby.splitLaTeXDocument
 sanitisePreamble = nobby.sanitisePreamble
 prettifyHTML = nobby.prettifyHTML
 neutraliseLaTeXComments = nobby.neutraliseLaTeXComments
+fragmentHash = nobby.fragmentHash
+referencedFiles = nobby.referencedFiles
+findCachedFragment = nobby.findCachedFragment
+storeCachedFragment = nobby.storeCachedFragment
+pruneFragmentCache = nobby.pruneFragmentCache
+fragmentUsesCounters = nobby.fragmentUsesCounters
+processFragments = nobby.processFragments
+fragmentBatchSize = nobby.fragmentBatchSize
+fragmentPage = nobby.fragmentPage
+fragmentIsMeasured = nobby.fragmentIsMeasured
+fragmentDocument = nobby.fragmentDocument
+buildPreambleFormat = nobby.buildPreambleFormat
+typesetFragments = nobby.typesetFragments
+computeCropBox = nobby.computeCropBox
+cropSVG = nobby.cropSVG
+readFragmentBoxes = nobby.readFragmentBoxes
+imageStyle = nobby.imageStyle
+findCachedMetrics = nobby.findCachedMetrics
+convertFragmentDVI = nobby.convertFragmentDVI
+estimateFragmentTime = nobby.estimateFragmentTime
+findCachedTiming = nobby.findCachedTiming
+storeCachedTiming = nobby.storeCachedTiming
+runFragmentTasks = nobby.runFragmentTasks
+runTool = nobby.runTool
 
 
 class TestNobby():
+    def test_import_time(self):
+        """
+        Importing Nobby must neither load the heavy modules that only some
+        code paths need, nor exceed the import time budget.
+        """
+        # Cumulative import time of Nobby and all its dependencies, in
+        # seconds. The best of several runs, to not fail on a busy machine.
+        budget = 0.5
+        code = ('import sys, nobby; print(sorted(m for m in '
+                '("IPython", "numpy", "PIL", "webbrowser") if m in '
+                'sys.modules))')
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        times = []
+        for ii in range(3):
+            ret = subprocess.run((sys.executable, '-X', 'importtime', '-c',
+                                  code), cwd=cwd, capture_output=True,
+                                 text=True, check=True)
+            assert ret.stdout.strip() == '[]'
+            line = ret.stderr.strip().splitlines()[-1]
+            assert line.endswith('| nobby')
+            times.append(int(line.split('|')[1]) / 1E6)
+        assert min(times) < budget
+
     def test_splitLaTeXDocument(self):
         stream = ' preamble  \\begin{document}\nbody \n\\end{document}  '
 
@@ -321,6 +376,64 @@ class TestNobby():
         assert out[5] == ((15, 15), True, 'text', None)
         assert out[6] == ((16, 16), False, 'text', None)
 
+    def test_findDelimiters_precedence(self):
+        # Escaped characters take precedence over the LaTeX newline, ie. the
+        # second backslash escapes the '$' and there is no '\\' macro.
+        body = r'a\\$b'
+        out = findDelimiters(body)
+        assert len(out) == 2
+        assert out[0] == ((0, 0), True, 'text', None)
+        assert out[1] == ((5, 5), False, 'text', None)
+
+        # Environment names must not contain comments.
+        body = '\\begin{a%}\n'
+        out = findDelimiters(body)
+        assert out[0] == ((0, 6), None, 'macro', 'begin')
+        assert out[1] == ((6, 7), True, '{', None)
+
+        # Macros inside '$' environments are not delimiters, but braces are.
+        body = r'$\ldots{}$'
+        out = findDelimiters(body)
+        assert len(out) == 6
+        assert out[0] == ((0, 1), True, '$', None)
+        assert out[3] == ((7, 8), True, '{', None)
+        assert out[4] == ((8, 9), False, '}', None)
+        assert out[5] == ((9, 10), False, '$', None)
+
+        # An unmatched '$$' is an empty '$' environment.
+        body = r'$$\ldots'
+        out = findDelimiters(body)
+        assert len(out) == 3
+        assert out[0] == ((0, 1), True, '$', None)
+        assert out[1] == ((1, 2), False, '$', None)
+        assert out[2] == ((2, 8), None, 'macro', 'ldots')
+
+    def test_findDelimiters_sequential(self):
+        """
+        The single pass parser must produce the same delimiters as running
+        the individual parsers one after another.
+        """
+        def sequential(body):
+            delim = {}
+            body_sane = body
+            for func in (findComments, findBeginEnd, findCurly, findDollar,
+                         findNewline, findMacros):
+                body_sane, tmp = func(body_sane)
+                delim.update(tmp)
+            return [delim[_] for _ in sorted(delim)]
+
+        bodies = [
+            'a % b $c$ \\begin{d}\n$e$ \\end{d}',
+            r'\begin{a\%b}x\end{a\%b}',
+            r'\\\\{x} \\% \\\ldots',
+            r'$a \begin{b}$\end{b}$ \$ $',
+            '%a\n\\begin{x}{\\{}\\}$$\\vdots$$ %\\y',
+            r'\section*{a}\\[1mm]\\end{foo}',
+        ]
+        for body in bodies:
+            out = [_ for _ in findDelimiters(body) if _.type != 'text']
+            assert out == sequential(body)
+
     def test_pruneDelimiters(self):
         body = 'blah'
         out = findDelimiters(body)
@@ -777,3 +890,1216 @@ class TestNobby():
         body = "a ``b'' c"
         out = convertTextToHTML(body)
         assert out == r'a &ldquo;b&rdquo; c'
+
+    def test_fragmentHash(self):
+        frag = {'tex': '$x$', 'inline': True, 'counters': {'equation': '1'}}
+        h0 = fragmentHash('preamble', frag, '.')
+        assert h0 == fragmentHash('preamble', dict(frag), '.')
+
+        # The position of the fragment is irrelevant.
+        assert h0 == fragmentHash('preamble', dict(frag, placeholder='foo'),
+                                  '.')
+
+        # Preamble, LaTeX code, counters and directory are not.
+        assert h0 != fragmentHash('other', frag, '.')
+        assert h0 != fragmentHash('preamble', dict(frag, tex='$y$'), '.')
+        assert h0 != fragmentHash('preamble', dict(frag, counters={}), '.')
+        assert h0 != fragmentHash('preamble', frag, '..')
+
+    def test_fragmentHash_config(self, monkeypatch):
+        frag = {'tex': '$x$', 'inline': True, 'counters': {}}
+        h0 = fragmentHash('preamble', frag, '.')
+        monkeypatch.setattr(config, 'pdf_scale', config.pdf_scale + 1)
+        h1 = fragmentHash('preamble', frag, '.')
+        monkeypatch.setattr(config, 'textwidth_addon', 1)
+        h2 = fragmentHash('preamble', frag, '.')
+        assert len({h0, h1, h2}) == 3
+
+    def test_referencedFiles(self, tmpdir):
+        tmpdir.join('plot.pdf').write('x')
+        tmpdir.join('macros.tex').write('xy')
+        d_base = str(tmpdir)
+
+        tex = r'\includegraphics[width=1cm]{plot} \input macros \input{foo}'
+        assert referencedFiles(tex, d_base) == [
+            (str(tmpdir.join('macros.tex')), (
+                os.stat(str(tmpdir.join('macros.tex'))).st_mtime_ns, 2)),
+            (str(tmpdir.join('plot.pdf')), (
+                os.stat(str(tmpdir.join('plot.pdf'))).st_mtime_ns, 1)),
+            ('foo', None),
+        ]
+
+        # Packages from the TeX distribution are the same everywhere.
+        tex = r'\usepackage{amsmath,amssymb}'
+        assert referencedFiles(tex, d_base) == referencedFiles(tex, '.')
+        assert referencedFiles('$x$', d_base) == []
+
+    def test_fragmentHash_files(self, tmpdir, monkeypatch):
+        """
+        The image of a fragment changes with the files it includes, which
+        must therefore invalidate its cache entry.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        for name in ('a', 'b'):
+            tmpdir.mkdir(name).join('plot.pdf').write('plot')
+        d_a, d_b = str(tmpdir.join('a')), str(tmpdir.join('b'))
+        frag = {'tex': r'\includegraphics{plot}', 'inline': False,
+                'counters': {}}
+
+        fname = str(tmpdir.join('img.svg'))
+        open(fname, 'w').write('<svg/>')
+        h0 = fragmentHash('', frag, d_a)
+        storeCachedFragment(h0, fname)
+        assert findCachedFragment(fragmentHash('', frag, d_a)) is not None
+
+        # The same fragment in another directory includes another file.
+        assert findCachedFragment(fragmentHash('', frag, d_b)) is None
+
+        # Edit the file in place.
+        fname_plot = str(tmpdir.join('a', 'plot.pdf'))
+        open(fname_plot, 'w').write('edited plot')
+        assert findCachedFragment(fragmentHash('', frag, d_a)) is None
+
+        # Same for the files the preamble reads.
+        tmpdir.join('a', 'macros.tex').write('foo')
+        preamble = r'\input{macros}'
+        h1 = fragmentHash(preamble, frag, d_a)
+        st = os.stat(fname_plot)
+        tmpdir.join('a', 'macros.tex').write('bar!')
+        os.utime(fname_plot, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert h1 != fragmentHash(preamble, frag, d_a)
+
+    def test_fragmentCache(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        frag_hash = fragmentHash('', {'tex': 'x', 'inline': True,
+                                      'counters': {}}, '.')
+        assert findCachedFragment(frag_hash) is None
+
+        # Add an image to the cache and find it again.
+        fname = str(tmpdir.join('img.svg'))
+        open(fname, 'w').write('foo')
+        storeCachedFragment(frag_hash, fname)
+        fname = findCachedFragment(frag_hash)
+        assert fname.endswith('.svg')
+        assert open(fname, 'r').read() == 'foo'
+
+        # A disabled cache contains nothing.
+        monkeypatch.setattr(config, 'cache_dir', None)
+        assert findCachedFragment(frag_hash) is None
+
+    def test_pruneFragmentCache(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir))
+        monkeypatch.setattr(config, 'cache_max_age', 10)
+        monkeypatch.setattr(config, 'cache_max_size', 25)
+
+        # Create four cache entries with 10 Bytes each. They were last used 1,
+        # 2, 3, and 20 days ago, respectively.
+        fnames = []
+        for age in (1, 2, 3, 20):
+            fname = str(tmpdir.join('{:02d}.svg'.format(age)))
+            open(fname, 'w').write('x' * 10)
+            mtime = time.time() - age * 86400
+            os.utime(fname, (mtime, mtime))
+            fnames.append(fname)
+
+        # The oldest entry is too old, and the next oldest does not fit into
+        # the cache anymore.
+        assert pruneFragmentCache() == 2
+        assert [os.path.exists(_) for _ in fnames] == [True, True, False, False]
+
+        # Nobby must not check the cache again right away.
+        mtime = time.time() - 30 * 86400
+        os.utime(fnames[0], (mtime, mtime))
+        assert pruneFragmentCache() == 0
+        assert os.path.exists(fnames[0])
+
+        # An image and its metrics stay in and leave the cache together.
+        monkeypatch.setattr(config, 'cache_prune_interval', 0)
+        fname_box = fnames[1][:-4] + '.box'
+        open(fname_box, 'w').write('x' * 10)
+        assert pruneFragmentCache() == 1
+        assert not os.path.exists(fnames[0])
+        assert os.path.exists(fnames[1]) and os.path.exists(fname_box)
+
+        mtime = time.time() - 30 * 86400
+        for fname in (fnames[1], fname_box):
+            os.utime(fname, (mtime, mtime))
+        assert pruneFragmentCache() == 1
+        assert not os.path.exists(fnames[1])
+        assert not os.path.exists(fname_box)
+
+    def test_fragmentUsesCounters(self):
+        assert not fragmentUsesCounters(r'$x$')
+        assert not fragmentUsesCounters(r'\begin{align*}x\end{align*}')
+        assert not fragmentUsesCounters(r'\section*{foo}')
+        assert not fragmentUsesCounters(r'\theorems')
+        assert fragmentUsesCounters(r'\begin{align}x\end{align}')
+        assert fragmentUsesCounters(r'\section{foo}')
+        assert fragmentUsesCounters(r'$x_\theequation$')
+        assert fragmentUsesCounters(r'\fbox{\arabic{section}}')
+
+    def test_processFragments_duplicates(self, tmpdir, monkeypatch):
+        """
+        Identical fragments must share a single image. To avoid the need for
+        pdflatex the images are already in the fragment cache.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        monkeypatch.setattr(config, 'num_processes', 1)
+        path = nobby.PathNames(None, None, None, str(tmpdir),
+                               str(tmpdir.join('build')),
+                               str(tmpdir.join('html')))
+
+        body = r'$x$ $y$ $x$'
+        delim_list = pruneDelimiters(findDelimiters(body))
+        root = buildTree(body, delim_list)
+        frags = []
+        html = convertTreeToHTML(root, frags, {})
+        assert html == '|dollar1_-0| |dollar1_-1| |dollar1_-2|'
+
+        fname = str(tmpdir.join('img.svg'))
+        open(fname, 'w').write('<svg/>')
+        for frag in frags:
+            storeCachedFragment(fragmentHash('', frag, path.d_base), fname)
+
+        html = processFragments('', html, frags, path)
+        assert html == '|dollar1_-0|.svg |dollar1_-1|.svg |dollar1_-0|.svg'
+        assert sorted(os.listdir(path.d_html)) == [
+            '|dollar1_-0|.svg', '|dollar1_-1|.svg']
+
+    def test_fragmentBatchSize(self, monkeypatch):
+        """
+        Batches must be small enough to keep all processes busy, but never
+        larger than config.max_batch_size.
+        """
+        monkeypatch.setattr(config, 'num_processes', 2)
+        monkeypatch.setattr(config, 'max_batch_size', 20)
+        assert fragmentBatchSize(0) == 1
+        assert fragmentBatchSize(1) == 1
+        assert fragmentBatchSize(8) == 1
+        assert fragmentBatchSize(9) == 2
+        assert fragmentBatchSize(80) == 10
+        assert fragmentBatchSize(1000) == 20
+
+        monkeypatch.setattr(config, 'max_batch_size', 1)
+        assert fragmentBatchSize(1000) == 1
+
+    def test_fragmentPage(self, monkeypatch):
+        """
+        Every fragment must be on a dedicated page and set its own counters
+        inside a group.
+        """
+        monkeypatch.setattr(config, 'pdf_scale', 2)
+        monkeypatch.setattr(config, 'counter_names', ('equation', 'lemma'))
+        frag = {'tex': 'x', 'inline': False,
+                'counters': {'section': 2, 'equation': 1}}
+        out = fragmentPage(frag)
+        assert out == ('\\begingroup\n'
+                       '\\setcounter{equation}{1}\n'
+                       '\\ifcsname c@lemma\\endcsname'
+                       '\\setcounter{lemma}{0}\\fi\n'
+                       '\\setcounter{section}{2}\n'
+                       '\\pdfsetmatrix {2.000000 0 0 2.000000}\n'
+                       'x\n\\endgroup\n\\clearpage\n')
+
+        # Measured inline fragments go into a box whose metrics end up in the
+        # '.box' file. Nobby scales them in the SVG instead of the PDF.
+        frag = {'tex': 'x', 'inline': True, 'counters': {},
+                'placeholder': 'ph', 'name': '$'}
+        out = fragmentPage(frag)
+        assert '\\pdfsetmatrix' not in out
+        assert '\\setbox0=\\hbox{x%\n}%\n' in out
+        assert '\\write\\nobbybox{ph \\number\\wd0 ' in out
+        assert out.endswith('\\noindent\\pdfsavepos\\nobbywrite\\box0\n'
+                            '\\endgroup\n\\clearpage\n')
+
+        # Otherwise, inline fragments are preceded by the reference block.
+        monkeypatch.setattr(config, 'measure_inline', False)
+        out = fragmentPage(frag)
+        assert out.endswith('\\rule{1ex}{1ex}\\rule{1ex}{0ex}x\n'
+                            '\\endgroup\n\\clearpage\n')
+
+        # The DVI backend always measures inline fragments and locks the
+        # bounding box of the page to the box. It never scales the page.
+        monkeypatch.setattr(config, 'backend', 'dvi')
+        out = fragmentPage(frag)
+        assert ('\\special{dvisvgm:bbox r \\the\\wd0 \\space\\the\\ht0 '
+                '\\space\\the\\dp0}\\special{dvisvgm:bbox lock}\\box0\n') in out
+        frag['inline'] = False
+        out = fragmentPage(frag)
+        assert '\\pdfsetmatrix' not in out
+        assert 'dvisvgm' not in out
+
+    def test_fragmentPage_display(self):
+        """
+        Display math must not go into a horizontal box, because TeX does not
+        permit '$$' there.
+        """
+        body = r'a $x$ b $$y$$ c'
+        delim_list = pruneDelimiters(findDelimiters(body))
+        frags = []
+        convertTreeToHTML(buildTree(body, delim_list), frags, {})
+        assert [_['tex'] for _ in frags] == ['$x$', '$$y$$']
+        assert [_['inline'] for _ in frags] == [True, False]
+        for frag in frags:
+            frag['counters'] = {}
+        assert '\\hbox{$x$' in fragmentPage(frags[0])
+        assert '\\hbox' not in fragmentPage(frags[1])
+        assert '\\rule' not in fragmentPage(frags[1])
+
+    def test_fragmentPage_vertical(self, monkeypatch):
+        """
+        Only inline equations go into a horizontal box, because macros like
+        '\\maketitle' or '\\section' need vertical mode.
+        """
+        body = r'\maketitle a $x$ b \section{A} c'
+        delim_list = pruneDelimiters(findDelimiters(body))
+        frags = []
+        convertTreeToHTML(buildTree(body, delim_list), frags, {})
+        assert [_['tex'] for _ in frags] == ['\\maketitle', '$x$',
+                                             '\\section{A}']
+        for frag in frags:
+            frag['counters'] = {}
+        assert [fragmentIsMeasured(_) for _ in frags] == [False, True, False]
+        assert '\\hbox' not in fragmentPage(frags[0])
+        assert '\\hbox' not in fragmentPage(frags[2])
+        assert fragmentPage(frags[2]).endswith(
+            '\\rule{1ex}{1ex}\\rule{1ex}{0ex}\\section{A}\n'
+            '\\endgroup\n\\clearpage\n')
+
+        # The DVI backend cannot remove the reference block again.
+        monkeypatch.setattr(config, 'backend', 'dvi')
+        assert [fragmentIsMeasured(_) for _ in frags] == [False, True, False]
+        assert '\\rule' not in fragmentPage(frags[2])
+        assert '\\hbox' not in fragmentPage(frags[2])
+
+    def test_readFragmentBoxes(self, tmpdir):
+        """
+        Parse the fragment metrics and convert them from sp to points.
+        """
+        fname = str(tmpdir.join('frag.box'))
+        assert readFragmentBoxes(fname) == {}
+
+        open(fname, 'w').write('a-1 65536 131072 32768 6553600 0\n'
+                               'b-2 0 0 0 0\n')
+        assert readFragmentBoxes(fname) == {'a-1': (1, 2, 0.5, 100, 0)}
+
+    def test_imageStyle(self):
+        """
+        Measured images have an exact size and baseline.
+        """
+        assert imageStyle(None) == 'vertical-align: middle;'
+        assert imageStyle((20.5, 10, 2.25)) == (
+            'vertical-align: -2.25pt; width: 20.50pt; height: 10.00pt;')
+
+    def test_fragmentDocument(self, monkeypatch):
+        """
+        The fragment document must only contain the preamble if it does not
+        compile from a format.
+        """
+        monkeypatch.setattr(config, 'textwidth_addon', 1)
+        out = fragmentDocument('\\documentclass{article}', None, 'x\n')
+        assert out.startswith('\\documentclass{article}\n')
+        assert '\\addtolength{\\textwidth}{1.00cm}\n' in out
+        assert out.endswith('\\begin{document}\n'
+                            '\\newwrite\\nobbybox\n'
+                            '\\immediate\\openout\\nobbybox=\\jobname.box'
+                            '\\relax\nx\n\\end{document}\n')
+
+        out = fragmentDocument('\\documentclass{article}', 'a.fmt', 'x\n')
+        assert out.startswith('\\begin{document}\n')
+
+        # Nobby must not dump a format if the user disabled them.
+        monkeypatch.setattr(config, 'use_preamble_format', False)
+        assert asyncio.run(buildPreambleFormat('', None)) is None
+
+    def test_typesetFragments(self, tmpdir, monkeypatch):
+        """
+        The TeX workers must typeset every good fragment on its own page, and
+        report all fragments that produce errors, no page, or wedge or crash
+        their worker. To avoid the need for pdflatex, this test uses mock
+        versions of pdflatex and pdfseparate that follow the same protocol.
+        """
+        mock_pdflatex = '\n'.join([
+            '#!' + sys.executable,
+            'import os, re, sys, json, time',
+            'out = sys.argv[-2].split("=", 1)[1]',
+            'job = os.path.splitext(sys.argv[-1])[0]',
+            'page, pages, eq, gdef = 1, [], 0, False',
+            'print("<nobby-done {}>".format(page), flush=True)',
+            'for line in sys.stdin:',
+            '    if line.strip() == "nobby-stop":',
+            '        fname = os.path.join(out, job + ".pdf")',
+            '        open(fname, "w").write(json.dumps(pages))',
+            '        sys.exit(0)',
+            '    tex = open(line.strip()).read()',
+            '    if "WEDGE" in tex: time.sleep(100)',
+            '    if "CRASH" in tex: sys.exit(1)',
+            '    if "ERROR" in tex: print("! Undefined control sequence.")',
+            '    for n in re.findall(r"setcounter.equation..(\\d+)", tex):',
+            '        eq = int(n)',
+            '    eq += tex.count("stepcounter{equation}")',
+            '    gdef = gdef or "gdef" in tex',
+            '    tex += " equation={} gdef={}".format(eq, gdef)',
+            '    if "EMPTY" not in tex: page, pages = page + 1, pages + [tex]',
+            '    print("<nobby-done {}>".format(page), flush=True)',
+        ])
+        mock_pdfseparate = '\n'.join([
+            '#!' + sys.executable,
+            'import sys, json',
+            'for page, tex in enumerate(json.load(open(sys.argv[1]))):',
+            '    open(sys.argv[2] % (page + 1), "w").write(tex)',
+        ])
+        tmpdir.mkdir('bin')
+        for name, src in (('pdflatex', mock_pdflatex),
+                          ('pdfseparate', mock_pdfseparate)):
+            fname = str(tmpdir.join('bin', name))
+            open(fname, 'w').write(src)
+            os.chmod(fname, 0o755)
+        monkeypatch.setenv('PATH', str(tmpdir.join('bin')) + os.pathsep +
+                           os.environ['PATH'])
+        monkeypatch.setattr(config, 'fragment_timeout', 1)
+        monkeypatch.setattr(config, 'num_processes', 2)
+        monkeypatch.setattr(config, 'max_batch_size', 2)
+
+        path = nobby.PathNames(None, None, None, str(tmpdir),
+                               str(tmpdir.join('build')), None)
+        texs = ['a', 'ERROR', 'b', 'WEDGE', 'EMPTY', 'c', 'CRASH', 'd']
+        frags = [{'tex': tex, 'inline': False, 'counters': {},
+                  'placeholder': 'frag-{}'.format(idx)}
+                 for idx, tex in enumerate(texs)]
+        done = []
+        typeset, failed = asyncio.run(
+            typesetFragments('', None, frags, path, done.append))
+        assert sorted(_['tex'] for _ in typeset) == ['a', 'b', 'c', 'd']
+        assert sorted(_['tex'] for frags in done for _ in frags) == [
+            'a', 'b', 'c', 'd']
+        assert all(len(_) <= config.max_batch_size for _ in done)
+        assert sorted(_['tex'] for _ in failed) == [
+            'CRASH', 'EMPTY', 'ERROR', 'WEDGE']
+
+        # Every fragment must have a dedicated PDF, and the workers must
+        # remove their LaTeX files.
+        for frag in typeset:
+            fname = tmpdir.join('build', frag['placeholder'] + '.pdf')
+            assert frag['tex'] in fname.read()
+        assert not any(_.endswith('.tex') for _ in os.listdir(str(tmpdir)))
+
+        # A fragment that fails must not affect the next one (here: the
+        # counter it increments, and the macro it defines globally before the
+        # error), because the next one goes to a fresh worker.
+        monkeypatch.setattr(config, 'num_processes', 1)
+        monkeypatch.setattr(config, 'max_batch_size', 10)
+        texs = ['\\stepcounter{equation}\\gdef\\foo{}ERROR', 'SHOW']
+        frags = [{'tex': tex, 'inline': False, 'counters': {},
+                  'placeholder': 'frag-{}'.format(idx)}
+                 for idx, tex in enumerate(texs)]
+        typeset, failed = asyncio.run(
+            typesetFragments('', None, frags, path, done.append))
+        assert [_['tex'] for _ in typeset] == ['SHOW']
+        fname = tmpdir.join('build', typeset[0]['placeholder'] + '.pdf')
+        assert '\nSHOW\n\\endgroup\n\\clearpage\n equation=0 gdef=False' in \
+            fname.read()
+
+        # Every page resets the counters, even if the fragment that changed
+        # them had no error.
+        frags[0]['tex'] = '\\stepcounter{equation}'
+        typeset, failed = asyncio.run(
+            typesetFragments('', None, frags, path, done.append))
+        assert len(typeset) == 2 and failed == []
+        fname = tmpdir.join('build', frags[1]['placeholder'] + '.pdf')
+        assert '\nSHOW\n\\endgroup\n\\clearpage\n equation=0' in fname.read()
+
+        # Documents in the same directory must not typeset each other's
+        # fragments, even if their placeholders are identical.
+        def typesetDocument(name):
+            path = nobby.PathNames(None, None, None, str(tmpdir),
+                                   str(tmpdir.join('build-' + name)), None)
+            frags = [{'tex': name + str(idx), 'inline': False,
+                      'counters': {}, 'placeholder': 'frag-{}'.format(idx)}
+                     for idx in range(4)]
+            return typesetFragments('', None, frags, path, lambda _: None)
+
+        async def main():
+            return await asyncio.gather(typesetDocument('A'),
+                                        typesetDocument('B'))
+
+        for name, (typeset, failed) in zip('AB', asyncio.run(main())):
+            assert len(typeset) == 4 and failed == []
+            for frag in typeset:
+                fname = tmpdir.join('build-' + name,
+                                    frag['placeholder'] + '.pdf')
+                assert frag['tex'] in fname.read()
+        assert not any(_.endswith('.tex') for _ in os.listdir(str(tmpdir)))
+
+    def test_FragmentQueue(self):
+        """
+        Hand out the most expensive fragment first, let consumers wait for
+        fragments that have not arrived yet, and return None once the queue
+        is closed and empty.
+        """
+        async def main():
+            queue = nobby.FragmentQueue([{'tex': 'a'}])
+            queue.put({'tex': 'b'}, 2)
+            queue.put({'tex': 'c'}, 1)
+            queue.put({'tex': 'd'})
+            out = [(await queue.get())['tex'] for _ in range(4)]
+            assert out == ['b', 'c', 'a', 'd']
+
+            waiter = asyncio.ensure_future(queue.get())
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            queue.put({'tex': 'e'})
+            assert (await waiter)['tex'] == 'e'
+
+            waiter = asyncio.ensure_future(queue.get())
+            await asyncio.sleep(0)
+            queue.close()
+            assert await waiter is None
+            assert await queue.get() is None
+        asyncio.run(main())
+
+    def test_runFragmentTasks(self, monkeypatch):
+        """
+        Run the tasks in order, limit the concurrent runs of every program,
+        and report every task, even if another one fails.
+        """
+        monkeypatch.setattr(config, 'num_processes', 3)
+        monkeypatch.setattr(config, 'tool_limits', {'slow': 1, 'fast': 5})
+        assert nobby.toolLimit('slow') == 1
+        assert nobby.toolLimit('fast') == 3
+        assert nobby.toolLimit('other') == 3
+        running = {'slow': 0, 'fast': 0}
+        started = []
+
+        async def run(tool):
+            async with nobby.toolSlot(tool):
+                running[tool] += 1
+                assert running[tool] <= nobby.toolLimit(tool)
+                await asyncio.sleep(0.01)
+                running[tool] -= 1
+
+        async def task(name):
+            started.append(name)
+            await run('slow')
+            await run('fast')
+            if name == 'bad':
+                raise ValueError(name)
+            return {name: None}
+
+        async def main():
+            queue = asyncio.Queue()
+            for name in ('a', 'bad', 'b', 'c'):
+                queue.put_nowait((task, (name,)))
+            queue.put_nowait(None)
+            await runFragmentTasks(queue, lambda ret, t: out.append(ret))
+
+        out = []
+        asyncio.run(main())
+        assert started == ['a', 'bad', 'b', 'c']
+        assert len(out) == 4
+        assert sorted(k for ret in out for k in ret) == ['a', 'b', 'c']
+
+    def test_nextConcurrency(self, monkeypatch):
+        """
+        Back off under memory pressure, high load or falling throughput, and
+        otherwise use idle cores.
+        """
+        monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+        monkeypatch.setattr(config, 'max_processes', 8)
+        monkeypatch.setattr(config, 'adaptive_min_memory', 100)
+        func = nobby.nextConcurrency
+        assert func(4, False, 1, 50, 1, 1) == (2, 'low memory')
+        assert func(4, False, 5, 200, 1, 1) == (3, 'high load')
+        assert func(4, True, 2, 200, 1, 2) == (3, 'lower throughput')
+        assert func(4, False, 2, 200, 1, 2) == (4, None)
+        assert func(4, True, 2, None, 2, 1) == (5, 'idle cores')
+        assert func(4, False, None, None, 1, None) == (5, 'idle cores')
+        assert func(4, False, 3.5, None, 1, None) == (4, None)
+        assert func(8, False, 1, None, 1, None) == (8, None)
+        assert func(1, False, 9, None, 1, None) == (1, None)
+
+    def test_ToolSlots_resize(self):
+        """
+        Waiting tasks must get a slot as soon as the limit grows, and tasks
+        must not get a slot while the number of used slots exceeds a reduced
+        limit.
+        """
+        async def main():
+            slots = nobby.ToolSlots(1)
+            await slots.acquire('x')
+            waiter = asyncio.ensure_future(slots.acquire('x'))
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            slots.resize(2)
+            await asyncio.sleep(0)
+            assert waiter.done() and slots.used['x'] == 2
+
+            slots.resize(1)
+            waiter = asyncio.ensure_future(slots.acquire('x'))
+            slots.release('x')
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            slots.release('x')
+            await asyncio.sleep(0)
+            assert waiter.done() and slots.used['x'] == 1
+
+            # Cancelled tasks must not occupy a slot.
+            waiter = asyncio.ensure_future(slots.acquire('x'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            slots.release('x')
+            assert slots.used['x'] == 0
+        asyncio.run(main())
+
+    def test_runTool(self):
+        """
+        Return the output of the program, and raise an error if it fails.
+        """
+        out = asyncio.run(runTool((sys.executable, '-c', 'print(1)')))
+        assert out.strip() == b'1'
+        with pytest.raises(subprocess.CalledProcessError):
+            asyncio.run(runTool((sys.executable, '-c', 'exit(2)')))
+
+        # The fragments of the task only pay for the time the program ran,
+        # not for the time it waited for a slot.
+        async def wait():
+            slots = nobby.ToolSlots(1)
+            nobby.tool_slots.set(slots)
+            await slots.acquire(sys.executable)
+            asyncio.get_running_loop().call_later(
+                0.5, slots.release, sys.executable)
+            frag = {}
+            nobby.charged_fragments.set([frag])
+            t0 = time.time()
+            await runTool((sys.executable, '-c', 'pass'))
+            return time.time() - t0, frag['tools'][sys.executable]
+
+        wall, seconds = asyncio.run(wait())
+        assert wall >= 0.5 and seconds < wall - 0.4
+
+    def test_compileWithCounters(self, tmpdir, monkeypatch):
+        """
+        A single pdflatex run must produce the PDF and auxiliary files of the
+        original document, as well as the counter dump. This test uses a mock
+        pdflatex that writes the counter dumps with all counters set to 3.
+        """
+        mock_pdflatex = '\n'.join([
+            '#!' + sys.executable,
+            'import os, re, sys',
+            'opts = dict(_[1:].split("=", 1) for _ in sys.argv[1:-1]',
+            '            if "=" in _)',
+            'out, job = opts["output-directory"], opts["jobname"]',
+            'tex = open(sys.argv[-1]).read()',
+            'open(os.path.join(out, "calls"), "a").write("x")',
+            'pat = r"\\\\addtostream\\{nobby\\}\\{((?:[^{}]|\\{[^{}]*\\})*)\\}"',
+            'dumps = [re.sub(r"\\\\arabic\\{\\w+\\}", "3", _)',
+            '         for _ in re.findall(pat, tex)]',
+            'open(os.path.join(out, job + ".nobby"), "w").write(',
+            '    "\\n".join(dumps))',
+            'for ext in ("aux", "log", "out", "pdf"):',
+            '    open(os.path.join(out, job + "." + ext), "w").write(ext)',
+        ])
+        tmpdir.mkdir('bin')
+        fname = str(tmpdir.join('bin', 'pdflatex'))
+        open(fname, 'w').write(mock_pdflatex)
+        os.chmod(fname, 0o755)
+        monkeypatch.setenv('PATH', str(tmpdir.join('bin')) + os.pathsep +
+                           os.environ['PATH'])
+        monkeypatch.setattr(config, 'use_latexmk', False)
+        monkeypatch.setattr(config, 'num_compile_iter', 1)
+
+        body = 'a \\section{A} b \\begin{equation}x\\end{equation}'
+        path = nobby.PathNames(str(tmpdir.join('doc.tex')), 'doc.tex', None,
+                               str(tmpdir), str(tmpdir.join('build')), None)
+        tex_out, counters = asyncio.run(
+            nobby.compileWithCounters('', body, path))
+        assert tmpdir.join('build', 'calls').read() == 'x'
+        assert tmpdir.join('build', 'doc.pdf').check()
+        assert tex_out.aux == 'aux'
+        assert [_.start for _ in counters] == [2, 16]
+        assert counters[0].counters['section'] == '3'
+        assert not any(_.endswith('.tex') for _ in os.listdir(str(tmpdir)))
+
+    def test_convertDocument_counters(self, tmpdir, monkeypatch):
+        """
+        The tree builds while the document compiles, yet the plugins must see
+        the counter values of this compilation, even on a cold start.
+        """
+        async def compileWithCounters(preamble, body, path_names):
+            await asyncio.sleep(0.05)
+            counters = [nobby.NTCounter(2, 10, {'section': '3'})]
+            return nobby.TexOut('', '', '', '', '', ''), counters
+
+        async def compileFragments(preamble, incoming, path, warm=False):
+            while await incoming.get() is not None:
+                pass
+            return {}
+
+        monkeypatch.setattr(config, 'counter_values', ())
+        monkeypatch.setattr(config, 'tex_output', None, raising=False)
+        monkeypatch.setattr(nobby, 'compileWithCounters', compileWithCounters)
+        monkeypatch.setattr(nobby, 'compileFragments', compileFragments)
+        monkeypatch.setattr(nobby, 'findCachedCounters', lambda *args: None)
+        monkeypatch.setattr(nobby, 'storeCachedCounters', lambda *args: None)
+
+        body = 'a \\section{A} b'
+        path = nobby.PathNames(str(tmpdir.join('doc.tex')), 'doc.tex', None,
+                               str(tmpdir), str(tmpdir.join('build')), None)
+        html, frags, metrics = asyncio.run(
+            nobby.convertDocument('', body, path))
+        assert '<h1>4  A</h1>' in html
+
+    def test_convertDocument_concurrent(self, tmpdir, monkeypatch):
+        """
+        Documents that convert concurrently must not see each other's counter
+        values, even if one builds its tree while the other converts.
+        """
+        async def compileWithCounters(preamble, body, path_names):
+            # The first document compiles slower than the second.
+            await asyncio.sleep(0.1 if body.startswith('1') else 0.01)
+            counters = [nobby.NTCounter(2, 10, {'section': body[0]})]
+            return nobby.TexOut('', '', '', '', '', ''), counters
+
+        async def compileFragments(preamble, incoming, path, warm=False):
+            while await incoming.get() is not None:
+                pass
+            return {}
+
+        monkeypatch.setattr(config, 'counter_values', ())
+        monkeypatch.setattr(config, 'tex_output', None, raising=False)
+        monkeypatch.setattr(nobby, 'compileWithCounters', compileWithCounters)
+        monkeypatch.setattr(nobby, 'compileFragments', compileFragments)
+        monkeypatch.setattr(nobby, 'findCachedCounters', lambda *args: None)
+        monkeypatch.setattr(nobby, 'storeCachedCounters', lambda *args: None)
+
+        def convert(name, body):
+            path = nobby.PathNames(
+                str(tmpdir.join(name + '.tex')), name + '.tex', None,
+                str(tmpdir), str(tmpdir.join('build-' + name)), None)
+            return nobby.convertDocument('', body, path)
+
+        async def main():
+            nobby.convert_lock.set(asyncio.Lock())
+            return await asyncio.gather(convert('a', '1 \\section{A} b'),
+                                        convert('b', '5 \\section{B} b'))
+
+        (html_a, _, _), (html_b, _, _) = asyncio.run(main())
+        assert '<h1>2  A</h1>' in html_a
+        assert '<h1>6  B</h1>' in html_b
+
+    def test_remapCounters(self):
+        """
+        Plain text edits must shift the counter positions, whereas edits of
+        LaTeX code or of a counter dump must invalidate them.
+        """
+        old = 'Some txet.\n\\section{A}\nMore \\begin{equation}x'
+        cnt = [nobby.NTCounter(11, 19, {'section': '0'}),
+               nobby.NTCounter(28, 44, {'section': '1'})]
+        assert old[11:19] == '\\section' and old[28:44].endswith('n}')
+
+        # Typo fix plus an additional word in front of the dumps.
+        new = 'Some nice text.\n\\section{A}\nMore \\begin{equation}x'
+        out = nobby.remapCounters(old, new, cnt)
+        assert [(_.start, _.stop) for _ in out] == [(16, 24), (33, 49)]
+        assert out[1].counters == {'section': '1'}
+
+        # Edits after the last dump do not shift anything.
+        assert nobby.remapCounters(old + ' y', old + ' z', cnt) == cnt
+
+        # Edits of LaTeX code.
+        assert nobby.remapCounters(old, old.replace('txet', '$x$'),
+                                   cnt) is None
+        assert nobby.remapCounters(old, old.replace('section', 'sectio'),
+                                   cnt) is None
+        assert nobby.remapCounters(old, old.replace('{A}', '{B}'),
+                                   cnt) is None
+        assert nobby.remapCounters(old, old.replace('equation', 'align'),
+                                   cnt) is None
+
+    def test_findCachedCounters(self, tmpdir, monkeypatch):
+        """
+        The counter cache must return the stored counters for an unchanged
+        document, remap them after plain text edits, and be invalid once
+        the preamble, an option, or any file LaTeX read has changed.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        path = nobby.PathNames(str(tmpdir.join('doc.tex')), 'doc.tex', None,
+                               str(tmpdir), str(tmpdir.join('build')), None)
+        tmpdir.join('chapter.tex').write('x')
+        tmpdir.mkdir('build').join('doc.pdf').write('pdf')
+        fls = 'INPUT ./doc.tex\nINPUT ./chapter.tex\nINPUT ./missing.tex\n'
+        tex_out = nobby.TexOut('tex', 'log', 'aux', 'out', None, fls)
+        body = 'Some txet \\begin{equation}'
+        cnt = [nobby.NTCounter(10, 26, {'equation': '0'})]
+        find = nobby.findCachedCounters
+
+        assert find('pre', body, path) is None
+        nobby.storeCachedCounters('pre', body, path, tex_out, cnt)
+        out, counters, fname_pdf = find('pre', body, path)
+        assert out == tex_out and counters == cnt
+        assert open(fname_pdf).read() == 'pdf'
+
+        # Plain text edits retain the counters, but not the PDF.
+        out, counters, fname_pdf = find('pre', 'Some text ' + body[10:], path)
+        assert counters == cnt and fname_pdf is None
+        assert find('pre', 'Some $x$ ' + body[10:], path) is None
+
+        # Changes of the preamble, options and included files.
+        assert find('other', body, path) is None
+        monkeypatch.setattr(config, 'num_compile_iter', 3)
+        assert find('pre', body, path) is None
+        monkeypatch.undo()
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        assert find('pre', body, path) is not None
+        tmpdir.join('chapter.tex').write('xy')
+        assert find('pre', body, path) is None
+
+        # Neither a rebuild nor a disabled cache use the counter cache.
+        tmpdir.join('chapter.tex').write('x')
+        nobby.storeCachedCounters('pre', body, path, tex_out, cnt)
+        monkeypatch.setattr(config, 'skip_existing_fragments', False)
+        assert find('pre', body, path) is None
+        monkeypatch.setattr(config, 'skip_existing_fragments', True)
+        monkeypatch.setattr(config, 'cache_dir', None)
+        assert find('pre', body, path) is None
+
+    def test_waitForChange(self, tmpdir, monkeypatch):
+        """
+        Return only once a watched file has changed, or has been created or
+        removed.
+        """
+        monkeypatch.setattr(config, 'watch_interval', 0.01)
+        fname = str(tmpdir.join('doc.tex'))
+        open(fname, 'w').write('a')
+        states = nobby.fileStates([fname, str(tmpdir.join('new.tex'))])
+        assert states[str(tmpdir.join('new.tex'))] is None
+
+        async def main(func):
+            waiter = asyncio.ensure_future(nobby.waitForChange(states))
+            await asyncio.sleep(0.05)
+            assert not waiter.done()
+            func()
+            await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(main(lambda: open(fname, 'w').write('ab')))
+        states = nobby.fileStates(states)
+        asyncio.run(main(lambda: tmpdir.join('new.tex').write('')))
+        states = nobby.fileStates(states)
+        asyncio.run(main(lambda: os.remove(fname)))
+
+    def test_Profile(self, monkeypatch):
+        """
+        Record stages and tools only if profiling is enabled, and report the
+        counts and percentiles of every tool.
+        """
+        with nobby.profileStage('stage'), nobby.profileTool('tool'):
+            pass
+        assert nobby.profiler is None
+
+        profile = nobby.Profile()
+        monkeypatch.setattr(nobby, 'profiler', profile)
+        for ii in range(2):
+            with nobby.profileStage('stage'):
+                pass
+        asyncio.run(nobby.runTool((sys.executable, '-c', '')))
+        for wall in (0.1, 0.3, 0.2):
+            profile.addTool('crop', profile.t0, wall)
+        assert list(profile.stages) == ['stage']
+        assert profile.stages['stage'][0] == 2
+        assert list(profile.tools) == [sys.executable, 'crop']
+
+        out = profile.report().splitlines()
+        crop = [_ for _ in out if _.strip().startswith('crop')][0].split()
+        assert crop[1:] == ['3', '0.60s', '0.200s', '0.300s', '0.300s',
+                            '0.300s']
+        assert out[-1].strip().startswith('Total:')
+
+    def test_reportSlowestFragments(self):
+        """
+        Map the fragments back to their source lines, and list the slowest
+        ones first, with the number of their uses and their tool times.
+        """
+        source = ('\\documentclass{article}\n\\begin{document}\n\n'
+                  'a $x$\n$y$ b\n$x$\n\\end{document}\n')
+        preamble, body = splitLaTeXDocument(source)
+        index = nobby.LineIndex(source, body)
+        assert [index.line(_) for _ in (0, 3, 6, 11, 12)] == [4, 4, 5, 5, 6]
+
+        def frag(tex, start, seconds=None):
+            out = {'tex': tex, 'node': 'dollar1_', 'hash': tex,
+                   'span': (start, start + len(tex))}
+            if seconds is not None:
+                out.update({'seconds': seconds, 'tools': {'pdf2svg': 0.5}})
+            return out
+        frags = [frag('$x$', 2, 1), frag('$y$', 6, 2), frag('$x$', 12)]
+
+        out = nobby.reportSlowestFragments(frags, index, 5).splitlines()
+        assert len(out) == 4
+        assert out[2].split() == ['5', 'dollar1_', '3', '1', '2.00s',
+                                  'pdf2svg', '0.50s']
+        assert out[3].split()[:5] == ['4', 'dollar1_', '3', '2', '1.00s']
+        assert len(nobby.reportSlowestFragments(frags, index, 1)
+                   .splitlines()) == 3
+
+    def test_writeTrace(self, tmpdir, monkeypatch):
+        """
+        Write every stage and span on its own track, and mark the start of
+        every stage across all tracks.
+        """
+        monkeypatch.setattr(nobby, 'profiler', nobby.Profile())
+
+        async def worker(num):
+            nobby.trace_track.set('doc.tex: TeX worker {}'.format(num))
+            with nobby.profileSpan('frag', {'fragment': num}):
+                await nobby.runTool((sys.executable, '-c', ''))
+
+        async def main():
+            with nobby.profileStage('compile fragments'):
+                await asyncio.gather(worker(10), worker(2))
+
+        asyncio.run(main())
+        fname = str(tmpdir.join('trace.json'))
+        nobby.profiler.writeTrace(fname)
+        events = json.loads(open(fname).read())['traceEvents']
+
+        names = {_['tid']: _['args']['name'] for _ in events
+                 if _['name'] == 'thread_name'}
+        assert [names[_] for _ in sorted(names)] == [
+            'stage: compile fragments', 'doc.tex: TeX worker 2',
+            'doc.tex: TeX worker 10']
+        spans = [(names[_['tid']], _['name']) for _ in events
+                 if _['ph'] == 'X']
+        assert sorted(spans) == [
+            ('doc.tex: TeX worker 10', sys.executable),
+            ('doc.tex: TeX worker 10', 'frag'),
+            ('doc.tex: TeX worker 2', sys.executable),
+            ('doc.tex: TeX worker 2', 'frag'),
+            ('stage: compile fragments', 'compile fragments')]
+        markers = [_ for _ in events if _['ph'] == 'i']
+        assert [_['name'] for _ in markers] == ['compile fragments']
+
+    def test_findTools(self, tmpdir, monkeypatch):
+        """
+        Query the version of every program only once, unless the program or
+        PATH changes, and report missing programs.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        tmpdir.mkdir('bin')
+        fname = str(tmpdir.join('bin', 'mytool'))
+        fname_log = str(tmpdir.join('log'))
+        open(fname, 'w').write('\n'.join([
+            '#!' + sys.executable,
+            'open({!r}, "a").write("x")'.format(fname_log),
+            'print("mytool 1.0")',
+        ]))
+        os.chmod(fname, 0o755)
+        monkeypatch.setenv('PATH', str(tmpdir.join('bin')))
+
+        def numRuns():
+            return len(open(fname_log).read())
+
+        # Query the tool only once.
+        out = nobby.findTools(['mytool'])
+        assert out == {'mytool': (fname, 'mytool 1.0')}
+        assert nobby.findTools(['mytool']) == out
+        assert numRuns() == 1
+
+        # Query it again if it was modified, or if PATH changed.
+        os.utime(fname, ns=(0, 0))
+        assert nobby.findTools(['mytool']) == out
+        assert numRuns() == 2
+        monkeypatch.setenv('PATH', str(tmpdir.join('bin')) + os.pathsep)
+        assert nobby.findTools(['mytool']) == out
+        assert numRuns() == 3
+
+        with pytest.raises(FileNotFoundError) as e:
+            nobby.findTools(['mytool', 'missing-tool'])
+        assert 'missing-tool' in str(e.value)
+
+    def test_findLaTeXFiles(self, tmpdir):
+        """
+        Replace directories with the LaTeX documents they contain, but keep
+        explicitly named files as they are.
+        """
+        tmpdir.join('b.tex').write('\\begin{document}\n\\end{document}')
+        tmpdir.join('a.tex').write('\\begin{document}\n\\end{document}')
+        tmpdir.join('inc.tex').write('Some text')
+        tmpdir.join('a.txt').write('\\begin{document}')
+        tmpdir.mkdir('sub.tex')
+        d = str(tmpdir)
+        fname = str(tmpdir.join('inc.tex'))
+
+        assert nobby.findLaTeXFiles([d]) == [
+            os.path.join(d, 'a.tex'), os.path.join(d, 'b.tex')]
+        assert nobby.findLaTeXFiles([fname, d])[0] == fname
+        assert nobby.findLaTeXFiles([str(tmpdir.mkdir('empty'))]) == []
+
+    def test_daemon(self, tmpdir, monkeypatch, capsys):
+        """
+        Report the jobs of the daemon, and route conversions through it only
+        if it is running.
+        """
+        monkeypatch.setattr(config, 'daemon_socket', str(tmpdir.join('s')))
+        fname = str(tmpdir.join('missing.tex'))
+
+        async def main():
+            # Without a daemon the client must convert the file itself.
+            assert await nobby.submitJob(fname) is None
+            assert await nobby.printDaemonStatus() == 1
+
+            daemon = asyncio.ensure_future(nobby.serveDaemon())
+            for ii in range(100):
+                if os.path.exists(config.daemon_socket):
+                    break
+                await asyncio.sleep(0.01)
+
+            # The daemon reports the failed conversion of the missing file.
+            assert await nobby.submitJob(fname) == 1
+            assert await nobby.printDaemonStatus() == 0
+
+            # The daemon must reject malformed requests and unknown options.
+            async def request(data):
+                reader, writer = await nobby.connectDaemon()
+                writer.write(data + b'\n')
+                reply = json.loads((await reader.readline()).decode('utf8'))
+                writer.close()
+                return reply
+
+            assert 'error' in await request(b'foo')
+            assert 'error' in await request(b'{"command": "convert"}')
+            reply = await request(json.dumps(
+                {'command': 'convert', 'file': fname,
+                 'options': {'daemon_socket': 'x'}}).encode('utf8'))
+            assert reply == {'error': 'unknown options: daemon_socket'}
+
+            # The values must have the type of the daemon's settings.
+            reply = await request(json.dumps(
+                {'command': 'convert', 'file': fname,
+                 'options': {'num_processes': 'x', 'verbose': 1,
+                             'pdf_scale': 2, 'cache_dir': None}}
+            ).encode('utf8'))
+            assert reply == {'error': 'invalid values for: num_processes, '
+                                      'verbose'}
+            daemon.cancel()
+            await asyncio.gather(daemon, return_exceptions=True)
+            assert not os.path.exists(config.daemon_socket)
+
+        asyncio.run(main())
+        out = capsys.readouterr().out
+        assert 'Job    0 error' in out
+        assert fname in out
+
+        # Every job sets the number of processes for all programs. Options
+        # that a job does not set have the value the daemon started with, not
+        # that of the previous job.
+        monkeypatch.setattr(config, 'num_processes', 1)
+        defaults = {name: getattr(config, name) for name in nobby.job_options}
+
+        async def runJobs(*options):
+            slots = nobby.ToolSlots(1)
+            nobby.tool_slots.set(slots)
+            out = []
+            for opts in options:
+                job = {'file': fname, 'options': opts,
+                       'events': asyncio.Queue()}
+                await nobby.runJob(job, {}, defaults)
+                out.append((job['status'], slots.num_processes,
+                            config.verbose))
+            return out
+
+        assert asyncio.run(runJobs(
+            {'num_processes': 3, 'verbose': True}, {})) == [
+                ('error', 3, True), ('error', 1, False)]
+
+        # Invalid values fail the job, but not the daemon or the next job.
+        out = asyncio.run(runJobs({'num_processes': 'x'}, {}))
+        assert out[0][0] == 'error' and out[1] == ('error', 1, False)
+
+    def test_checkJobRequest(self):
+        defaults = {name: getattr(config, name) for name in nobby.job_options}
+        defaults.update(pdf_scale=1.5, html_dir=None, num_processes=2)
+
+        def check(**options):
+            request = {'command': 'convert', 'file': 'a.tex',
+                       'options': options}
+            return nobby.checkJobRequest(request, defaults)
+
+        assert check() is None
+        assert check(pdf_scale=2, html_dir='html', num_processes=4) is None
+        assert check(cache_dir=None, trace='trace.json') is None
+        assert check(num_processes=2.5) == 'invalid values for: num_processes'
+        assert check(num_processes=True) == 'invalid values for: num_processes'
+        assert check(verbose=0) == 'invalid values for: verbose'
+        assert check(html_dir=1) == 'invalid values for: html_dir'
+        assert check(foo=1) == 'unknown options: foo'
+        assert nobby.checkJobRequest({'file': 'a.tex'}, defaults) is not None
+
+    def test_daemonOwner(self, tmpdir, monkeypatch, capsys):
+        """
+        Clients must only use a daemon of the same user, and the daemon must
+        only listen in a directory that nobody else can write to.
+        """
+        # A directory that everybody can write to.
+        shared = tmpdir.mkdir('shared')
+        shared.chmod(0o777)
+        assert not nobby.isPrivateDirectory(str(shared))
+        assert nobby.isPrivateDirectory(str(tmpdir.mkdir('private')))
+        monkeypatch.setattr(config, 'daemon_socket', str(shared.join('s')))
+        asyncio.run(nobby.serveDaemon())
+        assert 'Error: other users can write' in capsys.readouterr().out
+        assert not shared.join('s').check()
+
+        # The daemon creates a missing directory with private permissions.
+        fname = str(tmpdir.join('new', 's'))
+        monkeypatch.setattr(config, 'daemon_socket', fname)
+
+        async def main():
+            daemon = asyncio.ensure_future(nobby.serveDaemon())
+            for ii in range(100):
+                if os.path.exists(fname):
+                    break
+                await asyncio.sleep(0.01)
+            reader, writer = await nobby.connectDaemon()
+            owners = [nobby.daemonOwner(writer)]
+
+            # Without peer credentials, the directory and socket decide.
+            monkeypatch.delattr(nobby.socket, 'SO_PEERCRED', raising=False)
+            owners.append(nobby.daemonOwner(writer))
+            tmpdir.join('new').chmod(0o777)
+            owners.append(nobby.daemonOwner(writer))
+            tmpdir.join('new').chmod(0o700)
+            writer.close()
+
+            # Clients ignore the daemon of another user.
+            monkeypatch.setattr(nobby, 'daemonOwner', lambda writer: None)
+            assert await nobby.connectDaemon() is None
+            daemon.cancel()
+            await asyncio.gather(daemon, return_exceptions=True)
+            return owners
+
+        assert asyncio.run(main()) == [os.getuid(), os.getuid(), None]
+        assert 'does not belong to you' in capsys.readouterr().out
+        assert not nobby.isPrivateDirectory(str(tmpdir.join('missing')))
+
+    def test_computeCropBox(self):
+        """
+        Crop the image to its content and, for inline fragments, remove the
+        reference block and vertically center it.
+        """
+        # Empty images have no crop box.
+        img = np.ones((20, 30))
+        assert computeCropBox(img, False) is None
+        assert computeCropBox(img, True) is None
+
+        # Reference block (3x4 pixels) followed by text that reaches further
+        # down than up.
+        img[8:12, 2:5] = 0
+        img[6:16, 10:20] = 0
+        assert computeCropBox(img, False) == (2, 6, 20, 16)
+        assert computeCropBox(img, True) == (7, 4, 20, 16)
+
+        # Same, but the text reaches further up than down.
+        img = np.ones((20, 30))
+        img[8:12, 2:5] = 0
+        img[4:14, 10:20] = 0
+        assert computeCropBox(img, True) == (7, 4, 20, 16)
+
+        # A block without any text.
+        img = np.ones((20, 30))
+        img[8:12, 2:5] = 0
+        assert computeCropBox(img, True) is None
+
+    def test_cropSVG(self):
+        """
+        Replace the size and view box of the root element only.
+        """
+        svg = ('<?xml version="1.0"?>\n'
+               '<svg xmlns="http://www.w3.org/2000/svg" width="100pt" '
+               'height="50pt" viewBox="0 0 100 50" version="1.1">\n'
+               '<g width="1pt"></g></svg>')
+        out = cropSVG(svg, (10, 5, 30, 15.5))
+        assert out == ('<?xml version="1.0"?>\n'
+                       '<svg xmlns="http://www.w3.org/2000/svg" '
+                       'width="20.00pt" height="10.50pt" '
+                       'viewBox="10.00 5.00 20.00 10.50" version="1.1">\n'
+                       '<g width="1pt"></g></svg>')
+
+    def test_convertFragmentDVI(self, tmpdir, monkeypatch):
+        """
+        Pad and scale the view box that dvisvgm computed for a fragment.
+        """
+        monkeypatch.setattr(config, 'cache_dir', None)
+        monkeypatch.setattr(config, 'backend', 'dvi')
+        monkeypatch.setattr(config, 'pdf_scale', 2)
+        monkeypatch.setattr(config, 'fragment_padding', 1)
+        build_dir, target_dir = str(tmpdir.mkdir('b')), str(tmpdir.mkdir('t'))
+        svg = ('<svg width="{0}pt" height="{1}pt" viewBox="{2}">'
+               '<g></g></svg>')
+        frag = {'placeholder': 'ph', 'hash': 'ab12', 'inline': True,
+                'name': '$', 'box': (10, 6, 2.0075, 0, 0)}
+
+        # Measured fragments: the depth comes from TeX.
+        fname = os.path.join(build_dir, 'ph.svg')
+        open(fname, 'w').write(svg.format(10, 8, '5 -6 10 8'))
+        metrics = convertFragmentDVI(build_dir, target_dir, frag)
+        assert np.allclose(metrics, (24, 20, 6))
+        out = open(os.path.join(target_dir, 'ph.svg')).read()
+        assert 'width="24.00pt" height="20.00pt"' in out
+        assert 'viewBox="4.00 -7.00 12.00 10.00"' in out
+
+        # Display fragments: use the exact view box as is.
+        frag['inline'] = False
+        metrics = convertFragmentDVI(build_dir, target_dir, frag)
+        assert metrics is None
+        out = open(os.path.join(target_dir, 'ph.svg')).read()
+        assert 'viewBox="5.00 -6.00 10.00 8.00"' in out
+
+        # Empty pages.
+        open(fname, 'w').write(svg.format(0, 0, '0 0 0 0'))
+        assert convertFragmentDVI(build_dir, target_dir, frag) is None
+        out = open(os.path.join(target_dir, 'ph.svg')).read()
+        assert out == config.empty_svg
+
+    def test_estimateFragmentTime(self, tmpdir, monkeypatch):
+        """
+        Prefer recorded times, and otherwise rank graphics above display
+        equations above inline equations.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        inline = {'tex': '$x$', 'inline': True}
+        display = {'tex': '\\begin{equation}x\\end{equation}',
+                   'inline': False}
+        tikz = {'tex': '\\begin{tikzpicture}\\end{tikzpicture}',
+                'inline': False}
+        est = [estimateFragmentTime(_) for _ in (inline, display, tikz)]
+        assert est == sorted(est)
+
+        # Recorded times take precedence, and do not depend on the counters
+        # or the preamble.
+        storeCachedTiming(inline, 12.5)
+        assert estimateFragmentTime(inline) == 12.5
+        assert estimateFragmentTime(dict(inline, counters={'a': 1})) == 12.5
+        assert findCachedTiming(display) is None
+
+        # The store is part of the fragment cache.
+        monkeypatch.setattr(config, 'cache_dir', None)
+        storeCachedTiming(display, 1)
+        assert findCachedTiming(inline) is None
+        assert estimateFragmentTime(inline) == est[0]
+
+    def test_fragmentCache_metrics(self, tmpdir, monkeypatch):
+        """
+        The cache must return the metrics it stored alongside an image.
+        """
+        monkeypatch.setattr(config, 'cache_dir', str(tmpdir.join('cache')))
+        fname = str(tmpdir.join('img.svg'))
+        open(fname, 'w').write('<svg/>')
+
+        storeCachedFragment('ab12', fname)
+        assert findCachedMetrics('ab12') is None
+        storeCachedFragment('cd34', fname, (20.5, 10, 2.25))
+        assert findCachedMetrics('cd34') == (20.5, 10, 2.25)
+
+        monkeypatch.setattr(config, 'cache_dir', None)
+        assert findCachedMetrics('cd34') is None